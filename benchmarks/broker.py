@@ -0,0 +1,125 @@
+#benchmarks\broker.py
+
+"""
+In-memory stand-in for RabbitMQ, for running the whole pipeline in one process.
+
+``InMemoryBroker`` takes the place of the API's TaskPublisher, ResultConsumer
+and ProgressListener. A task published to a stage queue is run through the
+stage worker's real ``process_task`` with ``task_queue.run_task``, on a
+thread pool sized like one worker process per stage with prefetch 1, and the
+tagged result is applied with ``apply_result_batch`` as the result consumer
+would. Requeued tasks are redelivered with a higher delivery count until
+MAX_DELIVERIES, as the quorum queues do.
+"""
+
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from publisher import PublishError
+from task_queue import REQUEUE, run_task
+
+
+class _Properties:
+    """Just enough of pika's BasicProperties for run_task()."""
+
+    def __init__(self, headers, delivery_count):
+        self.headers = {**(headers or {}), "x-delivery-count": delivery_count}
+
+
+class InMemoryBroker:
+    """
+    ``consumers`` maps a queue name to ``(stage, process, give_up)``;
+    ``on_results`` is a coroutine taking a list of results. Publishing to a
+    queue with no consumer fails like an unroutable message. With
+    ``discard=True`` tasks are accepted and dropped, so the API can be
+    measured without the workers competing for the CPU.
+    """
+
+    def __init__(self, consumers, on_results, concurrency=1, discard=False):
+        self.consumers = consumers
+        self.on_results = on_results
+        self.concurrency = max(1, concurrency)
+        self.discard = discard
+        self.published = 0
+        self.delivered = 0
+        self.stage_seconds = {stage: [] for stage, _, _ in consumers.values()}
+        self._queues = {}
+        self._tasks = []
+        self._busy = 0
+        self._executor = None
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=len(self.consumers) * self.concurrency,
+                                            thread_name_prefix="broker")
+        for queue_name in self.consumers:
+            self._queues[queue_name] = asyncio.Queue()
+            for _ in range(self.concurrency):
+                self._tasks.append(asyncio.create_task(self._consume(queue_name)))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    @property
+    def idle(self):
+        """No task waiting or running (safe to read from another thread)."""
+        return self._busy == 0 and all(q.empty() for q in self._queues.values())
+
+    async def publish(self, payload, headers=None, routing_key=""):
+        queue = self._queues.get(routing_key)
+        if queue is None:
+            raise PublishError(f"Task for {routing_key!r} was returned by the broker (no queue bound)")
+        self.published += 1
+        if not self.discard:
+            queue.put_nowait((json.dumps(payload).encode(), headers, 0))
+
+    async def queue_depth(self, queue_name):
+        queue = self._queues.get(queue_name)
+        return None if queue is None else queue.qsize()
+
+    async def _consume(self, queue_name):
+        stage, process, give_up = self.consumers[queue_name]
+        queue = self._queues[queue_name]
+        loop = asyncio.get_running_loop()
+        while True:
+            body, headers, delivery_count = await queue.get()
+            self._busy += 1
+            try:
+                started = time.perf_counter()
+                outcome, result = await loop.run_in_executor(
+                    self._executor, run_task, stage, _Properties(headers, delivery_count), body, process, give_up,
+                )
+                self.stage_seconds[stage].append(time.perf_counter() - started)
+                self.delivered += 1
+                if outcome == REQUEUE:
+                    queue.put_nowait((body, headers, delivery_count + 1))
+                elif result is not None:
+                    await self.on_results([result])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[BROKER][ERROR] {stage}: {e}")
+            finally:
+                self._busy -= 1
+
+
+async def _noop():
+    pass
+
+
+def install(app_module, broker):
+    """Route the API module's broker traffic through ``broker``."""
+    app_module.task_publisher.start = broker.start
+    app_module.task_publisher.close = broker.close
+    app_module.task_publisher.publish = broker.publish
+    app_module.task_publisher.queue_depth = broker.queue_depth
+    for client in (app_module.result_consumer, app_module.progress_listener):
+        client.start = _noop
+        client.close = _noop
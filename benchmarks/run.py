@@ -0,0 +1,554 @@
+#benchmarks\run.py
+
+"""
+Reproducible benchmarks for the video pipeline.
+
+    python benchmarks/run.py [--quick] [--only enhancement,metadata] [--repeat 3]
+                             [--output results.json] [--baseline previous.json]
+    python benchmarks/run.py --compare previous.json results.json
+
+Groups:
+
+    enhancement  enhance_video and enhance_video_parallel on synthetic videos:
+                 input frames/s and peak RSS
+    metadata     extract_metadata with a cold and a warm cache, and the OpenCV
+                 fallback: latency
+    upload       POST /upload and the chunked /uploads protocol, through the
+                 FastAPI app in-process: MB/s
+    stream       whole-file and 1 MiB Range reads from /stream: MB/s
+    end_to_end   upload to completion through InMemoryBroker and the real
+                 stage workers, one job at a time, again as result-cache hits,
+                 and as a burst: seconds per job, and the cache's hit count
+
+Test videos are generated from fixed seeds, so two runs differ only by the
+code and the host. Results are written as JSON together with the host and
+the pipeline's environment settings. With --baseline (or --compare) every
+metric is compared with the earlier run; metrics named ``*_per_second`` should
+go up and ``*_seconds``/``*_ms``/``*_mb`` down, and a change beyond
+--tolerance the wrong way is a regression (exit status 1).
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+sys.path[:0] = [os.path.join(PROJECT_ROOT, "server"), os.path.join(PROJECT_ROOT, "workers")]
+
+import cv2
+import numpy as np
+
+from synthetic import QUICK_SPECS, VIDEO_SPECS, generate_specs, generate_video
+
+GROUPS = ["enhancement", "metadata", "upload", "stream", "end_to_end"]
+RESULTS_VERSION = 1
+DEFAULT_TOLERANCE = 0.10
+MIB = 1024 * 1024
+# Environment settings that change what is being measured
+ENV_PREFIXES = ("ENHANCE_", "SCHED_", "ADMIT_", "UPLOAD_", "METADATA_", "THUMBNAIL_", "HLS_",
+                "STATE_", "RESULT_", "PIPELINE_SPEC", "TASK_")
+# Result-cache index used instead of the API's own, removed before every app is opened
+BENCH_CACHE_INDEX = ".bench_result_cache.json"
+E2E_TIMEOUT = 600
+E2E_POLL_INTERVAL = 0.02
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile, as /scheduler/stats reports them."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def progress(message):
+    # The API's request logging is sent to /dev/null during runs; progress is not
+    print(message, file=sys.__stdout__, flush=True)
+
+
+def summarize(seconds, scale=1.0, unit="seconds"):
+    """Median and p95 of timing samples, in ``unit`` (seconds multiplied by ``scale``)."""
+    return {
+        f"median_{unit}": round(statistics.median(seconds) * scale, 4),
+        f"p95_{unit}": round(percentile(seconds, 0.95) * scale, 4),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "settings": {k: v for k, v in sorted(os.environ.items()) if k.startswith(ENV_PREFIXES)},
+    }
+
+
+# --- enhancement and metadata (worker functions, no API) ---------------------
+
+def bench_enhancement(videos, repeat, workdir):
+    import enhancement_worker
+
+    results = {}
+    modes = {
+        "serial": enhancement_worker.enhance_video,
+        "parallel": enhancement_worker.enhance_video_parallel,
+    }
+    for name, (path, frames) in videos.items():
+        for mode, enhance in modes.items():
+            seconds = []
+            peak_rss = []
+            for i in range(repeat):
+                output_path = os.path.join(workdir, f"{name}_{mode}_{i}_enhanced.mp4")
+                started = time.perf_counter()
+                stats = enhance(path, output_path)
+                seconds.append(time.perf_counter() - started)
+                if not stats:
+                    raise RuntimeError(f"{mode} enhancement of {name} failed")
+                peak_rss.append(stats["peak_rss_mb"])
+                os.remove(stats["output_path"])
+            results[f"{mode}/{name}"] = {
+                **summarize(seconds),
+                "frames_per_second": round(frames / statistics.median(seconds), 2),
+                "peak_rss_mb": max(peak_rss),
+                "input_frames": frames,
+                "output_frames": stats["frames_written"],
+                "writer": stats["writer"],
+            }
+            progress(f"  enhancement {mode}/{name}: {results[f'{mode}/{name}']['frames_per_second']} frames/s")
+    return results
+
+
+def bench_metadata(videos, repeat):
+    import metadata_worker
+
+    results = {}
+    samples = max(20, repeat * 10)
+    for name, (path, _) in videos.items():
+        def cold():
+            metadata_worker._metadata_cache.clear()
+            return metadata_worker.extract_metadata(path)
+
+        cases = {
+            "cold": cold,
+            "warm": lambda: metadata_worker.extract_metadata(path),
+            "opencv": lambda: metadata_worker._opencv_metadata(path),
+        }
+        for case, extract in cases.items():
+            seconds = []
+            for _ in range(samples):
+                started = time.perf_counter()
+                metadata = extract()
+                seconds.append(time.perf_counter() - started)
+                if not metadata:
+                    raise RuntimeError(f"Metadata extraction ({case}) failed for {name}")
+            results[f"{case}/{name}"] = summarize(seconds, 1000, "ms")
+            progress(f"  metadata {case}/{name}: {results[f'{case}/{name}']['median_ms']} ms")
+    return results
+
+
+# --- API benchmarks (FastAPI app in-process, InMemoryBroker) -------------------
+
+class StorageSnapshot:
+    """Removes whatever the benchmarks left under the API's storage directory."""
+
+    def __init__(self, root):
+        self.root = root
+        self.paths = self._walk()
+
+    def _walk(self):
+        paths = set()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            paths.add(dirpath)
+            paths.update(os.path.join(dirpath, name) for name in filenames)
+        return paths
+
+    def restore(self):
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if path not in self.paths:
+                    os.remove(path)
+            if dirpath not in self.paths:
+                shutil.rmtree(dirpath, ignore_errors=True)
+
+
+def open_app(workdir, discard):
+    """The API module wired to a fresh InMemoryBroker and an empty result cache."""
+    import main
+    import enhancement_worker
+    import metadata_worker
+    import thumbnail_worker
+    from broker import InMemoryBroker, install
+    from result_cache import ResultCache
+
+    workers = {"metadata": metadata_worker, "enhancement": enhancement_worker, "thumbnails": thumbnail_worker}
+    consumers = {
+        main.pipeline.stages[stage].queue: (stage, module.process_task, module.give_up)
+        for stage, module in workers.items() if stage in main.pipeline.stages
+    }
+    broker = InMemoryBroker(consumers, main.apply_result_batch, discard=discard)
+    install(main, broker)
+    # The cache only keeps outputs it finds under STORAGE_DIR, so it stays there with an
+    # index of its own; every run starts cold and the end-to-end group reports its hits
+    index_path = os.path.join(main.STORAGE_DIR, BENCH_CACHE_INDEX)
+    for path in (index_path, index_path + ".lock"):
+        if os.path.exists(path):
+            os.remove(path)
+    main.result_cache = ResultCache(main.STORAGE_DIR, index_name=BENCH_CACHE_INDEX,
+                                    referenced=main.result_cache.referenced)
+    return main, broker
+
+
+def random_payload(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+def bench_upload(client, main, sizes_mib, repeat):
+    results = {}
+    for size_mib in sizes_mib:
+        payload = random_payload(size_mib * MIB, size_mib)
+
+        seconds = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            res = client.post("/upload", files={"file": ("bench.mp4", payload, "video/mp4")},
+                              headers={"X-Client-Id": "bench"})
+            seconds.append(time.perf_counter() - started)
+            forget_job(main, res)
+        results[f"multipart/{size_mib}MiB"] = {
+            **summarize(seconds),
+            "mb_per_second": round(size_mib / statistics.median(seconds), 2),
+        }
+
+        seconds = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            res = chunked_upload(client, payload)
+            seconds.append(time.perf_counter() - started)
+            forget_job(main, res)
+        results[f"chunked/{size_mib}MiB"] = {
+            **summarize(seconds),
+            "mb_per_second": round(size_mib / statistics.median(seconds), 2),
+        }
+        for case in ("multipart", "chunked"):
+            progress(f"  upload {case}/{size_mib}MiB: {results[f'{case}/{size_mib}MiB']['mb_per_second']} MB/s")
+    return results
+
+
+def chunked_upload(client, payload):
+    res = client.post("/uploads", json={"filename": "bench.mp4", "size": len(payload)},
+                      headers={"X-Client-Id": "bench"})
+    if res.status_code != 201:
+        raise RuntimeError(f"/uploads answered {res.status_code}: {res.text}")
+    session = res.json()
+    chunk_size = session["chunk_size"]
+    for index in range(session["chunk_count"]):
+        chunk = payload[index * chunk_size:(index + 1) * chunk_size]
+        res = client.put(f"/uploads/{session['upload_id']}/chunks/{index}", content=chunk,
+                         headers={"X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest()})
+        if res.status_code != 200:
+            raise RuntimeError(f"Chunk {index} answered {res.status_code}: {res.text}")
+    return client.post(f"/uploads/{session['upload_id']}/finalize", headers={"X-Client-Id": "bench"})
+
+
+def forget_job(main, res):
+    """Drop an upload-only job so the next one is not held back by admission control."""
+    if res.status_code != 200:
+        raise RuntimeError(f"Upload answered {res.status_code}: {res.text}")
+    video_id = res.json()["video_id"]
+    state = main.job_store.get(video_id)
+    main.job_store.delete(video_id)
+    if state and state.get("filepath") and os.path.exists(state["filepath"]):
+        os.remove(state["filepath"])
+
+
+def bench_stream(client, main, size_mib, repeat, range_reads=64):
+    filename = f"bench-{os.getpid()}_stream.mp4"
+    path = os.path.join(main.STORAGE_DIR, filename)
+    size = size_mib * MIB
+    with open(path, "wb") as f:
+        f.write(random_payload(size, 7))
+
+    try:
+        results = {}
+        seconds = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            res = client.get(f"/stream/{filename}")
+            seconds.append(time.perf_counter() - started)
+            if res.status_code != 200 or len(res.content) != size:
+                raise RuntimeError(f"/stream answered {res.status_code} with {len(res.content)} bytes")
+        results[f"full/{size_mib}MiB"] = {
+            **summarize(seconds),
+            "mb_per_second": round(size_mib / statistics.median(seconds), 2),
+        }
+
+        rng = random.Random(11)
+        seconds = []
+        for _ in range(repeat):
+            offsets = [rng.randrange(0, size - MIB) for _ in range(range_reads)]
+            started = time.perf_counter()
+            for offset in offsets:
+                res = client.get(f"/stream/{filename}", headers={"Range": f"bytes={offset}-{offset + MIB - 1}"})
+                if res.status_code != 206 or len(res.content) != MIB:
+                    raise RuntimeError(f"Range read answered {res.status_code} with {len(res.content)} bytes")
+            seconds.append(time.perf_counter() - started)
+        elapsed = statistics.median(seconds)
+        results["range/1MiB"] = {
+            "median_ms": round(elapsed / range_reads * 1000, 3),
+            "mb_per_second": round(range_reads / elapsed, 2),
+        }
+        for case, metrics in results.items():
+            progress(f"  stream {case}: {metrics['mb_per_second']} MB/s")
+        return results
+    finally:
+        os.remove(path)
+
+
+def wait_for_job(client, video_id, started):
+    deadline = started + E2E_TIMEOUT
+    while time.perf_counter() < deadline:
+        status = client.get(f"/status/{video_id}").json()
+        if status.get("error"):
+            raise RuntimeError(f"Job {video_id} failed: {status['error']}")
+        if status.get("complete"):
+            return time.perf_counter() - started
+        time.sleep(E2E_POLL_INTERVAL)
+    raise RuntimeError(f"Job {video_id} did not complete within {E2E_TIMEOUT}s")
+
+
+def wait_idle(broker):
+    """Let optional stages (thumbnails) finish before the broker is torn down."""
+    deadline = time.perf_counter() + E2E_TIMEOUT
+    while not broker.idle and time.perf_counter() < deadline:
+        time.sleep(E2E_POLL_INTERVAL)
+
+
+def e2e_upload(client, path, client_name):
+    with open(path, "rb") as f:
+        data = f.read()
+    started = time.perf_counter()
+    res = client.post("/upload", files={"file": (os.path.basename(path), data, "video/mp4")},
+                      headers={"X-Client-Id": client_name})
+    if res.status_code != 200:
+        raise RuntimeError(f"/upload answered {res.status_code}: {res.text}")
+    return res.json()["video_id"], started
+
+
+def bench_end_to_end(client, main, broker, spec, jobs, workdir):
+    width, height, seconds, fps = VIDEO_SPECS[spec]
+    # A distinct seed per job, so only the "cached" case is served from the result cache
+    paths = []
+    for seed in range(2 * jobs):
+        path = os.path.join(workdir, f"e2e_{seed}.mp4")
+        generate_video(path, width, height, seconds, fps, seed=1000 + seed)
+        paths.append(path)
+
+    results = {}
+    latencies = []
+    for path in paths[:jobs]:
+        video_id, started = e2e_upload(client, path, "bench")
+        latencies.append(wait_for_job(client, video_id, started))
+    wait_idle(broker)
+    results[f"sequential/{spec}"] = {**summarize(latencies), "jobs": jobs}
+
+    # The same videos again: result-cache hits, which skip the pipeline
+    hits = main.result_cache.hits
+    latencies = []
+    for path in paths[:jobs]:
+        video_id, started = e2e_upload(client, path, "bench")
+        latencies.append(wait_for_job(client, video_id, started))
+    wait_idle(broker)
+    results[f"cached/{spec}"] = {**summarize(latencies), "jobs": jobs, "hits": main.result_cache.hits - hits}
+
+    # Burst: every job uploaded at once from two clients, so the scheduler has a queue to order
+    started = time.perf_counter()
+    submitted = [e2e_upload(client, path, f"bench-{i % 2}") for i, path in enumerate(paths[jobs:])]
+    latencies = [wait_for_job(client, video_id, job_started) for video_id, job_started in submitted]
+    makespan = time.perf_counter() - started
+    wait_idle(broker)
+    results[f"burst/{spec}"] = {
+        **summarize(latencies),
+        "makespan_seconds": round(makespan, 4),
+        "jobs_per_second": round(jobs / makespan, 4),
+        "jobs": jobs,
+    }
+    for stage, samples in broker.stage_seconds.items():
+        if samples:
+            results[f"stage/{stage}"] = summarize(samples)
+    cache = main.result_cache.stats()
+    results["result_cache"] = {name: cache[name] for name in ("hits", "misses", "hit_ratio")}
+    for case, metrics in results.items():
+        if "median_seconds" in metrics:
+            progress(f"  end_to_end {case}: median {metrics['median_seconds']}s")
+    progress(f"  end_to_end result cache: {cache['hits']} hits, {cache['misses']} misses")
+    return results
+
+
+def run_api_benchmarks(groups, args, workdir):
+    from fastapi.testclient import TestClient
+
+    results = {}
+    if {"upload", "stream"} & groups:
+        main, broker = open_app(workdir, discard=True)
+        with TestClient(main.app) as client:
+            if "upload" in groups:
+                results["upload"] = bench_upload(client, main, [16] if args.quick else [16, 128], args.repeat)
+            if "stream" in groups:
+                results["stream"] = bench_stream(client, main, 16 if args.quick else 64, args.repeat)
+    if "end_to_end" in groups:
+        main, broker = open_app(workdir, discard=False)
+        spec = "360p_5s_30fps" if args.quick else "720p_5s_30fps"
+        with TestClient(main.app) as client:
+            results["end_to_end"] = bench_end_to_end(client, main, broker, spec, 2 if args.quick else args.jobs, workdir)
+    return results
+
+
+# --- baseline comparison --------------------------------------------------------
+
+def metric_direction(name):
+    """+1 if higher is better, -1 if lower is better, 0 for informational values."""
+    if name.endswith("_per_second"):
+        return 1
+    if name.endswith(("_seconds", "_ms", "_mb")):
+        return -1
+    return 0
+
+
+def compare(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """Rows of (metric, baseline, current, relative change, regressed) for metrics present in both runs."""
+    rows = []
+    for group, cases in current.get("results", {}).items():
+        for case, metrics in cases.items():
+            previous = baseline.get("results", {}).get(group, {}).get(case, {})
+            for metric, value in metrics.items():
+                old = previous.get(metric)
+                direction = metric_direction(metric)
+                if not direction or not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or not old:
+                    continue
+                change = (value - old) / old
+                rows.append((f"{group}/{case}/{metric}", old, value, change, change * direction < -tolerance))
+    return rows
+
+
+def print_comparison(rows, tolerance):
+    width = max((len(row[0]) for row in rows), default=10)
+    print(f"\n{'metric':<{width}}  {'baseline':>12}  {'current':>12}  {'change':>8}")
+    for name, old, new, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<{width}}  {old:>12.4g}  {new:>12.4g}  {change:>+8.1%}{flag}")
+    regressions = sum(1 for row in rows if row[4])
+    print(f"\n{regressions} regression(s) beyond {tolerance:.0%} in {len(rows)} compared metrics")
+    return regressions
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# --- entry point ------------------------------------------------------------------
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Video pipeline benchmarks")
+    parser.add_argument("--only", default=",".join(GROUPS),
+                        help=f"comma-separated groups to run (default: all of {', '.join(GROUPS)})")
+    parser.add_argument("--quick", action="store_true", help="smaller videos and payloads")
+    parser.add_argument("--repeat", type=int, default=3, help="timed repetitions per case (default 3)")
+    parser.add_argument("--jobs", type=int, default=4, help="jobs per end-to-end case (default 4)")
+    parser.add_argument("--output", default=None,
+                        help="results file (default benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="earlier results to compare against")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="only compare two results files")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative change counted as a regression (default 0.10)")
+    parser.add_argument("--verbose", action="store_true", help="keep API and worker logging")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        rows = compare(load_results(args.compare[0]), load_results(args.compare[1]), args.tolerance)
+        sys.exit(1 if print_comparison(rows, args.tolerance) else 0)
+
+    groups = {g.strip() for g in args.only.split(",") if g.strip()}
+    unknown = groups - set(GROUPS)
+    if unknown:
+        sys.exit(f"Unknown benchmark group(s): {', '.join(sorted(unknown))}")
+    output = os.path.abspath(args.output or os.path.join(
+        BENCH_DIR, "results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"))
+    baseline = load_results(args.baseline) if args.baseline else None
+
+    workdir = tempfile.mkdtemp(prefix="video-bench-")
+    # Workers open their log files in the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    storage = StorageSnapshot(os.path.abspath(os.path.join(PROJECT_ROOT, "static", "storage")))
+
+    specs = QUICK_SPECS if args.quick else list(VIDEO_SPECS)
+    report = {
+        "version": RESULTS_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "config": {"groups": sorted(groups), "quick": args.quick, "repeat": args.repeat,
+                   "jobs": args.jobs, "videos": {name: VIDEO_SPECS[name] for name in specs}},
+        "results": {},
+    }
+    try:
+        videos = {}
+        if {"enhancement", "metadata"} & groups:
+            print(f"Generating {len(specs)} synthetic video(s)...")
+            videos = generate_specs(os.path.join(workdir, "videos"), specs)
+        with quiet:
+            if "metadata" in groups:
+                progress("Metadata...")
+                report["results"]["metadata"] = bench_metadata(videos, args.repeat)
+            if "enhancement" in groups:
+                progress("Enhancement...")
+                report["results"]["enhancement"] = bench_enhancement(videos, args.repeat, workdir)
+            if {"upload", "stream", "end_to_end"} & groups:
+                progress("API (upload, stream, end to end)...")
+                report["results"].update(run_api_benchmarks(groups, args, workdir))
+    finally:
+        storage.restore()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline is not None:
+        rows = compare(baseline, report, args.tolerance)
+        sys.exit(1 if print_comparison(rows, args.tolerance) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#benchmarks\synthetic.py
+
+"""
+Synthetic test videos for the benchmarks.
+
+Frames are drawn from a seeded pattern (a scrolling colour gradient, a
+bouncing block and per-frame noise) and written with cv2.VideoWriter, so a
+given spec and seed always produce the same frames and runs on different
+trees can be compared.
+"""
+
+import math
+import os
+
+import cv2
+import numpy as np
+
+# name -> (width, height, seconds, fps)
+VIDEO_SPECS = {
+    "360p_5s_30fps": (640, 360, 5, 30),
+    "720p_5s_30fps": (1280, 720, 5, 30),
+    "720p_10s_60fps": (1280, 720, 10, 60),
+    "1080p_5s_30fps": (1920, 1080, 5, 30),
+}
+QUICK_SPECS = ["360p_5s_30fps", "720p_5s_30fps"]
+VIDEO_CODEC = "mp4v"
+# Noise frames cycled through, so generation does not dominate the run
+NOISE_FRAMES = 8
+
+
+def generate_video(path, width, height, seconds, fps, seed=0, codec=VIDEO_CODEC):
+    """Write a synthetic video to ``path`` and return the number of frames written."""
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"cv2.VideoWriter cannot write {codec} to {path}")
+
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 24, size=(NOISE_FRAMES, height, width, 3), dtype=np.uint8)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)
+    base = x[None, :] * 0.6 + y[:, None] * 0.4
+    block = max(16, height // 6)
+    phase = rng.uniform(0, 2 * math.pi)
+
+    frames = int(round(seconds * fps))
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    try:
+        for i in range(frames):
+            shift = (i * 4) % 256
+            frame[..., 0] = (base + shift) % 256
+            frame[..., 1] = (base * 0.5 + 2 * shift) % 256
+            frame[..., 2] = 255 - frame[..., 0]
+            out = cv2.add(frame, noise[i % NOISE_FRAMES])
+            t = i / fps
+            bx = int((width - block) * (0.5 + 0.5 * math.sin(2 * t + phase)))
+            by = int((height - block) * (0.5 + 0.5 * math.cos(3 * t + phase)))
+            cv2.rectangle(out, (bx, by), (bx + block, by + block), (255, 255, 255), -1)
+            writer.write(out)
+    finally:
+        writer.release()
+    return frames
+
+
+def generate_specs(directory, names, seed=0):
+    """Generate the named VIDEO_SPECS into ``directory``; returns {name: (path, frames)}."""
+    os.makedirs(directory, exist_ok=True)
+    videos = {}
+    for name in names:
+        width, height, seconds, fps = VIDEO_SPECS[name]
+        path = os.path.join(directory, f"{name}.mp4")
+        videos[name] = (path, generate_video(path, width, height, seconds, fps, seed=seed))
+    return videos
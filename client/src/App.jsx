@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from "react";
-import axios from "axios";
+import { resumableUpload } from "./resumableUpload";
 import VideoUpload from "./components/VideoUpload";
 import ResultDisplay from "./components/ResultDisplay";
 import ProcessingStatus from "./components/ProcessingStatus";
@@ -35,17 +35,12 @@ const App = () => {
           progress: 10,
         }));
   
-        const formData = new FormData();
-        formData.append("file", file);
-  
-        const res = await axios.post("http://localhost:8000/upload", formData, {
-          onUploadProgress: (progressEvent) => {
-            const percentCompleted = Math.round(
-              (progressEvent.loaded * 40) / progressEvent.total
-            );
+        // Chunked and resumable: an interrupted upload picks up where it stopped
+        const res = await resumableUpload(file, {
+          onProgress: (fraction) => {
             setProcessingStatus(prev => ({
               ...prev,
-              progress: 10 + percentCompleted,
+              progress: 10 + Math.round(fraction * 40),
             }));
           },
         });
@@ -98,10 +93,17 @@ const App = () => {
                 timestamp: new Date().toLocaleString(),
                 videoUrl: data.enhanced_video_url,
                 metadata: data.metadata,
+                thumbnails: data.thumbnails,
               }, ...prev].slice(0, 10));
               
               ws.close();
               resolve();
+            } else if (data.type === "failed") {
+              clearTimeout(wsTimeout);
+              setError(data.error || "Processing failed");
+              setProcessingStatus(prev => ({ ...prev, processing: false }));
+              ws.close();
+              reject(new Error(data.error || "Processing failed"));
             } else if (data.status) {
               // Update processing status
               setProcessingStatus(prev => ({
@@ -129,7 +131,10 @@ const App = () => {
         };
       } catch (error) {
         console.error("Error uploading video:", error);
-        setError(error.message || "Error uploading video");
+        // 429/503 from admission control carry a reason and Retry-After
+        const retryAfter = error.response?.headers?.["retry-after"];
+        const reason = error.response?.data?.error || error.message || "Error uploading video";
+        setError(retryAfter ? `${reason} (retry in ${retryAfter}s)` : reason);
         setProcessingStatus(prev => ({
           ...prev,
           uploading: false,
@@ -22,6 +22,18 @@ const UploadHistory = ({ history, onSelect }) => {
               onClick={() => onSelect(item)}
             >
               <div className="flex items-start justify-between">
+                {item.thumbnails && (
+                  // First tile of the sprite sheet as a preview
+                  <div
+                    className="flex-shrink-0 mr-3 rounded border border-white/10"
+                    style={{
+                      width: item.thumbnails.width,
+                      height: item.thumbnails.height,
+                      backgroundImage: `url(${item.thumbnails.sprite_url})`,
+                      backgroundPosition: "0 0",
+                    }}
+                  />
+                )}
                 <div className="flex-1 min-w-0">
                   <p className="text-white font-semibold truncate group-hover:text-cyan-300 transition">
                     {item.filename}
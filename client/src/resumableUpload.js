@@ -0,0 +1,85 @@
+import axios from "axios";
+
+const API_URL = "http://localhost:8000";
+const PARALLEL_CHUNKS = 4;
+const CHUNK_RETRIES = 3;
+
+// Uploads are resumed across page reloads by remembering the session per file
+const sessionKey = (file) => `upload:${file.name}:${file.size}:${file.lastModified}`;
+
+const sha256Hex = async (blob) => {
+  const digest = await crypto.subtle.digest("SHA-256", await blob.arrayBuffer());
+  return Array.from(new Uint8Array(digest))
+    .map((b) => b.toString(16).padStart(2, "0"))
+    .join("");
+};
+
+const openSession = async (file, options) => {
+  const saved = localStorage.getItem(sessionKey(file));
+  if (saved) {
+    try {
+      const res = await axios.get(`${API_URL}/uploads/${saved}`);
+      return res.data;
+    } catch (err) {
+      // Expired or already finalized: start over
+      localStorage.removeItem(sessionKey(file));
+    }
+  }
+  const res = await axios.post(`${API_URL}/uploads`, {
+    filename: file.name,
+    size: file.size,
+    ...options,
+  });
+  localStorage.setItem(sessionKey(file), res.data.upload_id);
+  return { ...res.data, received_chunks: [] };
+};
+
+const putChunk = async (file, session, index) => {
+  const start = index * session.chunk_size;
+  const chunk = file.slice(start, Math.min(file.size, start + session.chunk_size));
+  const checksum = await sha256Hex(chunk);
+  for (let attempt = 1; ; attempt++) {
+    try {
+      await axios.put(`${API_URL}/uploads/${session.upload_id}/chunks/${index}`, chunk, {
+        headers: { "Content-Type": "application/octet-stream", "X-Chunk-SHA256": checksum },
+      });
+      return chunk.size;
+    } catch (err) {
+      const status = err.response?.status;
+      // 4xx other than a checksum mismatch will not get better on retry
+      if (attempt >= CHUNK_RETRIES || (status && status < 500 && status !== 422)) {
+        throw err;
+      }
+      await new Promise((r) => setTimeout(r, 500 * 2 ** attempt));
+    }
+  }
+};
+
+/**
+ * Upload ``file`` in parallel chunks through /uploads, skipping chunks the
+ * server already has, and finalize it. Resolves with the same response as
+ * POST /upload. ``onProgress`` receives the fraction of bytes received.
+ */
+export const resumableUpload = async (file, { onProgress, ...options } = {}) => {
+  const session = await openSession(file, options);
+  const received = new Set(session.received_chunks);
+  const pending = [];
+  for (let i = 0; i < session.chunk_count; i++) {
+    if (!received.has(i)) pending.push(i);
+  }
+
+  let sent = session.received_bytes || 0;
+  onProgress?.(file.size ? sent / file.size : 1);
+  const worker = async () => {
+    while (pending.length) {
+      const index = pending.shift();
+      sent += await putChunk(file, session, index);
+      onProgress?.(sent / file.size);
+    }
+  };
+  await Promise.all(Array.from({ length: PARALLEL_CHUNKS }, worker));
+
+  const res = await axios.post(`${API_URL}/uploads/${session.upload_id}/finalize`);
+  localStorage.removeItem(sessionKey(file));
+  return res;
+};
@@ -0,0 +1,219 @@
+"""
+Admission control and backpressure for /upload.
+
+Before an upload body is read, ``AdmissionController.check`` decides whether
+to take it:
+
+* a per-client token bucket (RATE_LIMIT_PER_MINUTE, off by default) answers
+  429 when a client uploads faster than its rate;
+* the pipeline backlog (jobs still processing, plus tasks waiting in the
+  broker's stage queues, read with a passive declare, plus stages held by
+  the scheduler) and the free space under the storage directory, net of
+  uploads already being received, answer 503 when over their limits.
+
+Rejections carry a ``Retry-After`` computed from the token refill time or
+from the recent job completion rate. Every decision is counted per reason.
+"""
+
+import math
+import os
+import shutil
+import time
+from collections import deque
+
+
+# 0 disables a limit
+ADMIT_MAX_INFLIGHT = int(os.environ.get("ADMIT_MAX_INFLIGHT", "200"))
+ADMIT_MAX_QUEUE_DEPTH = int(os.environ.get("ADMIT_MAX_QUEUE_DEPTH", "100"))
+ADMIT_MIN_FREE_BYTES = int(os.environ.get("ADMIT_MIN_FREE_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Broker queue depths are re-read at most this often
+ADMIT_DEPTH_TTL = float(os.environ.get("ADMIT_DEPTH_TTL", "1.0"))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "0"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "5"))
+
+# Retry-After bounds, and the fallback when no completion rate is known yet
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 600
+DEFAULT_RETRY_AFTER = 30
+# Completions remembered for the drain-rate estimate
+COMPLETION_WINDOW_SECONDS = 300
+# Idle token buckets are dropped after this long
+BUCKET_IDLE_SECONDS = 3600
+
+ADMITTED = "admitted"
+RATE_LIMITED = "rate_limited"
+TOO_MANY_INFLIGHT = "too_many_inflight"
+QUEUE_TOO_DEEP = "queue_too_deep"
+DISK_LOW = "disk_low"
+
+
+class Admission:
+    """Outcome of an admission check."""
+
+    def __init__(self, reason=ADMITTED, status_code=200, retry_after=None, message=None):
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.message = message
+
+    @property
+    def allowed(self):
+        return self.reason == ADMITTED
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second up to ``burst``."""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """Take a token; returns 0 on success, else the seconds until one is available."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def _clamp_retry(seconds):
+    return int(min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(seconds))))
+
+
+class AdmissionController:
+    """
+    ``inflight()`` returns the number of jobs still processing, ``queue_depth()``
+    (a coroutine) the tasks waiting for workers, and ``storage_dir`` is checked
+    for free space.
+    """
+
+    def __init__(self, storage_dir, inflight, queue_depth,
+                 max_inflight=ADMIT_MAX_INFLIGHT, max_queue_depth=ADMIT_MAX_QUEUE_DEPTH,
+                 min_free_bytes=ADMIT_MIN_FREE_BYTES, rate_per_minute=RATE_LIMIT_PER_MINUTE,
+                 burst=RATE_LIMIT_BURST, depth_ttl=ADMIT_DEPTH_TTL):
+        self.storage_dir = storage_dir
+        self.inflight = inflight
+        self.queue_depth = queue_depth
+        self.max_inflight = max_inflight
+        self.max_queue_depth = max_queue_depth
+        self.min_free_bytes = min_free_bytes
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self.depth_ttl = depth_ttl
+        self.buckets = {}
+        self.reserved_bytes = 0
+        self.decisions = {reason: 0 for reason in (ADMITTED, RATE_LIMITED, TOO_MANY_INFLIGHT, QUEUE_TOO_DEEP, DISK_LOW)}
+        self._completions = deque()
+        self._depth = None
+        self._depth_read_at = None
+
+    def record_completion(self, now=None):
+        """A job finished; feeds the drain-rate estimate behind Retry-After."""
+        now = time.monotonic() if now is None else now
+        self._completions.append(now)
+        self._trim_completions(now)
+
+    def _trim_completions(self, now):
+        while self._completions and self._completions[0] < now - COMPLETION_WINDOW_SECONDS:
+            self._completions.popleft()
+
+    def drain_rate(self, now=None):
+        """Jobs completed per second over the recent window, or None if unknown."""
+        now = time.monotonic() if now is None else now
+        self._trim_completions(now)
+        if len(self._completions) < 2:
+            return None
+        span = now - self._completions[0]
+        return len(self._completions) / span if span > 0 else None
+
+    def _retry_for_backlog(self, excess):
+        rate = self.drain_rate()
+        if rate is None:
+            return DEFAULT_RETRY_AFTER
+        return _clamp_retry(excess / rate)
+
+    async def _current_depth(self):
+        now = time.monotonic()
+        if self._depth_read_at is None or now - self._depth_read_at >= self.depth_ttl:
+            try:
+                self._depth = await self.queue_depth()
+            except Exception as e:
+                print(f"[ADMISSION] Could not read queue depth: {e}")
+                self._depth = None
+            self._depth_read_at = now
+        return self._depth
+
+    def _rate_limit(self, client):
+        if self.rate <= 0:
+            return None
+        now = time.monotonic()
+        if len(self.buckets) > 1000:
+            for key in [k for k, b in self.buckets.items() if now - b.updated > BUCKET_IDLE_SECONDS]:
+                del self.buckets[key]
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst, now)
+        wait = bucket.take(now)
+        if wait:
+            return Admission(RATE_LIMITED, 429, _clamp_retry(wait), "Too many uploads, slow down")
+        return None
+
+    async def check(self, client, incoming_bytes=0):
+        """Decide whether to accept an upload of about ``incoming_bytes`` from ``client``."""
+        decision = self._rate_limit(client) or await self._check_capacity(incoming_bytes) or Admission()
+        self.decisions[decision.reason] += 1
+        return decision
+
+    async def _check_capacity(self, incoming_bytes):
+        if self.min_free_bytes:
+            free = shutil.disk_usage(self.storage_dir).free - self.reserved_bytes - incoming_bytes
+            if free < self.min_free_bytes:
+                # Space comes back as the result cache evicts and jobs are cleaned up; no rate to go by
+                return Admission(DISK_LOW, 503, DEFAULT_RETRY_AFTER * 2, "Storage is nearly full, please retry later")
+
+        if self.max_inflight:
+            inflight = self.inflight()
+            if inflight >= self.max_inflight:
+                return Admission(TOO_MANY_INFLIGHT, 503, self._retry_for_backlog(inflight - self.max_inflight + 1),
+                                 "Too many videos processing, please retry later")
+
+        if self.max_queue_depth:
+            depth = await self._current_depth()
+            if depth is not None and depth >= self.max_queue_depth:
+                return Admission(QUEUE_TOO_DEEP, 503, self._retry_for_backlog(depth - self.max_queue_depth + 1),
+                                 "Processing queue is full, please retry later")
+        return None
+
+    def reserve(self, nbytes):
+        """Count an upload being received against free space until ``release``."""
+        self.reserved_bytes += nbytes
+
+    def release(self, nbytes):
+        self.reserved_bytes = max(0, self.reserved_bytes - nbytes)
+
+    def stats(self):
+        rate = self.drain_rate()
+        return {
+            "decisions": dict(self.decisions),
+            "inflight": self.inflight(),
+            "max_inflight": self.max_inflight,
+            "queue_depth": self._depth,
+            "max_queue_depth": self.max_queue_depth,
+            "free_bytes": shutil.disk_usage(self.storage_dir).free,
+            "reserved_bytes": self.reserved_bytes,
+            "min_free_bytes": self.min_free_bytes,
+            "drain_rate_per_minute": round(rate * 60, 3) if rate else None,
+            "rate_limit_per_minute": round(self.rate * 60, 3),
+            "tracked_clients": len(self.buckets),
+        }
@@ -0,0 +1,243 @@
+"""
+Byte-range file responses for the video endpoints.
+
+Supports single, suffix (``bytes=-N``) and multiple ranges (as
+``multipart/byteranges``), strong ETag / Last-Modified validators with
+If-None-Match, If-Modified-Since and If-Range, and HEAD. File bodies go out
+through the server's zero-copy ``http.response.zerocopysend`` extension (or
+``pathsend`` for whole files) when it offers one; otherwise they are read
+with ``os.pread`` on a worker thread in large chunks, without an async file
+wrapper or per-chunk seeks.
+"""
+
+import os
+import stat
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from starlette.responses import Response
+
+
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(1024 * 1024)))
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+# Finished outputs are replaced atomically and never change once they exist
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def file_etag(st):
+    """Strong validator from size and modification time."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def parse_range_header(header, size):
+    """
+    Parse a ``Range`` header against a file of ``size`` bytes.
+
+    Returns a sorted list of merged, inclusive ``(start, end)`` ranges; an
+    empty list if the header is valid but no range is satisfiable; or None if
+    the header should be ignored (not bytes, malformed, or too many ranges).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    parts = [part.strip() for part in spec.split(",") if part.strip()]
+    if not parts or len(parts) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in parts:
+        first, dash, last = part.partition("-")
+        if not dash:
+            return None
+        try:
+            if not first:
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length == 0:
+                    continue
+                start, end = max(0, size - length), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else start
+                if start < 0 or end < start:
+                    return None
+                end = size - 1 if not last else min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _etag_matches(header, etag, weak=True):
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _not_modified_since(header, st):
+    try:
+        return int(st.st_mtime) <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def _if_range_allows(header, etag, last_modified):
+    header = header.strip()
+    if header.startswith('"') or header.startswith("W/"):
+        # If-Range requires a strong comparison
+        return header == etag
+    return header == last_modified
+
+
+class RangeFileResponse(Response):
+    """Serve a file honouring Range and conditional request headers."""
+
+    def __init__(self, path, request, media_type="application/octet-stream", immutable=False, headers=None):
+        self.path = path
+        self.media_type = media_type
+        self.background = None
+        self.send_header_only = request.method == "HEAD"
+
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise FileNotFoundError(path)
+        self.file_size = size = st.st_size
+        etag = file_etag(st)
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+
+        base = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": last_modified,
+            "cache-control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+        }
+        base.update(headers or {})
+        request_headers = request.headers
+
+        self.ranges = None
+        self.boundary = None
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            not_modified = _etag_matches(if_none_match, etag)
+        else:
+            not_modified = _not_modified_since(request_headers.get("if-modified-since"), st)
+
+        if not_modified:
+            self.status_code = 304
+            self.init_headers(base)
+            self.send_header_only = True
+            return
+
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        ranges = None
+        if range_header and (if_range is None or _if_range_allows(if_range, etag, last_modified)):
+            ranges = parse_range_header(range_header, size)
+
+        if ranges == []:
+            self.status_code = 416
+            base["content-range"] = f"bytes */{size}"
+            base["content-length"] = "0"
+            self.init_headers(base)
+            self.send_header_only = True
+            return
+
+        if not ranges or ranges == [(0, size - 1)]:
+            self.status_code = 200
+            base["content-length"] = str(size)
+            self.init_headers(base)
+            return
+
+        self.status_code = 206
+        self.ranges = ranges
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            base["content-range"] = f"bytes {start}-{end}/{size}"
+            base["content-length"] = str(end - start + 1)
+            self.init_headers(base)
+            return
+
+        self.boundary = uuid.uuid4().hex
+        self._part_headers = [
+            (
+                f"--{self.boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode("latin-1")
+            for start, end in ranges
+        ]
+        self._closing = f"--{self.boundary}--\r\n".encode("latin-1")
+        length = sum(len(h) + (end - start + 1) + 2 for h, (start, end) in zip(self._part_headers, ranges))
+        base["content-length"] = str(length + len(self._closing))
+        self.media_type = f"multipart/byteranges; boundary={self.boundary}"
+        self.init_headers(base)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if self.ranges is None and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+            return
+
+        zerocopy = "http.response.zerocopysend" in extensions
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if self.ranges is None:
+                await self._send_file_range(send, fd, 0, self.file_size, zerocopy, more=False)
+            elif self.boundary is None:
+                start, end = self.ranges[0]
+                await self._send_file_range(send, fd, start, end - start + 1, zerocopy, more=False)
+            else:
+                for part_header, (start, end) in zip(self._part_headers, self.ranges):
+                    await send({"type": "http.response.body", "body": part_header, "more_body": True})
+                    await self._send_file_range(send, fd, start, end - start + 1, zerocopy, more=True)
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+                await send({"type": "http.response.body", "body": self._closing, "more_body": False})
+        finally:
+            os.close(fd)
+
+    async def _send_file_range(self, send, fd, offset, count, zerocopy, more):
+        if zerocopy:
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": fd,
+                "offset": offset,
+                "count": count,
+                "more_body": more,
+            })
+            return
+        remaining = count
+        while remaining > 0:
+            chunk = await anyio.to_thread.run_sync(os.pread, fd, min(STREAM_CHUNK_SIZE, remaining), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            remaining -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more or remaining > 0})
+        if not more and (remaining > 0 or count == 0):
+            # Empty file, or it shrank underneath us: end the response rather than hang
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,76 @@
+"""
+Prometheus metrics for the API, exposed at ``/metrics``.
+
+prometheus_client is optional: without it every metric below is a no-op and
+``/metrics`` answers 503. Gauges that mirror existing state (active jobs,
+open WebSockets, scheduled stages) are read when scraped rather than kept
+up to date on every change. Each uvicorn worker process has its own
+registry, so scrape them individually (or run one worker per port).
+"""
+
+import logging
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+    logging.warning("prometheus_client not available - /metrics is disabled")
+
+
+SIZE_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(0, 13))  # 1 MiB .. 4 GiB
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class _NullMetric:
+    """Stands in for every metric when prometheus_client is missing."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set_function(self, f):
+        pass
+
+
+def _histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    if not PROMETHEUS_AVAILABLE:
+        return _NullMetric()
+    return Histogram(name, documentation, labels, buckets=buckets)
+
+
+def _counter(name, documentation, labels=()):
+    return Counter(name, documentation, labels) if PROMETHEUS_AVAILABLE else _NullMetric()
+
+
+def _gauge(name, documentation):
+    return Gauge(name, documentation) if PROMETHEUS_AVAILABLE else _NullMetric()
+
+
+UPLOAD_BYTES = _histogram("video_upload_bytes", "Size of completed uploads", ["mode"], SIZE_BUCKETS)
+UPLOAD_SECONDS = _histogram("video_upload_seconds",
+                            "Time to receive an upload (multipart) or from session creation to finalize (chunked)",
+                            ["mode"], LATENCY_BUCKETS + (1800, 3600))
+PUBLISH_SECONDS = _histogram("video_publish_seconds", "Time to publish a stage task and get the broker's confirm",
+                             ["stage"])
+SCHEDULE_WAIT_SECONDS = _histogram("video_schedule_wait_seconds",
+                                   "Time a scheduled stage was held by the API before being published",
+                                   ["stage"], WAIT_BUCKETS)
+STAGE_RESULTS = _counter("video_stage_results", "Stage results applied, by outcome", ["stage", "outcome"])
+STREAM_BYTES = _histogram("video_stream_response_bytes", "Body size of /stream responses", ["status"],
+                          (64 * 1024, 256 * 1024) + SIZE_BUCKETS)
+ACTIVE_JOBS = _gauge("video_jobs_active", "Jobs still processing")
+WEBSOCKETS = _gauge("video_websockets_connected", "Open WebSocket connections in this process")
+SCHEDULED_STAGES = _gauge("video_scheduled_stages", "Stage tasks held by the scheduler in this process")
+
+
+def render():
+    """(body, content type) for a scrape."""
+    return generate_latest(), CONTENT_TYPE_LATEST
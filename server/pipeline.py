@@ -0,0 +1,161 @@
+"""
+Declarative stage DAG for the processing pipeline.
+
+Each stage names the stages it runs ``after``, static ``params`` merged into
+its task message, the upload fields it takes (``job_params``), whether it
+is ``optional`` (its result or failure never holds up job completion) and
+whether it is ``scheduled`` (released by the fair scheduler rather than
+published as soon as it is ready). The
+API tracks every job against the DAG: a stage is dispatched to its own queue
+once everything it depends on has finished, with those results attached as
+``upstream``, and a job is complete when all required stages are done.
+
+The default DAG can be replaced without code changes by setting
+PIPELINE_SPEC to a JSON list in the same format.
+"""
+
+import json
+import os
+
+
+STAGE_QUEUE_PREFIX = "video_tasks"
+
+DEFAULT_PIPELINE = [
+    {"stage": "metadata"},
+    {"stage": "enhancement", "after": ["metadata"], "job_params": ["filters", "target_fps", "hls"],
+     "scheduled": True},
+    {"stage": "thumbnails", "after": ["enhancement"], "optional": True},
+]
+
+
+class PipelineError(ValueError):
+    """The stage DAG is malformed."""
+
+
+class Stage:
+    def __init__(self, name, after=(), params=None, job_params=(), optional=False, queue=None,
+                 scheduled=False):
+        self.name = name
+        self.after = list(after)
+        self.params = dict(params or {})
+        self.job_params = list(job_params)
+        self.optional = optional
+        self.queue = queue or f"{STAGE_QUEUE_PREFIX}.{name}"
+        self.scheduled = scheduled
+
+
+class Pipeline:
+    """A validated stage DAG plus the per-job bookkeeping built on it."""
+
+    def __init__(self, spec):
+        self.stages = {}
+        for entry in spec:
+            try:
+                stage = Stage(
+                    entry["stage"], entry.get("after", ()), entry.get("params"),
+                    entry.get("job_params", ()), entry.get("optional", False), entry.get("queue"),
+                    entry.get("scheduled", False),
+                )
+            except (KeyError, TypeError) as e:
+                raise PipelineError(f"Invalid stage entry {entry!r}: {e}") from e
+            if stage.name in self.stages:
+                raise PipelineError(f"Duplicate stage: {stage.name}")
+            self.stages[stage.name] = stage
+        if not self.stages:
+            raise PipelineError("Pipeline has no stages")
+        for stage in self.stages.values():
+            for dependency in stage.after:
+                if dependency not in self.stages:
+                    raise PipelineError(f"{stage.name} runs after unknown stage {dependency}")
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise PipelineError(f"Pipeline has a cycle through {name}")
+            visiting.add(name)
+            for dependency in self.stages[name].after:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    @property
+    def job_param_names(self):
+        return {name for stage in self.stages.values() for name in stage.job_params}
+
+    def new_job(self, task, job_params=None):
+        """Pipeline bookkeeping for a fresh job; merged into its state."""
+        return {
+            "status": {name: False for name in self.order},
+            "task": task,
+            "job_params": dict(job_params or {}),
+            "results": {},
+            "dispatched": [],
+            "complete": False,
+        }
+
+    def claim_ready(self, state):
+        """
+        Mark the stages whose dependencies have all finished as dispatched and
+        return their names. Call inside a store update so a stage is claimed once.
+        """
+        if state.get("error"):
+            return []
+        ready = []
+        for name in self.order:
+            if name in state["dispatched"]:
+                continue
+            if all(state["status"].get(dependency) for dependency in self.stages[name].after):
+                ready.append(name)
+        state["dispatched"].extend(ready)
+        return ready
+
+    def record(self, state, stage, result):
+        """Store a stage's result; a failed required stage fails the job."""
+        payload = {k: v for k, v in result.items() if k not in ("video_id", "stage")}
+        state["results"][stage] = payload
+        state["status"][stage] = True
+        if result.get("error") and not self.stages[stage].optional:
+            state["error"] = result["error"]
+        if stage not in state["dispatched"]:
+            state["dispatched"].append(stage)
+        state["complete"] = self.is_complete(state)
+
+    def is_complete(self, state):
+        """True once every required stage has finished (or the job has failed)."""
+        status = state.get("status", {})
+        return all(status.get(name) for name, stage in self.stages.items() if not stage.optional)
+
+    def task_message(self, state, stage):
+        """Message for one stage: the job's task, its parameters and all finished upstream results."""
+        spec = self.stages[stage]
+        message = dict(state["task"])
+        message.update(spec.params)
+        for name in spec.job_params:
+            if state["job_params"].get(name) is not None:
+                message[name] = state["job_params"][name]
+        message["stage"] = stage
+        message["upstream"] = {
+            name: state["results"][name] for name in self.order if name in state["results"]
+        }
+        return message
+
+
+def load_pipeline(spec=None):
+    """The DAG from PIPELINE_SPEC (a JSON list) or the default one."""
+    if spec is None:
+        raw = os.environ.get("PIPELINE_SPEC")
+        try:
+            spec = json.loads(raw) if raw else DEFAULT_PIPELINE
+        except ValueError as e:
+            raise PipelineError(f"PIPELINE_SPEC is not valid JSON: {e}") from e
+    return Pipeline(spec)
@@ -0,0 +1,189 @@
+"""
+Long-lived RabbitMQ publisher for pipeline tasks.
+
+Tasks go to one exchange, by default the broker's default exchange with each
+stage's queue name as the routing key; a task no queue accepts is returned
+by the broker and raised as a PublishError rather than silently dropped.
+
+One robust connection is opened for the lifetime of the app and publishes go
+through a small pool of confirm-mode channels, so an upload costs a single
+publish + broker ack instead of a connect/declare/close round-trip sequence.
+With a non-zero batch window, publishes arriving close together are sent
+back-to-back on one channel and their confirms awaited together.
+"""
+
+import asyncio
+import json
+import os
+
+import aio_pika
+from aio_pika.pool import Pool
+
+
+PUBLISH_CHANNELS = int(os.environ.get("RABBITMQ_PUBLISH_CHANNELS", "4"))
+# 0 disables micro-batching: every publish awaits its own confirm
+PUBLISH_BATCH_WINDOW_MS = float(os.environ.get("PUBLISH_BATCH_WINDOW_MS", "0"))
+PUBLISH_BATCH_MAX = int(os.environ.get("PUBLISH_BATCH_MAX", "64"))
+PUBLISH_TIMEOUT = float(os.environ.get("PUBLISH_TIMEOUT", "5"))
+
+
+class PublishError(Exception):
+    """The broker did not confirm a publish."""
+
+
+class TaskPublisher:
+    """Pooled, confirm-mode publisher bound to one exchange ("" for the default exchange)."""
+
+    def __init__(self, url, exchange_name="", exchange_type=aio_pika.ExchangeType.FANOUT,
+                 pool_size=PUBLISH_CHANNELS, batch_window_ms=PUBLISH_BATCH_WINDOW_MS,
+                 batch_max=PUBLISH_BATCH_MAX, timeout=PUBLISH_TIMEOUT):
+        self.url = url
+        self.exchange_name = exchange_name
+        self.exchange_type = exchange_type
+        self.pool_size = pool_size
+        self.batch_window = batch_window_ms / 1000.0
+        self.batch_max = batch_max
+        self.timeout = timeout
+        self.connection = None
+        self.channel_pool = None
+        self._exchanges = {}
+        self._inspect_channel = None
+        self._inspect_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+        self._batch_queue = None
+        self._batch_task = None
+
+    async def start(self):
+        """Connect eagerly; a broker that is down now is retried on first publish."""
+        try:
+            await self._ensure_connected()
+            print(f"[PUBLISHER] Connected to RabbitMQ ({self.pool_size} channels)")
+        except Exception as e:
+            print(f"[PUBLISHER] RabbitMQ unavailable at startup, will retry on publish: {e}")
+        if self.batch_window > 0:
+            self._batch_queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._batch_loop())
+
+    async def close(self):
+        if self._batch_task is not None:
+            self._batch_task.cancel()
+            try:
+                await self._batch_task
+            except asyncio.CancelledError:
+                pass
+            self._batch_task = None
+        if self._inspect_channel is not None and not self._inspect_channel.is_closed:
+            await self._inspect_channel.close()
+        self._inspect_channel = None
+        if self.channel_pool is not None:
+            await self.channel_pool.close()
+            self.channel_pool = None
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+        self._exchanges.clear()
+
+    async def _ensure_connected(self):
+        if self.channel_pool is not None:
+            return
+        async with self._connect_lock:
+            if self.channel_pool is not None:
+                return
+            self.connection = await aio_pika.connect_robust(self.url)
+            self.channel_pool = Pool(self._open_channel, max_size=self.pool_size)
+
+    async def _open_channel(self):
+        # Unroutable (returned) messages fail the publish instead of vanishing
+        channel = await self.connection.channel(publisher_confirms=True, on_return_raises=True)
+        if not self.exchange_name:
+            self._exchanges[channel] = channel.default_exchange
+        else:
+            # Declared once per pooled channel rather than once per message
+            self._exchanges[channel] = await channel.declare_exchange(self.exchange_name, self.exchange_type)
+        return channel
+
+    @staticmethod
+    def _message(payload, headers=None):
+        return aio_pika.Message(
+            body=json.dumps(payload).encode(),
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            headers=headers or {},
+        )
+
+    async def _publish_now(self, messages):
+        """Publish (message, routing_key) pairs back-to-back on one channel and await all confirms."""
+        await self._ensure_connected()
+        async with self.channel_pool.acquire() as channel:
+            exchange = self._exchanges[channel]
+            results = await asyncio.gather(
+                *(exchange.publish(m, routing_key=key, timeout=self.timeout) for m, key in messages),
+                return_exceptions=True,
+            )
+        return results
+
+    async def publish(self, payload, headers=None, routing_key=""):
+        """Publish one task and return once the broker has confirmed it; raises PublishError."""
+        message = self._message(payload, headers)
+        try:
+            if self._batch_queue is not None:
+                future = asyncio.get_running_loop().create_future()
+                await self._batch_queue.put((message, routing_key, future))
+                await future
+            else:
+                (result,) = await self._publish_now([(message, routing_key)])
+                if isinstance(result, BaseException):
+                    raise result
+        except PublishError:
+            raise
+        except Exception as e:
+            raise PublishError(f"RabbitMQ publish failed: {e}") from e
+
+    async def queue_depth(self, queue_name):
+        """
+        Ready (not yet delivered) messages in a queue, from a passive declare,
+        or None if the queue does not exist or could not be inspected.
+        """
+        await self._ensure_connected()
+        # A passive declare of a missing queue closes its channel, so checks get a
+        # channel of their own and run one at a time: a check in flight on a channel
+        # another one just lost would fail for a queue that is there
+        async with self._inspect_lock:
+            try:
+                if self._inspect_channel is None or self._inspect_channel.is_closed:
+                    self._inspect_channel = await self.connection.channel(publisher_confirms=False)
+                queue = await self._inspect_channel.declare_queue(queue_name, passive=True)
+            except aio_pika.exceptions.ChannelNotFoundEntity:
+                self._inspect_channel = None
+                return None
+            except (aio_pika.exceptions.AMQPError, aio_pika.exceptions.ChannelInvalidStateError) as e:
+                print(f"[PUBLISHER] Could not read the depth of {queue_name}: {e!r}")
+                self._inspect_channel = None
+                return None
+        return queue.declaration_result.message_count
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._batch_queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_max:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._batch_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await self._publish_now([(message, key) for message, key, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(PublishError(f"RabbitMQ publish failed: {result}"))
+                else:
+                    future.set_result(result)
@@ -0,0 +1,185 @@
+"""
+Content-addressed cache of finished pipeline results.
+
+Entries are keyed by the upload's content hash plus the enhancement
+parameters, so re-uploading the same clip with the same settings can reuse
+the existing ``_enhanced.mp4``, metadata and preview thumbnails instead of
+reprocessing it. Thumbnails are added to an entry when the optional
+thumbnails stage finishes, after the entry was created. The
+index is persisted next to the videos and evicted least-recently-used once
+the enhanced outputs exceed a disk budget.
+
+Several API processes (uvicorn ``--workers``) share the index file: every
+change is made under an exclusive lock on it, against the index as last
+saved by any of them. Outputs that a job state still points at are never
+evicted, since the job's ``/static`` and HLS URLs would stop working.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: the index is then safe for one process only
+    fcntl = None
+
+
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+RESULT_CACHE_INDEX = ".result_cache.json"
+
+
+def cache_key(content_hash, params):
+    """Stable key for a content hash and the enhancement parameters that shaped the output."""
+    canonical = json.dumps(params or {}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{content_hash}:{canonical}".encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU index of enhanced outputs, bounded by the total size of those files.
+    ``referenced()``, if given, returns the enhanced filenames that job
+    states still point at; those entries are kept even over the budget.
+    """
+
+    def __init__(self, storage_dir, max_bytes=RESULT_CACHE_MAX_BYTES, index_name=RESULT_CACHE_INDEX,
+                 referenced=None):
+        self.storage_dir = storage_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(storage_dir, index_name)
+        self.referenced = referenced
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load()
+
+    @property
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    @contextmanager
+    def _locked(self):
+        """Hold the index lock, with the entries re-read from the shared index file."""
+        if fcntl is None:
+            yield
+            return
+        with open(self.index_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._load()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.entries = OrderedDict()
+        for entry in sorted(stored.values(), key=lambda e: e.get("last_access", 0)):
+            if os.path.exists(os.path.join(self.storage_dir, entry["enhanced_filename"])):
+                self.entries[entry["key"]] = entry
+
+    def _save(self):
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def get(self, key):
+        """Return the cached result for key (refreshing its LRU position), or None."""
+        with self._locked():
+            entry = self.entries.get(key)
+            if entry is not None and not os.path.exists(os.path.join(self.storage_dir, entry["enhanced_filename"])):
+                # Output was removed behind our back; forget it
+                del self.entries[key]
+                self._save()
+                entry = None
+            if entry is not None and entry.get("thumbnails") and not all(
+                    os.path.exists(os.path.join(self.storage_dir, entry["thumbnails"][name])) for name in ("sprite", "vtt")):
+                # Previews are gone; the thumbnails stage will make them again
+                del entry["thumbnails"]
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["last_access"] = time.time()
+            self.entries.move_to_end(key)
+            self._save()
+            return entry
+
+    def put(self, key, enhanced_filename, enhancement_metadata, metadata):
+        """Record a finished result and evict older ones beyond the disk budget."""
+        path = os.path.join(self.storage_dir, enhanced_filename)
+        if not os.path.exists(path):
+            return
+        with self._locked():
+            self.entries[key] = {
+                "key": key,
+                "enhanced_filename": enhanced_filename,
+                "enhancement_metadata": enhancement_metadata,
+                "metadata": metadata,
+                "size": os.path.getsize(path),
+                "last_access": time.time(),
+            }
+            self.entries.move_to_end(key)
+            self._evict()
+            self._save()
+
+    def add_thumbnails(self, key, thumbnails):
+        """Attach the thumbnails stage's result (sprite, vtt, tile geometry) to an entry."""
+        with self._locked():
+            entry = self.entries.get(key)
+            if entry is None or entry.get("thumbnails") == thumbnails:
+                return
+            entry["thumbnails"] = thumbnails
+            self._save()
+
+    def _evict(self):
+        total = self.total_bytes
+        if total <= self.max_bytes:
+            return
+        referenced = self.referenced() if self.referenced else set()
+        # Oldest first, always keeping the newest entry
+        for key in list(self.entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            entry = self.entries[key]
+            if entry["enhanced_filename"] in referenced:
+                continue
+            del self.entries[key]
+            total -= entry["size"]
+            self.evictions += 1
+            path = os.path.join(self.storage_dir, entry["enhanced_filename"])
+            if os.path.exists(path):
+                os.remove(path)
+            hls = (entry.get("enhancement_metadata") or {}).get("hls")
+            if hls:
+                shutil.rmtree(os.path.join(self.storage_dir, os.path.dirname(hls["playlist"])), ignore_errors=True)
+            thumbnails = entry.get("thumbnails") or {}
+            for name in ("sprite", "vtt"):
+                if thumbnails.get(name) and os.path.exists(os.path.join(self.storage_dir, thumbnails[name])):
+                    os.remove(os.path.join(self.storage_dir, thumbnails[name]))
+            print(f"[CACHE] Evicted {entry['enhanced_filename']} ({entry['size']} bytes)")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._locked():
+            # Entries as saved by every process; hits and misses are this process's
+            pass
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
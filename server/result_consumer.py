@@ -0,0 +1,203 @@
+"""
+Consumer for worker results published to the ``video_results`` exchange.
+
+Results are pulled from a durable queue, grouped into small batches and handed
+to an ``apply_batch`` coroutine; messages are acked only after their batch has
+been applied, so a crash of the API process just means redelivery.
+``apply_batch`` applies each result on its own and returns those that failed.
+Only those are retried, after a backoff, by republishing them with an attempt
+count in ``x-result-attempts``. The results queue is a classic queue with no
+delivery count of its own. After RESULT_MAX_ATTEMPTS a result is parked in
+``video_results.dead``.
+
+Progress events from ``video_progress`` are transient: every API process
+listens on its own exclusive queue (its WebSockets are its own) and drops
+whatever arrives while it is not connected.
+"""
+
+import asyncio
+import json
+import os
+
+import aio_pika
+
+
+RESULTS_EXCHANGE = "video_results"
+RESULTS_QUEUE = "video_results.api"
+DEAD_RESULTS_QUEUE = "video_results.dead"
+PROGRESS_EXCHANGE = "video_progress"
+RESULT_BATCH_MAX = int(os.environ.get("RESULT_BATCH_MAX", "100"))
+RESULT_BATCH_WINDOW_MS = float(os.environ.get("RESULT_BATCH_WINDOW_MS", "50"))
+RECONNECT_DELAY = 5
+# Attempts a result gets before it is parked, and the backoff between them
+RESULT_MAX_ATTEMPTS = int(os.environ.get("RESULT_MAX_ATTEMPTS", "5"))
+RESULT_RETRY_DELAY = float(os.environ.get("RESULT_RETRY_DELAY", "1"))
+RESULT_RETRY_DELAY_MAX = 60
+ATTEMPTS_HEADER = "x-result-attempts"
+
+
+async def connect_with_retry(url, label):
+    """Open a robust connection, retrying until the broker is reachable."""
+    # connect_robust only reconnects once it has connected the first time
+    while True:
+        try:
+            return await aio_pika.connect_robust(url)
+        except Exception as e:
+            print(f"[{label}] RabbitMQ unavailable, retrying in {RECONNECT_DELAY}s: {e}")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+class ResultConsumer:
+    """Background task that feeds batches of worker results to ``apply_batch``."""
+
+    def __init__(self, url, apply_batch, batch_max=RESULT_BATCH_MAX, batch_window_ms=RESULT_BATCH_WINDOW_MS):
+        self.url = url
+        self.apply_batch = apply_batch
+        self.batch_max = batch_max
+        self.batch_window = batch_window_ms / 1000.0
+        self.connection = None
+        self.channel = None
+        self._incoming = asyncio.Queue()
+        self._tasks = []
+        self._retries = set()
+
+    async def start(self):
+        self._tasks = [
+            asyncio.create_task(self._connect_loop()),
+            asyncio.create_task(self._batch_loop()),
+        ]
+
+    async def close(self):
+        # Pending retries are unacked, so the broker redelivers them
+        tasks = self._tasks + list(self._retries)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._retries = set()
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    async def _connect_loop(self):
+        self.connection = await connect_with_retry(self.url, "RESULTS")
+        channel = self.channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=self.batch_max * 2)
+        exchange = await channel.declare_exchange(RESULTS_EXCHANGE, aio_pika.ExchangeType.FANOUT, durable=True)
+        queue = await channel.declare_queue(RESULTS_QUEUE, durable=True)
+        await channel.declare_queue(DEAD_RESULTS_QUEUE, durable=True)
+        await queue.bind(exchange)
+        await queue.consume(self._incoming.put)
+        print(f"[RESULTS] Consuming worker results from {RESULTS_QUEUE}")
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._incoming.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_max:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._incoming.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            parsed = []
+            for message in batch:
+                try:
+                    parsed.append((message, json.loads(message.body)))
+                except ValueError:
+                    print(f"[RESULTS][ERROR] Dropping unparseable result: {message.body[:200]!r}")
+                    await message.ack()
+            try:
+                failed = await self.apply_batch([result for _, result in parsed]) or []
+            except Exception as e:
+                print(f"[RESULTS][ERROR] Failed to apply result batch: {e}")
+                failed = [result for _, result in parsed]
+            failed_ids = {id(result) for result in failed}
+            for message, result in parsed:
+                if id(result) in failed_ids:
+                    self._schedule_retry(message)
+                else:
+                    await message.ack()
+
+    def _schedule_retry(self, message):
+        task = asyncio.create_task(self._retry(message))
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    async def _retry(self, message):
+        """Republish a result that failed to apply after a backoff (or park it), then ack the original."""
+        attempts = int((message.headers or {}).get(ATTEMPTS_HEADER, 1))
+        try:
+            if attempts >= RESULT_MAX_ATTEMPTS:
+                print(f"[RESULTS][ERROR] Result failed {attempts} times, parking it in {DEAD_RESULTS_QUEUE}")
+                routing_key = DEAD_RESULTS_QUEUE
+            else:
+                delay = min(RESULT_RETRY_DELAY * 2 ** (attempts - 1), RESULT_RETRY_DELAY_MAX)
+                print(f"[RESULTS] Retrying result in {delay:g}s (attempt {attempts + 1}/{RESULT_MAX_ATTEMPTS})")
+                await asyncio.sleep(delay)
+                routing_key = RESULTS_QUEUE
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(
+                    message.body,
+                    content_type=message.content_type,
+                    headers={**(message.headers or {}), ATTEMPTS_HEADER: attempts + 1},
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=routing_key,
+            )
+            await message.ack()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Left unacked: the broker redelivers it when this channel goes away
+            print(f"[RESULTS][ERROR] Could not retry result: {e}")
+
+
+class ProgressListener:
+    """Background task that passes each progress event to ``on_event`` (a plain callable)."""
+
+    def __init__(self, url, on_event):
+        self.url = url
+        self.on_event = on_event
+        self.connection = None
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._connect())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+
+    async def _connect(self):
+        self.connection = await connect_with_retry(self.url, "PROGRESS")
+        channel = await self.connection.channel()
+        exchange = await channel.declare_exchange(PROGRESS_EXCHANGE, aio_pika.ExchangeType.FANOUT, durable=True)
+        # Server-named, exclusive: gone with this process, never backs up the broker
+        queue = await channel.declare_queue(exclusive=True, auto_delete=True, arguments={"x-max-length": 1000})
+        await queue.bind(exchange)
+        await queue.consume(self._on_message, no_ack=True)
+        print("[PROGRESS] Listening for worker progress")
+
+    async def _on_message(self, message):
+        try:
+            event = json.loads(message.body)
+        except ValueError:
+            return
+        self.on_event(event)
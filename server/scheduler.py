@@ -0,0 +1,230 @@
+"""
+Duration-aware, per-client fair scheduling for expensive pipeline stages.
+
+Stages marked ``scheduled`` in the DAG are not published as soon as they
+are ready. They wait here and are released to the broker only while the
+stage's queue holds fewer than SCHED_BROKER_BACKLOG ready tasks, so the
+order in which workers pick jobs up is decided here rather than by FIFO.
+
+Each job has a cost estimated from the metadata stage's result (duration ×
+resolution, in 1080p-seconds). Clients take turns by accumulated cost
+(start-time fair queueing): a client's virtual time grows by the cost of
+every job released for it, and the client with the lowest virtual time
+goes next. Within a client the cheapest job goes first, with its cost
+discounted the longer it has waited (SCHED_AGING_SECONDS) so long jobs are
+never starved. Jobs are grouped into classes by cost for reporting p50/p95
+queue wait and completion time.
+
+Queued entries live in this process's memory; each API process schedules
+the jobs it dispatched. With a shared state store, jobs left queued by a
+process that has exited are requeued by another (or its replacement), see
+``recover_scheduled`` in main.py.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+SCHED_BROKER_BACKLOG = int(os.environ.get("SCHED_BROKER_BACKLOG", "2"))
+SCHED_POLL_INTERVAL = float(os.environ.get("SCHED_POLL_INTERVAL", "0.5"))
+# A job that has waited this long competes at half its cost, a third after twice as long, ...
+SCHED_AGING_SECONDS = float(os.environ.get("SCHED_AGING_SECONDS", "300"))
+# Upper cost bounds (1080p-seconds) of the classes before "long"
+SCHED_CLASS_BOUNDS = [float(b) for b in os.environ.get("SCHED_CLASS_BOUNDS", "60,600").split(",") if b.strip()]
+SCHED_CLASS_NAMES = ["short", "medium", "long"]
+# Cost assumed when the metadata stage gave nothing usable
+DEFAULT_JOB_COST = float(os.environ.get("SCHED_DEFAULT_COST", "120"))
+# Completed jobs kept per class for the percentiles
+SCHED_SAMPLE_SIZE = 1000
+
+REFERENCE_PIXELS = 1920 * 1080
+
+
+def estimate_cost(metadata):
+    """Work estimate in 1080p-seconds from the metadata stage's result."""
+    metadata = metadata or {}
+    duration = metadata.get("duration") or 0
+    if not duration and metadata.get("fps"):
+        duration = (metadata.get("frame_count") or 0) / metadata["fps"]
+    pixels = (metadata.get("width") or 0) * (metadata.get("height") or 0)
+    if duration <= 0 or pixels <= 0:
+        return DEFAULT_JOB_COST
+    return round(duration * pixels / REFERENCE_PIXELS, 3)
+
+
+def cost_class(cost):
+    for name, bound in zip(SCHED_CLASS_NAMES, SCHED_CLASS_BOUNDS):
+        if cost <= bound:
+            return name
+    return SCHED_CLASS_NAMES[min(len(SCHED_CLASS_BOUNDS), len(SCHED_CLASS_NAMES) - 1)]
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a sequence of numbers."""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return round(ordered[rank], 3)
+
+
+class ScheduledJob:
+    def __init__(self, video_id, stage, client, cost):
+        self.video_id = video_id
+        self.stage = stage
+        self.client = client
+        self.cost = cost
+        self.job_class = cost_class(cost)
+        self.queued_at = time.monotonic()
+
+    def effective_cost(self, now):
+        return self.cost / (1 + (now - self.queued_at) / SCHED_AGING_SECONDS)
+
+
+class _ClientQueue:
+    def __init__(self):
+        self.jobs = []
+        self.vtime = 0.0
+
+
+class StageScheduler:
+    """
+    Holds scheduled stage tasks and releases them one at a time through
+    ``release(job)`` (a coroutine) while ``backlog(stage)`` (a coroutine
+    returning the broker's ready count, or None if unknown) is below the target.
+    """
+
+    def __init__(self, release, backlog, target_backlog=SCHED_BROKER_BACKLOG,
+                 poll_interval=SCHED_POLL_INTERVAL):
+        self.release = release
+        self.backlog = backlog
+        self.target_backlog = max(1, target_backlog)
+        self.poll_interval = poll_interval
+        self.clients = {}
+        self.vtime = 0.0
+        self._queued = {}
+        self._wakeup = None
+        self._task = None
+        self.waits = {name: deque(maxlen=SCHED_SAMPLE_SIZE) for name in SCHED_CLASS_NAMES}
+        self.completions = {name: deque(maxlen=SCHED_SAMPLE_SIZE) for name in SCHED_CLASS_NAMES}
+        self.released = {name: 0 for name in SCHED_CLASS_NAMES}
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def queued(self):
+        return len(self._queued)
+
+    def submit(self, job):
+        """Queue a job; it is released once the broker backlog has room and its turn comes."""
+        queue = self.clients.get(job.client)
+        if queue is None:
+            queue = self.clients[job.client] = _ClientQueue()
+        if not queue.jobs:
+            # A client returning from idle starts level with the others, not with banked credit
+            queue.vtime = max(queue.vtime, self.vtime)
+        queue.jobs.append(job)
+        self._queued[job.video_id] = job
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _next(self, room):
+        """Pop the next job among stages with ``room`` left, or None."""
+        best = None
+        for client, queue in self.clients.items():
+            eligible = [job for job in queue.jobs if room.get(job.stage, 0) > 0]
+            if eligible and (best is None or queue.vtime < best[0]):
+                best = (queue.vtime, client, eligible)
+        if best is None:
+            return None
+        start_tag, client, eligible = best
+        now = time.monotonic()
+        job = min(eligible, key=lambda j: (j.effective_cost(now), j.queued_at))
+
+        queue = self.clients[client]
+        queue.jobs.remove(job)
+        queue.vtime += job.cost
+        self.vtime = max(self.vtime, start_tag)
+        # Idle clients that are not ahead of the others have nothing left to remember
+        for idle in [c for c, q in self.clients.items() if not q.jobs and q.vtime <= self.vtime]:
+            del self.clients[idle]
+
+        del self._queued[job.video_id]
+        self.waits[job.job_class].append(now - job.queued_at)
+        self.released[job.job_class] += 1
+        return job
+
+    async def _run(self):
+        while True:
+            if not self._queued:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            stages = {job.stage for job in self._queued.values()}
+            room = {}
+            for stage in stages:
+                try:
+                    depth = await self.backlog(stage)
+                except Exception as e:
+                    print(f"[SCHEDULER] Could not read {stage} backlog: {e}")
+                    depth = None
+                # Unknown depth: release one at a time so a broker outage surfaces as publish errors
+                room[stage] = 1 if depth is None else self.target_backlog - depth
+            released = False
+            while True:
+                job = self._next(room)
+                if job is None:
+                    break
+                room[job.stage] -= 1
+                released = True
+                try:
+                    await self.release(job)
+                except Exception as e:
+                    print(f"[SCHEDULER][ERROR] Releasing {job.stage} for {job.video_id}: {e}")
+            if not released:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def record_completion(self, job_class, seconds):
+        """Upload-to-completion time of a scheduled job."""
+        if job_class in self.completions:
+            self.completions[job_class].append(seconds)
+
+    def stats(self):
+        classes = {}
+        queued = {name: 0 for name in SCHED_CLASS_NAMES}
+        for job in self._queued.values():
+            queued[job.job_class] += 1
+        for name in SCHED_CLASS_NAMES:
+            classes[name] = {
+                "queued": queued[name],
+                "released": self.released[name],
+                "completed": len(self.completions[name]),
+                "wait_p50_seconds": percentile(self.waits[name], 0.5),
+                "wait_p95_seconds": percentile(self.waits[name], 0.95),
+                "completion_p50_seconds": percentile(self.completions[name], 0.5),
+                "completion_p95_seconds": percentile(self.completions[name], 0.95),
+            }
+        return {
+            "queued": len(self._queued),
+            "clients": {client: {"queued": len(q.jobs), "vtime": round(q.vtime, 3)}
+                        for client, q in self.clients.items() if q.jobs},
+            "target_backlog": self.target_backlog,
+            "classes": classes,
+        }
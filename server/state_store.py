@@ -0,0 +1,264 @@
+"""
+Job-state stores for the API.
+
+Each job's state is a JSON-serialisable dict keyed by ``video_id``. Stores
+also track a coarse status (``processing``/``done``/``failed``) derived from
+the state, and evict finished jobs once they are older than a TTL. The
+in-memory store is per process; the SQLite store (WAL mode) can be shared by
+several uvicorn workers on one host. Live connection handles such as
+WebSockets never go into a store.
+"""
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+STATE_STORE = os.environ.get("STATE_STORE", "memory").lower()
+STATE_DB_PATH = os.environ.get(
+    "STATE_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../static/storage/.job_state.db"),
+)
+# Finished (or failed) jobs are forgotten this long after they finish
+STATE_TTL_SECONDS = float(os.environ.get("STATE_TTL_SECONDS", str(24 * 3600)))
+
+PROCESSING, DONE, FAILED = "processing", "done", "failed"
+
+
+def job_status(state):
+    """Coarse status of a job state, used for indexing and eviction."""
+    if state.get("error"):
+        return FAILED
+    stages = state.get("status", {})
+    # "complete" is set from the pipeline DAG, where optional stages may still be pending
+    if state.get("complete", bool(stages) and all(stages.values())):
+        return DONE
+    return PROCESSING
+
+
+class StateStore:
+    """Interface shared by the job-state backends."""
+
+    shared = False  # True if other processes see the same jobs
+
+    def __init__(self, ttl_seconds=STATE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, video_id):
+        """Return a copy of the job's state, or None."""
+        raise NotImplementedError
+
+    def create(self, video_id, state):
+        raise NotImplementedError
+
+    def update(self, video_id, mutate):
+        """
+        Atomically apply ``mutate(state)`` to a job and save it. Returns the
+        new state, or None if the job does not exist.
+        """
+        raise NotImplementedError
+
+    def delete(self, video_id):
+        raise NotImplementedError
+
+    def count(self, status=None):
+        raise NotImplementedError
+
+    def ids(self, status=None):
+        """The video_ids of all jobs, or of those with ``status``."""
+        raise NotImplementedError
+
+    def evict_expired(self, now=None):
+        """Drop finished jobs older than the TTL; returns how many were dropped."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _finish_time(self, status, previous=None):
+        if status == PROCESSING:
+            return None
+        return previous or time.time()
+
+
+class MemoryStateStore(StateStore):
+    """Per-process dict with a status index; the default for a single API process."""
+
+    def __init__(self, ttl_seconds=STATE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self._jobs = {}
+        self._status = {}
+        self._finished_at = {}
+        self._by_status = {PROCESSING: set(), DONE: set(), FAILED: set()}
+        self._lock = threading.Lock()
+
+    def _index(self, video_id, state):
+        status = job_status(state)
+        old = self._status.get(video_id)
+        if old is not None:
+            self._by_status[old].discard(video_id)
+        self._by_status[status].add(video_id)
+        self._status[video_id] = status
+        if status == PROCESSING:
+            self._finished_at.pop(video_id, None)
+        else:
+            self._finished_at.setdefault(video_id, time.time())
+
+    def get(self, video_id):
+        with self._lock:
+            state = self._jobs.get(video_id)
+            return copy.deepcopy(state) if state is not None else None
+
+    def create(self, video_id, state):
+        with self._lock:
+            self._jobs[video_id] = copy.deepcopy(state)
+            self._index(video_id, state)
+
+    def update(self, video_id, mutate):
+        with self._lock:
+            state = self._jobs.get(video_id)
+            if state is None:
+                return None
+            mutate(state)
+            self._index(video_id, state)
+            return copy.deepcopy(state)
+
+    def delete(self, video_id):
+        with self._lock:
+            self._jobs.pop(video_id, None)
+            self._finished_at.pop(video_id, None)
+            status = self._status.pop(video_id, None)
+            if status is not None:
+                self._by_status[status].discard(video_id)
+
+    def count(self, status=None):
+        with self._lock:
+            if status is None:
+                return len(self._jobs)
+            return len(self._by_status.get(status, ()))
+
+    def ids(self, status=None):
+        with self._lock:
+            if status is None:
+                return list(self._jobs)
+            return list(self._by_status.get(status, ()))
+
+    def evict_expired(self, now=None):
+        cutoff = (now or time.time()) - self.ttl_seconds
+        expired = [vid for vid, finished in list(self._finished_at.items()) if finished <= cutoff]
+        for video_id in expired:
+            self.delete(video_id)
+        return len(expired)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Jobs in a WAL-mode SQLite table, indexed by video_id and status. Readers
+    never block the writer, so several API processes can share one file.
+    """
+
+    shared = True
+
+    def __init__(self, path=STATE_DB_PATH, ttl_seconds=STATE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Explicit transactions only; one connection per process guarded by a lock
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    video_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    finished_at REAL,
+                    state TEXT NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+
+    def get(self, video_id):
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM jobs WHERE video_id = ?", (video_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def create(self, video_id, state):
+        status = job_status(state)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (video_id, status, updated_at, finished_at, state) VALUES (?, ?, ?, ?, ?)",
+                (video_id, status, now, self._finish_time(status), json.dumps(state)),
+            )
+
+    def update(self, video_id, mutate):
+        with self._lock:
+            # IMMEDIATE takes the write lock up front so concurrent read-modify-writes serialise
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT state, finished_at FROM jobs WHERE video_id = ?", (video_id,)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                state = json.loads(row[0])
+                mutate(state)
+                status = job_status(state)
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, updated_at = ?, finished_at = ?, state = ? WHERE video_id = ?",
+                    (status, time.time(), self._finish_time(status, row[1]), json.dumps(state), video_id),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return state
+
+    def delete(self, video_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE video_id = ?", (video_id,))
+
+    def count(self, status=None):
+        with self._lock:
+            if status is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()
+            else:
+                row = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()
+        return row[0]
+
+    def ids(self, status=None):
+        with self._lock:
+            if status is None:
+                rows = self._conn.execute("SELECT video_id FROM jobs").fetchall()
+            else:
+                rows = self._conn.execute("SELECT video_id FROM jobs WHERE status = ?", (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    def evict_expired(self, now=None):
+        cutoff = (now or time.time()) - self.ttl_seconds
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at <= ?", (cutoff,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_state_store(backend=STATE_STORE):
+    """Build the store selected by STATE_STORE ("memory" or "sqlite")."""
+    if backend == "sqlite":
+        return SQLiteStateStore()
+    if backend == "memory":
+        return MemoryStateStore()
+    raise ValueError(f"Unknown STATE_STORE backend: {backend}")
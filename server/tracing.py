@@ -0,0 +1,149 @@
+"""
+Per-job traces: where a job's time went, from upload to the last stage result.
+
+A trace is created when an upload arrives and kept in the job's state. The
+API records its own spans (receiving the upload, time held by the
+scheduler, publishing each stage, and the delivery of each stage result)
+and passes a W3C ``traceparent`` header with every task, whose parent is
+that task's publish span. Workers send back their queue, processing and
+phase (decode/filter/encode, ...) spans with the result, and they are added
+to the same trace. ``/status`` returns a breakdown by stage and phase.
+
+With TRACE_EXPORT_PATH set, each trace is appended to that file as one
+OTLP/JSON ``TracesData`` object per line once every dispatched stage has
+reported back.
+"""
+
+import json
+import os
+import secrets
+import time
+
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH")
+SERVICE_NAME = "video-pipeline"
+# Spans every stage has; anything else a worker reports is a phase of its processing
+STAGE_SPANS = ("schedule", "publish", "queue", "process", "callback")
+
+
+def new_span_id():
+    return secrets.token_hex(8)
+
+
+def new_trace(start=None):
+    """Trace state for a new job, rooted at ``start`` (epoch seconds)."""
+    return {
+        "trace_id": secrets.token_hex(16),
+        "span_id": new_span_id(),
+        "start": time.time() if start is None else start,
+        "end": None,
+        "spans": [],
+        "exported": False,
+    }
+
+
+def traceparent(trace_id, span_id):
+    return f"00-{trace_id}-{span_id}-01"
+
+
+def make_span(name, start, end, parent_id, span_id=None, **attributes):
+    return {
+        "name": name,
+        "span_id": span_id or new_span_id(),
+        "parent_id": parent_id,
+        "start": start,
+        "end": end,
+        "attributes": attributes,
+    }
+
+
+def add_spans(state, spans):
+    trace = state.get("trace")
+    if trace is not None:
+        trace["spans"].extend(spans)
+
+
+def finish_trace(state, end=None):
+    trace = state.get("trace")
+    if trace is not None and trace["end"] is None:
+        trace["end"] = time.time() if end is None else end
+
+
+def timing_breakdown(trace, now=None):
+    """Seconds per upload step, and per stage and phase, for /status."""
+    if not trace:
+        return None
+    upload = {}
+    stages = {}
+    for span in trace["spans"]:
+        attributes = span.get("attributes") or {}
+        seconds = round(span["end"] - span["start"], 4)
+        stage = attributes.get("stage")
+        if stage is None:
+            upload[f"{span['name']}_seconds"] = seconds
+            continue
+        entry = stages.setdefault(stage, {"phases": {}})
+        if span["name"] in STAGE_SPANS:
+            key = f"{span['name']}_seconds"
+            # A stage can be scheduled, published or run more than once
+            entry[key] = round(entry.get(key, 0) + seconds, 4)
+        else:
+            phase = {"seconds": seconds}
+            if "busy_seconds" in attributes:
+                phase["busy_seconds"] = attributes["busy_seconds"]
+            entry["phases"][span["name"]] = phase
+    end = trace["end"] or (time.time() if now is None else now)
+    return {
+        "trace_id": trace["trace_id"],
+        "finished": trace["end"] is not None,
+        "total_seconds": round(end - trace["start"], 4),
+        "upload": upload,
+        "stages": stages,
+    }
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(trace_id, span):
+    return {
+        "traceId": trace_id,
+        "spanId": span["span_id"],
+        "parentSpanId": span.get("parent_id") or "",
+        "name": span["name"],
+        "kind": 1,
+        "startTimeUnixNano": str(int(span["start"] * 1e9)),
+        "endTimeUnixNano": str(int(span["end"] * 1e9)),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.get("attributes", {}).items()],
+    }
+
+
+def otlp_json(video_id, trace):
+    """The trace as an OTLP/JSON TracesData object, with a root ``job`` span."""
+    root = make_span("job", trace["start"], trace["end"] or time.time(), None, trace["span_id"], video_id=video_id)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": SERVICE_NAME},
+                "spans": [_otlp_span(trace["trace_id"], span) for span in [root] + trace["spans"]],
+            }],
+        }],
+    }
+
+
+def export_trace(video_id, trace, path=TRACE_EXPORT_PATH):
+    """Append a finished trace to the OTLP/JSON lines file, if one is configured."""
+    if not path:
+        return
+    try:
+        with open(path, "a") as f:
+            f.write(json.dumps(otlp_json(video_id, trace)) + "\n")
+    except OSError as e:
+        print(f"[TRACE][ERROR] Could not export trace for {video_id}: {e}")
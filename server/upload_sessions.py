@@ -0,0 +1,365 @@
+"""
+Resumable, parallel chunked uploads.
+
+A session is created with the file's name and size. The file is then sent
+as numbered chunks of ``chunk_size`` bytes in any order, several at once,
+each with its SHA-256. Each chunk is written with ``os.pwrite`` at its offset
+into a file preallocated at creation, so the assembled upload is never
+copied. Finalizing renames that file into place.
+
+Session state lives on disk under ``<storage>/.uploads/<upload_id>/``:
+
+    session.json   immutable description written at creation
+    data.part      the preallocated upload
+    chunks         one byte per chunk, set to 1 with a positioned write once
+                   that chunk has been received and verified, and cleared
+                   before any write of its bytes
+    lock           flocked shared by each chunk write and exclusively by finalize
+    finalizing     created by finalize; chunk writes are refused once it exists
+
+Chunk writes only share the lock, so any API process on the host can take
+any chunk, several at once. Finalize marks the session, then waits for the
+writes already under way before it reads the flags and renames the file.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+import anyio
+
+try:
+    import fcntl
+except ImportError:  # Windows: chunk writes are then only refused once finalize has begun
+    fcntl = None
+
+from uploads import MAX_UPLOAD_BYTES, UploadError
+
+
+UPLOAD_SESSION_DIRNAME = ".uploads"
+UPLOAD_SESSION_CHUNK_SIZE = int(os.environ.get("UPLOAD_SESSION_CHUNK_SIZE", str(8 * 1024 * 1024)))
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+# Unfinished sessions are dropped this long after they were created
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", str(24 * 3600)))
+# Bytes gathered from the request before each positioned write
+WRITE_BATCH_BYTES = 1024 * 1024
+HASH_READ_SIZE = 4 * 1024 * 1024
+
+
+def _preallocate(fd, size):
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # No fallocate here (or the filesystem refuses it): a sparse file still avoids any copy
+        os.ftruncate(fd, size)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _received_ranges(flags, chunk_size, size):
+    """Merged ``[start, end)`` byte ranges covered by received chunks."""
+    ranges = []
+    for index, flag in enumerate(flags):
+        if not flag:
+            continue
+        start = index * chunk_size
+        end = min(size, start + chunk_size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _file_hash(path):
+    hasher = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_READ_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class UploadSession:
+    def __init__(self, directory, info):
+        self.directory = directory
+        self.info = info
+
+    @property
+    def upload_id(self):
+        return self.info["upload_id"]
+
+    @property
+    def size(self):
+        return self.info["size"]
+
+    @property
+    def chunk_size(self):
+        return self.info["chunk_size"]
+
+    @property
+    def chunk_count(self):
+        return self.info["chunk_count"]
+
+    @property
+    def data_path(self):
+        return os.path.join(self.directory, "data.part")
+
+    @property
+    def chunks_path(self):
+        return os.path.join(self.directory, "chunks")
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.directory, "lock")
+
+    @property
+    def finalizing_path(self):
+        return os.path.join(self.directory, "finalizing")
+
+    def _open_lock(self):
+        try:
+            return os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            raise UploadError("Upload session is finished or gone", status_code=404)
+
+    @contextmanager
+    def _chunk_writer(self):
+        """Shared hold on the session for one chunk write, refused once finalize has begun."""
+        lock = self._open_lock()
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise UploadError("Upload session is being finalized", status_code=409)
+            # Checked while holding the lock: a finalize that starts later waits for this write
+            if os.path.exists(self.finalizing_path):
+                raise UploadError("Upload session is being finalized", status_code=409)
+            yield
+        finally:
+            os.close(lock)
+
+    def chunk_length(self, index):
+        start = index * self.chunk_size
+        return min(self.chunk_size, self.size - start)
+
+    def received_flags(self):
+        with open(self.chunks_path, "rb") as f:
+            return f.read(self.chunk_count)
+
+    def status(self):
+        flags = self.received_flags()
+        received = [i for i, flag in enumerate(flags) if flag]
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.info["filename"],
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunk_count": self.chunk_count,
+            "received_chunks": received,
+            "missing_chunks": [i for i, flag in enumerate(flags) if not flag],
+            "received_ranges": _received_ranges(flags, self.chunk_size, self.size),
+            "received_bytes": sum(self.chunk_length(i) for i in received),
+            "expires_at": self.info["created_at"] + UPLOAD_SESSION_TTL,
+        }
+
+    async def write_chunk(self, index, stream, checksum):
+        """
+        Write chunk ``index`` from an async byte ``stream`` at its offset and
+        mark it received if its length and SHA-256 (hex) match. A retried
+        chunk overwrites the same bytes, so it is marked missing first: a
+        retry that fails verification leaves the chunk to be sent again
+        rather than counted with corrupted bytes.
+        """
+        if not 0 <= index < self.chunk_count:
+            raise UploadError(f"Chunk index must be between 0 and {self.chunk_count - 1}")
+        expected = self.chunk_length(index)
+        offset = index * self.chunk_size
+        hasher = hashlib.sha256()
+        written = 0
+
+        with self._chunk_writer():
+            try:
+                fd = os.open(self.data_path, os.O_WRONLY)
+            except FileNotFoundError:
+                raise UploadError("Upload session is finished or gone", status_code=404)
+            try:
+                self._set_flag(index, b"\x00")
+                pending = []
+                pending_size = 0
+                async for piece in stream:
+                    if not piece:
+                        continue
+                    written += len(piece)
+                    if written > expected:
+                        raise UploadError(f"Chunk {index} is larger than {expected} bytes", status_code=413)
+                    hasher.update(piece)
+                    pending.append(piece)
+                    pending_size += len(piece)
+                    if pending_size >= WRITE_BATCH_BYTES:
+                        data = b"".join(pending)
+                        await anyio.to_thread.run_sync(_pwrite_all, fd, data, offset)
+                        offset += len(data)
+                        pending, pending_size = [], 0
+                if pending:
+                    await anyio.to_thread.run_sync(_pwrite_all, fd, b"".join(pending), offset)
+            finally:
+                os.close(fd)
+
+            if written != expected:
+                raise UploadError(f"Chunk {index} has {written} bytes, expected {expected}")
+            if hasher.hexdigest() != checksum.lower():
+                raise UploadError(f"Checksum mismatch for chunk {index}", status_code=422)
+
+            self._set_flag(index, b"\x01")
+
+    def _set_flag(self, index, flag):
+        fd = os.open(self.chunks_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, flag, index)
+        finally:
+            os.close(fd)
+
+    async def finalize(self, destination):
+        """
+        Move the assembled file to ``destination`` once every chunk is in and
+        return its BLAKE2b hash. Raises UploadError listing missing chunks.
+        """
+        try:
+            # Refuses new chunk writes; only one finalize gets to create it
+            os.close(os.open(self.finalizing_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            raise UploadError("Upload session is already being finalized", status_code=409)
+        except FileNotFoundError:
+            raise UploadError("Upload session is already finalized", status_code=409)
+        renamed = False
+        lock = None
+        try:
+            lock = self._open_lock()
+            if fcntl is not None:
+                # Writes that began before the marker existed finish first
+                await anyio.to_thread.run_sync(fcntl.flock, lock, fcntl.LOCK_EX)
+            missing = [i for i, flag in enumerate(self.received_flags()) if not flag]
+            if missing:
+                raise UploadError(f"Missing {len(missing)} chunk(s), first {missing[:10]}", status_code=409)
+            os.rename(self.data_path, destination)
+            renamed = True
+        finally:
+            if lock is not None:
+                os.close(lock)
+            if not renamed:
+                # Let the client send what is missing and finalize again
+                try:
+                    os.remove(self.finalizing_path)
+                except FileNotFoundError:
+                    pass
+        try:
+            content_hash = await anyio.to_thread.run_sync(_file_hash, destination)
+        except BaseException:
+            os.remove(destination)
+            raise
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        return content_hash
+
+    def abort(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class UploadSessions:
+    """Creates and looks up upload sessions under ``<storage>/.uploads``."""
+
+    def __init__(self, storage_dir, max_bytes=MAX_UPLOAD_BYTES, ttl_seconds=UPLOAD_SESSION_TTL):
+        self.root = os.path.join(storage_dir, UPLOAD_SESSION_DIRNAME)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(self.root, exist_ok=True)
+
+    def create(self, filename, size, chunk_size=None, fields=None):
+        filename = os.path.basename(str(filename or "").replace("\\", "/"))
+        if not filename:
+            raise UploadError("filename is required")
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("size must be a positive integer")
+        if size > self.max_bytes:
+            raise UploadError(f"File exceeds the {self.max_bytes} byte upload limit", status_code=413)
+        chunk_size = UPLOAD_SESSION_CHUNK_SIZE if chunk_size is None else chunk_size
+        if not isinstance(chunk_size, int) or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            raise UploadError(f"chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE}")
+
+        upload_id = uuid.uuid4().hex
+        info = {
+            "upload_id": upload_id,
+            "filename": filename,
+            "size": size,
+            "chunk_size": chunk_size,
+            "chunk_count": -(-size // chunk_size),
+            "fields": fields or {},
+            "created_at": time.time(),
+        }
+        directory = os.path.join(self.root, upload_id)
+        os.makedirs(directory)
+        session = UploadSession(directory, info)
+        try:
+            fd = os.open(session.data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                _preallocate(fd, size)
+            finally:
+                os.close(fd)
+            with open(session.chunks_path, "wb") as f:
+                f.write(bytes(info["chunk_count"]))
+            # Written last: a session without it is incomplete and is never served
+            temp_path = os.path.join(directory, "session.json.tmp")
+            with open(temp_path, "w") as f:
+                json.dump(info, f)
+            os.replace(temp_path, os.path.join(directory, "session.json"))
+        except BaseException:
+            session.abort()
+            raise
+        return session
+
+    def get(self, upload_id):
+        """The session, or None if it does not exist (or has been finalized)."""
+        if not upload_id.isalnum():
+            return None
+        directory = os.path.join(self.root, upload_id)
+        try:
+            with open(os.path.join(directory, "session.json")) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return UploadSession(directory, info)
+
+    def evict_expired(self, now=None):
+        """Remove sessions created more than the TTL ago; returns how many."""
+        cutoff = (now or time.time()) - self.ttl_seconds
+        evicted = 0
+        for upload_id in os.listdir(self.root):
+            directory = os.path.join(self.root, upload_id)
+            try:
+                created = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            session = self.get(upload_id)
+            if session is not None:
+                created = session.info["created_at"]
+            if created <= cutoff:
+                shutil.rmtree(directory, ignore_errors=True)
+                evicted += 1
+        return evicted
@@ -0,0 +1,198 @@
+"""
+Streaming multipart upload handling for /upload.
+
+The request body is parsed incrementally as it arrives: the video part is
+hashed and written to a temp file in fixed-size chunks, then renamed into
+place, so memory per upload stays constant regardless of the file size.
+"""
+
+import hashlib
+import os
+import uuid
+
+import aiofiles
+
+try:
+    from python_multipart.exceptions import MultipartParseError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.exceptions import MultipartParseError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+
+# Bytes buffered before each disk write
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Largest accepted video; larger uploads are rejected with 413
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(4 * 1024 * 1024 * 1024)))
+# Cap on the size of ordinary (non-file) form fields
+MAX_FIELD_BYTES = 64 * 1024
+
+
+class UploadError(Exception):
+    """Upload rejected; carries the HTTP status code to answer with."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StoredUpload:
+    """Result of a completed streaming upload."""
+
+    def __init__(self, filename, path, size, content_hash, fields):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.content_hash = content_hash
+        self.fields = fields
+
+
+class _PartCollector:
+    """Synchronous MultipartParser callbacks; the async side drains ``pending``."""
+
+    def __init__(self, file_field, max_bytes):
+        self.file_field = file_field
+        self.max_bytes = max_bytes
+        self.hasher = hashlib.blake2b(digest_size=32)
+        self.fields = {}
+        self.filename = None
+        self.file_size = 0
+        self.pending = []
+        self.pending_size = 0
+        self.finished = False
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._name = None
+        self._is_file = False
+        self._field_value = bytearray()
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_end": self.on_end,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._name = None
+        self._is_file = False
+        self._field_value = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        if self._name == self.file_field and filename is not None:
+            if self.filename is not None:
+                raise UploadError(f"Only one '{self.file_field}' part is allowed")
+            # Never trust client paths: keep only the final component
+            self.filename = os.path.basename(filename.decode("utf-8", "replace").replace("\\", "/"))
+            if not self.filename:
+                raise UploadError("Uploaded file has no filename")
+            self._is_file = True
+
+    def on_part_data(self, data, start, end):
+        if self._is_file:
+            self.file_size += end - start
+            if self.file_size > self.max_bytes:
+                raise UploadError(f"File exceeds the {self.max_bytes} byte upload limit", status_code=413)
+            chunk = data[start:end]
+            self.hasher.update(chunk)
+            self.pending.append(chunk)
+            self.pending_size += len(chunk)
+        else:
+            self._field_value += data[start:end]
+            if len(self._field_value) > MAX_FIELD_BYTES:
+                raise UploadError(f"Form field '{self._name}' is too large", status_code=413)
+
+    def on_part_end(self):
+        if not self._is_file and self._name:
+            self.fields[self._name] = self._field_value.decode("utf-8", "replace")
+
+    def on_end(self):
+        self.finished = True
+
+    def take_pending(self):
+        data = b"".join(self.pending)
+        self.pending.clear()
+        self.pending_size = 0
+        return data
+
+
+async def receive_upload(request, storage_dir, name_prefix, file_field="file",
+                         max_bytes=None, chunk_size=None):
+    """
+    Stream a multipart request body to ``storage_dir``.
+
+    The ``file_field`` part is hashed (BLAKE2b) and written in ``chunk_size``
+    chunks to a hidden temp file that is renamed to ``{name_prefix}_{filename}``
+    only once the whole body has been received. Other parts are returned as
+    small text fields. Raises UploadError on malformed or oversized uploads.
+    """
+    max_bytes = MAX_UPLOAD_BYTES if max_bytes is None else max_bytes
+    chunk_size = UPLOAD_CHUNK_SIZE if chunk_size is None else chunk_size
+
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data body")
+
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes + MAX_FIELD_BYTES:
+        raise UploadError(f"File exceeds the {max_bytes} byte upload limit", status_code=413)
+
+    collector = _PartCollector(file_field, max_bytes)
+    parser = MultipartParser(boundary, collector.callbacks())
+    temp_path = os.path.join(storage_dir, f".upload-{uuid.uuid4().hex}.part")
+
+    try:
+        async with aiofiles.open(temp_path, "wb") as out_file:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if collector.pending_size >= chunk_size:
+                    await out_file.write(collector.take_pending())
+            parser.finalize()
+            if collector.pending_size:
+                await out_file.write(collector.take_pending())
+
+        if not collector.finished:
+            raise UploadError("Incomplete multipart body")
+        if collector.filename is None:
+            raise UploadError(f"Missing '{file_field}' file part")
+
+        final_path = os.path.join(storage_dir, f"{name_prefix}_{collector.filename}")
+        os.replace(temp_path, final_path)
+    except MultipartParseError as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise UploadError(f"Malformed multipart body: {e}") from e
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return StoredUpload(
+        filename=collector.filename,
+        path=final_path,
+        size=collector.file_size,
+        content_hash=collector.hasher.hexdigest(),
+        fields=collector.fields,
+    )
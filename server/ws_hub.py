@@ -0,0 +1,161 @@
+"""
+WebSocket subscription hub.
+
+One socket can follow any number of video_ids. Events are queued per
+connection and coalesced by (video_id, type), so a slow client only ever has
+the latest progress event per job waiting rather than a growing backlog, and
+each connection is drained by its own sender task so one slow client never
+holds up the event loop or the other subscribers. Once a job's
+``complete`` or ``failed`` event is queued, its progress is no longer sent,
+so a client never goes back from done to a progress bar.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+
+
+# A client that takes longer than this to accept one message is disconnected
+WS_SEND_TIMEOUT = float(os.environ.get("WS_SEND_TIMEOUT", "10"))
+# Most video_ids a single connection may follow
+WS_MAX_SUBSCRIPTIONS = int(os.environ.get("WS_MAX_SUBSCRIPTIONS", "1000"))
+
+TERMINAL_EVENTS = ("complete", "failed")
+
+
+class Subscriber:
+    """One connected socket: its subscriptions and its coalescing outbox."""
+
+    def __init__(self, websocket, send_timeout=WS_SEND_TIMEOUT):
+        self.websocket = websocket
+        self.send_timeout = send_timeout
+        self.video_ids = set()
+        self._pending = OrderedDict()
+        self._terminal = set()  # video_ids whose complete/failed event has been queued
+        self._replies = 0
+        self._wakeup = asyncio.Event()
+        self._sender = None
+        self.closed = False
+
+    def start(self):
+        self._sender = asyncio.create_task(self._send_loop())
+
+    def offer(self, event, key=None):
+        """Queue an event without waiting; replaces any unsent event with the same key."""
+        if self.closed:
+            return
+        video_id, kind = event.get("video_id"), event.get("type")
+        if kind == "progress" and video_id in self._terminal:
+            return
+        if kind in TERMINAL_EVENTS:
+            self._terminal.add(video_id)
+            self._pending.pop((video_id, "progress"), None)
+        key = key or (video_id, kind)
+        self._pending.pop(key, None)
+        self._pending[key] = event
+        self._wakeup.set()
+
+    def reply(self, message):
+        """Queue a direct response to this client; replies are never coalesced."""
+        self._replies += 1
+        self.offer(message, key=("reply", self._replies))
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._pending:
+                    _, event = self._pending.popitem(last=False)
+                    if event.get("type") == "progress" and event.get("video_id") in self._terminal:
+                        continue
+                    await asyncio.wait_for(self.websocket.send_json(event), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[WS] Dropping slow or broken connection: {e!r}")
+            self.closed = True
+            try:
+                await self.websocket.close()
+            except Exception:
+                pass
+
+    def forget(self, video_id):
+        self._terminal.discard(video_id)
+
+    async def close(self):
+        self.closed = True
+        if self._sender is not None:
+            self._sender.cancel()
+            try:
+                await self._sender
+            except asyncio.CancelledError:
+                pass
+
+
+class SubscriptionHub:
+    """Per-process registry of sockets and the video_ids each one follows."""
+
+    def __init__(self, max_subscriptions=WS_MAX_SUBSCRIPTIONS):
+        self.max_subscriptions = max_subscriptions
+        self._subscribers = {}  # video_id -> set of Subscriber
+        self.finished = set()   # subscribed video_ids whose completion has been sent here
+        self.connected = 0      # open sockets, subscribed or not
+
+    def connect(self, websocket):
+        subscriber = Subscriber(websocket)
+        subscriber.start()
+        self.connected += 1
+        return subscriber
+
+    async def disconnect(self, subscriber):
+        for video_id in list(subscriber.video_ids):
+            self.unsubscribe(subscriber, video_id)
+        self.connected -= 1
+        await subscriber.close()
+
+    def subscribe(self, subscriber, video_id):
+        """Follow a video_id; False if the connection is at its subscription limit."""
+        if video_id not in subscriber.video_ids and len(subscriber.video_ids) >= self.max_subscriptions:
+            return False
+        subscriber.video_ids.add(video_id)
+        self._subscribers.setdefault(video_id, set()).add(subscriber)
+        return True
+
+    def unsubscribe(self, subscriber, video_id):
+        subscriber.video_ids.discard(video_id)
+        subscriber.forget(video_id)
+        subscribers = self._subscribers.get(video_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[video_id]
+            self.finished.discard(video_id)
+
+    def mark_finished(self, video_id):
+        """
+        Remember that video_id's completion was sent, so it is not polled for
+        again. Only subscribed ids are kept; unsubscribe forgets them, which
+        bounds the set by the live subscriptions.
+        """
+        if video_id in self._subscribers:
+            self.finished.add(video_id)
+
+    def publish(self, video_id, event):
+        """Fan an event out to every subscriber of video_id; never blocks."""
+        for subscriber in list(self._subscribers.get(video_id, ())):
+            subscriber.offer(event)
+        return len(self._subscribers.get(video_id, ()))
+
+    def has_subscribers(self, video_id):
+        return bool(self._subscribers.get(video_id))
+
+    def video_ids(self):
+        return set(self._subscribers)
+
+    def stats(self):
+        connections = set()
+        for subscribers in self._subscribers.values():
+            connections.update(subscribers)
+        return {"video_ids": len(self._subscribers), "connections": len(connections)}
@@ -1,14 +1,27 @@
 #workers\enhancement_worker.py
 
-import pika
-import json
-import requests
+import math
+import queue
+import threading
 import os
 import cv2
+import numpy as np
 import logging
+import multiprocessing
+import subprocess
+import sys
+import tempfile
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 
+try:
+    import resource
+    RESOURCE_AVAILABLE = True
+except ImportError:  # Windows
+    RESOURCE_AVAILABLE = False
+
 # Try importing imageio as a fallback
 try:
     import imageio
@@ -17,6 +30,19 @@ except ImportError:
     IMAGEIO_AVAILABLE = False
     logging.warning("imageio not available - will use OpenCV fallback only")
 
+# imageio-ffmpeg lets us hand BGR frames straight to ffmpeg (no RGB pass)
+try:
+    import imageio_ffmpeg
+    IMAGEIO_FFMPEG_AVAILABLE = True
+except ImportError:
+    IMAGEIO_FFMPEG_AVAILABLE = False
+
+from task_queue import PermanentTaskError, handle_delivery, parse_worker_args, stage_queue_name, supervise
+from hls import HLSWriter, hls_dir, hls_metadata, package_hls
+from worker_metrics import ENHANCEMENT_DURATION, ENHANCEMENT_FPS, ENHANCEMENT_FRAMES
+from worker_tracing import current_trace
+from video_filters import build_filter_chain
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -28,21 +54,513 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-RABBITMQ_HOST = 'localhost'
-QUEUE_NAME = 'video_tasks'
+STAGE = 'enhancement'
+QUEUE_NAME = stage_queue_name(STAGE)
+# Used only by the HTTP result transport (RESULT_TRANSPORT=http)
 FASTAPI_STATUS_URL = 'http://localhost:8000/internal/video-enhancement-status'
 PROJECT_ROOT = os.path.dirname(os.path.dirname(__file__))
 STORAGE_PATH = os.path.abspath(os.path.join(PROJECT_ROOT, "static", "storage"))
 
-# Retry configuration
-MAX_RETRIES = 3
-RETRY_DELAY = 2
+# Upper bound on enhanced frames held in memory before they are handed to the writer
+MAX_INFLIGHT_FRAMES = int(os.environ.get("ENHANCE_MAX_INFLIGHT_FRAMES", "8"))
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Segment-parallel enhancement: a worker count of 1 keeps the serial path
+PARALLEL_WORKERS = int(os.environ.get("ENHANCE_PARALLEL_WORKERS", str(os.cpu_count() or 1)))
+SEGMENT_FRAMES = int(os.environ.get("ENHANCE_SEGMENT_FRAMES", "300"))
+# Default output frame rate; jobs may override it with "target_fps"
+OUTPUT_FPS = float(os.environ.get("ENHANCE_OUTPUT_FPS", "15"))
+# Also produce HLS for every job, not just those that ask for it with "hls": true
+HLS_BY_DEFAULT = os.environ.get("ENHANCE_HLS", "0") == "1"
+
+# Writer backends in order of preference; the working subset is probed once
+OPENCV_CODECS = ['MJPG', 'XVID', 'DIVX', 'FFV1']
+FFMPEG_BACKENDS = ('imageio-bgr', 'imageio')
+
+_process_pool = None
+_process_pool_size = 0
+_process_pool_lock = threading.Lock()
+_writer_backends = None
+
+def _current_rss_bytes():
+    """Return the resident set size of this process in bytes (0 if unknown)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    if RESOURCE_AVAILABLE:
+        # ru_maxrss is the lifetime peak: kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return 0
+
+
+class RSSTracker:
+    """Tracks the peak resident set size observed while a job runs."""
+
+    def __init__(self):
+        self.peak = _current_rss_bytes()
+
+    def sample(self):
+        rss = _current_rss_bytes()
+        if rss > self.peak:
+            self.peak = rss
+        return rss
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / (1024 * 1024), 1)
+
+
+class PhaseTimer:
+    """
+    Time spent in one pipeline phase (decode, filter or encode): the wall-clock
+    window from its first to its last timed call, and the busy time inside it
+    (excluding waits on the other phases). Timed with perf_counter.
+    """
+
+    def __init__(self):
+        self.first = None
+        self.last = None
+        self.busy = 0.0
+        self.frames = 0
+
+    def record(self, began, ended, frames=1):
+        if self.first is None:
+            self.first = began
+        self.last = ended
+        self.busy += ended - began
+        self.frames += frames
+
+    def to_dict(self, anchor):
+        """Window as epoch seconds, given ``anchor`` = time.time() - time.perf_counter()."""
+        return {"start": anchor + self.first, "end": anchor + self.last,
+                "busy": self.busy, "frames": self.frames}
+
+
+def _phase_dicts(timers):
+    anchor = time.time() - time.perf_counter()
+    return {name: timer.to_dict(anchor) for name, timer in timers.items() if timer.first is not None}
+
+
+def _merge_phases(phase_dicts):
+    """Combine per-segment phase timings: overall window, summed busy time and frames."""
+    merged = {}
+    for phases in phase_dicts:
+        for name, phase in phases.items():
+            total = merged.get(name)
+            if total is None:
+                merged[name] = dict(phase)
+                continue
+            total["start"] = min(total["start"], phase["start"])
+            total["end"] = max(total["end"], phase["end"])
+            total["busy"] += phase["busy"]
+            total["frames"] += phase["frames"]
+    return merged
+
+
+class FrameResampler:
+    """
+    Temporal resampler that picks which source frames survive a frame-rate
+    reduction while keeping the original duration.
+
+    Output frame k is taken from the first source frame whose timestamp is at or
+    after k / out_fps. The decision depends only on the source frame index, so
+    independently processed segments stay in phase. Upsampling is not done: a
+    target at or above the source rate keeps every frame at the source rate.
+    """
+
+    def __init__(self, src_fps, target_fps=None):
+        self.src_fps = float(src_fps)
+        if not target_fps or target_fps <= 0 or target_fps >= self.src_fps:
+            self.out_fps = self.src_fps
+        else:
+            self.out_fps = float(target_fps)
+        self._ratio = self.out_fps / self.src_fps
+
+    @property
+    def decimating(self):
+        return self.out_fps < self.src_fps
+
+    def keeps(self, index):
+        """True if source frame ``index`` is emitted."""
+        if not self.decimating:
+            return True
+        # An output timestamp k/out_fps falls in ((index-1)/src_fps, index/src_fps]
+        eps = 1e-9
+        return math.floor(index * self._ratio + eps) > math.floor((index - 1) * self._ratio + eps)
+
+    def output_count(self, frame_count):
+        """Number of frames emitted for the first ``frame_count`` source frames."""
+        if not self.decimating or frame_count <= 0:
+            return max(0, frame_count)
+        return math.floor((frame_count - 1) * self._ratio + 1e-9) + 1
+
+
+def _prepare_frame(frame, width, height):
+    """Normalise a decoded frame to a 3-channel BGR image of the expected size."""
+    if frame.shape[0] != height or frame.shape[1] != width:
+        frame = cv2.resize(frame, (width, height))
+
+    if len(frame.shape) == 2:
+        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    elif frame.shape[2] == 4:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
+    return frame
+
+
+def _encoded_size(backend, width, height):
+    """Frame size a backend actually encodes for a width x height input."""
+    if backend == 'imageio-bgr':
+        # yuv420p needs even dimensions; don't pad any further than that
+        return width + width % 2, height + height % 2
+    if backend == 'imageio':
+        # imageio pads both dimensions up to its 16-pixel macro block
+        return -(-width // 16) * 16, -(-height // 16) * 16
+    return width, height
+
+
+class BGRVideoWriter:
+    """
+    Incremental ffmpeg writer that accepts OpenCV's native BGR frames, leaving
+    the channel swap to ffmpeg's own pixel-format conversion.
+    """
+
+    def __init__(self, path, fps, width, height):
+        self.size = _encoded_size('imageio-bgr', width, height)
+        self._gen = imageio_ffmpeg.write_frames(
+            path, (width, height), fps=fps, pix_fmt_in="bgr24", quality=5, macro_block_size=2
+        )
+        self._gen.send(None)
+
+    def append_data(self, frame):
+        self._gen.send(frame)
+
+    def close(self):
+        if self._gen is not None:
+            self._gen.close()
+            self._gen = None
+
+
+class ImageioVideoWriter:
+    """imageio.get_writer wrapper; expects RGB frames."""
+
+    def __init__(self, path, fps, width, height):
+        self.size = _encoded_size('imageio', width, height)
+        self._writer = imageio.get_writer(path, fps=fps)
+        self.append_data = self._writer.append_data
+
+    def close(self):
+        self._writer.close()
+
+
+class OpenCVVideoWriter:
+    """cv2.VideoWriter wrapper exposing the same append_data/close interface."""
+
+    def __init__(self, path, fps, width, height, codec):
+        self.size = _encoded_size(f'opencv-{codec}', width, height)
+        self._out = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec), fps, (width, height))
+        if not self._out.isOpened():
+            self._out.release()
+            raise RuntimeError(f"{codec} failed to open")
+        self.append_data = self._out.write
+
+    def close(self):
+        self._out.release()
+
+
+def _open_writer(backend, output_path, fps, width, height):
+    """
+    Open an incremental writer for a backend name from get_writer_backends().
+    Returns (writer, needs_rgb, path actually written).
+    """
+    if backend == 'imageio-bgr':
+        path = output_path.replace('.avi', '.mp4')
+        return BGRVideoWriter(path, fps, width, height), False, path
+    if backend == 'imageio':
+        path = output_path.replace('.avi', '.mp4')
+        return ImageioVideoWriter(path, fps, width, height), True, path
+    codec = backend.split('-', 1)[1]
+    return OpenCVVideoWriter(output_path, fps, width, height, codec), False, output_path
+
+
+def _candidate_backends():
+    candidates = []
+    if IMAGEIO_FFMPEG_AVAILABLE:
+        candidates.append('imageio-bgr')
+    if IMAGEIO_AVAILABLE:
+        candidates.append('imageio')
+    candidates.extend(f'opencv-{codec}' for codec in OPENCV_CODECS)
+    return candidates
+
+
+def get_writer_backends(refresh=False):
+    """
+    Return the writer backends that can actually encode on this host, best first.
+
+    Each candidate writes a few frames to a scratch file the first time this is
+    called; the result is cached for the life of the process so jobs go straight
+    to a known-good encoder.
+    """
+    global _writer_backends
+    if _writer_backends is not None and not refresh:
+        return _writer_backends
+
+    working = []
+    frame = np.zeros((64, 64, 3), np.uint8)
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in _candidate_backends():
+            path = os.path.join(tmp, f"probe-{backend}.mp4")
+            try:
+                writer, _, written_path = _open_writer(backend, path, 15.0, 64, 64)
+                try:
+                    for _ in range(3):
+                        writer.append_data(frame)
+                finally:
+                    writer.close()
+                if os.path.exists(written_path) and os.path.getsize(written_path) > 0:
+                    working.append(backend)
+                else:
+                    logger.warning(f"Writer backend {backend} produced no output")
+            except Exception as e:
+                logger.warning(f"Writer backend {backend} unavailable: {e}")
+
+    logger.info(f"Writer backends available: {working}")
+    _writer_backends = working
+    return working
+
+
+def _capture_metadata(cap):
+    """Input metadata from an already-open capture, in the metadata worker's format."""
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    duration = frame_count / fps if fps > 0 else 0
+    return {
+        "fps": round(fps, 2),
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "duration": round(duration, 2),
+        "frame_count": frame_count
+    }
+
+
+def _output_metadata(size, fps, frames_written):
+    """Output metadata derived from the encode pass instead of re-opening the file."""
+    width, height = size
+    return {
+        "fps": round(fps, 2),
+        "width": width,
+        "height": height,
+        "duration": round(frames_written / fps, 2) if fps > 0 else 0,
+        "frame_count": frames_written
+    }
+
+
+def _run_frame_pipeline(cap, write_frame, width, height, ring_size, to_rgb, chain,
+                        resampler=None, on_batch=None, timings=None):
+    """
+    Run decode -> enhance -> encode as three overlapping stages.
+
+    Decoding and enhancement each get their own thread while the calling thread
+    feeds ``write_frame``; OpenCV and the encoders release the GIL, so the stages
+    genuinely overlap. Frames travel through a preallocated ring of
+    ``ring_size`` slots (decoded with ``cap.read(image=...)`` and filtered in
+    place by ``chain``), so the steady-state loop allocates no frame buffers.
+    Frames that ``resampler`` drops are only ``grab()``-ed, never retrieved,
+    colour-converted or filtered.
+    ``on_batch(written)`` is called after every ``ring_size`` written frames.
+    If a ``timings`` dict is given it is filled with each phase's window and
+    busy time (see PhaseTimer). Returns the number of frames written.
+    """
+    shape = (height, width, 3)
+    ring = [
+        (np.empty(shape, np.uint8), np.empty(shape, np.uint8) if to_rgb else None)
+        for _ in range(ring_size)
+    ]
+    free = queue.Queue()
+    for slot in range(ring_size):
+        free.put(slot)
+    decoded = queue.Queue()
+    enhanced = queue.Queue()
+    stop = threading.Event()
+    errors = []
+    timers = {"decode": PhaseTimer(), "filter": PhaseTimer(), "encode": PhaseTimer()}
+    clock = time.perf_counter
+
+    def decode():
+        index = 0
+        timer = timers["decode"]
+        try:
+            while not stop.is_set():
+                began = clock()
+                if not cap.grab():
+                    break
+                timer.record(began, clock(), frames=0)
+                keep = resampler is None or resampler.keeps(index)
+                index += 1
+                if not keep:
+                    continue
+                slot = None
+                while slot is None and not stop.is_set():
+                    try:
+                        slot = free.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                if slot is None:
+                    break
+                bgr = ring[slot][0]
+                began = clock()
+                ret, frame = cap.retrieve(image=bgr)
+                if not ret:
+                    break
+                if frame is not bgr:
+                    # Odd-sized or non-BGR frame: the decoder allocated its own buffer
+                    np.copyto(bgr, _prepare_frame(frame, width, height))
+                timer.record(began, clock())
+                decoded.put(slot)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            decoded.put(None)
+
+    def enhance():
+        timer = timers["filter"]
+        try:
+            while True:
+                slot = decoded.get()
+                if slot is None:
+                    break
+                bgr, rgb = ring[slot]
+                began = clock()
+                chain.apply(bgr)
+                if rgb is not None:
+                    cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=rgb)
+                timer.record(began, clock())
+                enhanced.put(slot)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            enhanced.put(None)
+
+    threads = [
+        threading.Thread(target=decode, name="enhance-decode", daemon=True),
+        threading.Thread(target=enhance, name="enhance-filter", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    written = 0
+    encode_timer = timers["encode"]
+    try:
+        while True:
+            slot = enhanced.get()
+            if slot is None:
+                break
+            bgr, rgb = ring[slot]
+            began = clock()
+            write_frame(rgb if rgb is not None else bgr)
+            encode_timer.record(began, clock())
+            free.put(slot)
+            written += 1
+            if on_batch is not None and written % ring_size == 0:
+                on_batch(written)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    if timings is not None:
+        timings.update(_phase_dicts(timers))
+    return written
+
+
+class _HLSTee:
+    """
+    Frame sink that feeds the main writer (if any) and an HLSWriter. HLS is
+    best effort: if its encoder fails the HLS output is dropped and the main
+    output carries on.
+    """
 
-def enhance_video(video_path, output_path):
+    def __init__(self, write_frame, hls_writer):
+        self.write_frame = write_frame
+        self.hls_writer = hls_writer
+
+    def __call__(self, frame):
+        if self.write_frame is not None:
+            self.write_frame(frame)
+        if self.hls_writer is not None:
+            try:
+                self.hls_writer.append_data(frame)
+            except Exception as e:
+                logger.warning(f"HLS output dropped: {e}")
+                self.abort()
+
+    def finish(self):
+        """Close the HLS writer; returns its renditions, or None if HLS failed."""
+        if self.hls_writer is None:
+            return None
+        try:
+            self.hls_writer.close()
+        except Exception as e:
+            logger.warning(f"HLS output dropped: {e}")
+            self.abort()
+            return None
+        return self.hls_writer.renditions
+
+    def abort(self):
+        if self.hls_writer is not None:
+            self.hls_writer.abort()
+            self.hls_writer = None
+
+
+def _open_hls_writer(hls_output_dir, fps, width, height, rgb):
+    ffmpeg = _ffmpeg_exe()
+    if ffmpeg is None:
+        logger.warning("HLS requested but no ffmpeg binary is available")
+        return None
+    try:
+        return HLSWriter(ffmpeg, hls_output_dir, fps, width, height, pix_fmt_in="rgb24" if rgb else "bgr24")
+    except Exception as e:
+        logger.warning(f"HLS writer failed to start: {e}")
+        return None
+
+
+def enhance_video(video_path, output_path, max_inflight_frames=None, chain=None, target_fps=None,
+                  cap=None, on_progress=None, hls_output_dir=None, input_metadata=None):
     """
-    Enhance video with brightness and contrast adjustments.
-    Tries imageio first, then falls back to OpenCV with multiple codecs.
+    Enhance video with a filter chain (brightness and contrast by default).
+
+    Frames are streamed from the decoder through the enhancement step into an
+    incremental writer by a threaded pipeline whose frame ring holds at most
+    ``max_inflight_frames`` frames, so memory use is independent of the video
+    length. The output is decimated to ``target_fps`` (OUTPUT_FPS by default)
+    without decoding the dropped frames.
+    Uses the first known-good writer from get_writer_backends(); later backends
+    are only tried if that one fails mid-job. An already-open ``cap`` may be
+    passed in to avoid opening the input again. ``on_progress(frames_done,
+    frame_count)`` is called as output frames are written (it should throttle
+    itself); ``frame_count`` is the expected number of output frames.
+    With ``hls_output_dir`` the same frames are also encoded to HLS there as
+    they are produced, so playback can start before the job finishes.
+    ``input_metadata`` (as reported by the metadata stage) is used instead of
+    reading it from the capture.
+
+    Returns a stats dict (frames written, writer used, peak RSS, input and output
+    metadata collected during the single pass, and per-phase timings) on
+    success, or False on failure.
     """
+    if max_inflight_frames is None:
+        max_inflight_frames = MAX_INFLIGHT_FRAMES
+    max_inflight_frames = max(1, int(max_inflight_frames))
+    if chain is None:
+        chain = build_filter_chain()
+    rss = RSSTracker()
+
     try:
         # Check if output directory exists and create if needed
         output_dir = os.path.dirname(output_path)
@@ -50,109 +568,87 @@ def enhance_video(video_path, output_path):
             logger.info(f"Creating output directory: {output_dir}")
             os.makedirs(output_dir, exist_ok=True)
         
-        cap = cv2.VideoCapture(video_path)
+        if cap is None:
+            cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             logger.error(f"Failed to open video: {video_path}")
             return False
 
+        input_metadata = input_metadata or _capture_metadata(cap)
         original_fps = cap.get(cv2.CAP_PROP_FPS)
+        # Decoded frame size, which the writers must match
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        new_fps = 15.0
 
         if original_fps == 0 or width == 0 or height == 0:
             logger.error(f"Invalid video properties: fps={original_fps}, width={width}, height={height}")
             cap.release()
             return False
 
-        logger.info(f"Input video: {width}x{height} @ {original_fps} fps")
+        resampler = FrameResampler(original_fps, OUTPUT_FPS if target_fps is None else target_fps)
+        new_fps = resampler.out_fps
+        logger.info(f"Input video: {width}x{height} @ {original_fps} fps -> {new_fps} fps")
+        expected_frames = resampler.output_count(input_metadata["frame_count"])
+
+        def on_batch(written):
+            rss.sample()
+            if on_progress is not None:
+                on_progress(written, expected_frames)
 
-        # METHOD 1: Try imageio (best Windows support)
-        if IMAGEIO_AVAILABLE:
-            logger.info("Method 1: Trying imageio...")
+        backends = get_writer_backends()
+        if not backends:
+            logger.error("No working writer backend on this host")
+            cap.release()
+            return False
+
+        rewind = False
+        for backend in backends:
             try:
-                frames = []
-                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                frame_count = 0
-                
-                while True:
-                    ret, frame = cap.read()
-                    if not ret:
-                        break
-                    
-                    # Validate and enhance frame
-                    if frame.shape[0] != height or frame.shape[1] != width:
-                        frame = cv2.resize(frame, (width, height))
-                    
-                    # Ensure BGR 3-channel
-                    if len(frame.shape) == 2:
-                        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-                    elif frame.shape[2] == 4:
-                        frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
-                    
-                    # Enhance
-                    enhanced = cv2.convertScaleAbs(frame, alpha=1.2, beta=20)
-                    # Convert BGR to RGB for imageio
-                    enhanced_rgb = cv2.cvtColor(enhanced, cv2.COLOR_BGR2RGB)
-                    frames.append(enhanced_rgb)
-                    frame_count += 1
-                
-                if frames:
-                    # Use MP4 for better compatibility
-                    output_mp4 = output_path.replace('.avi', '.mp4')
-                    logger.info(f"Saving {len(frames)} frames to {output_mp4} using imageio...")
-                    imageio.mimsave(output_mp4, frames, fps=new_fps)
-                    cap.release()
-                    logger.info(f"Successfully saved video with imageio: {len(frames)} frames")
-                    return True
+                writer, needs_rgb, written_path = _open_writer(backend, output_path, new_fps, width, height)
             except Exception as e:
-                logger.warning(f"imageio failed: {e}")
+                logger.warning(f"{backend} failed to open: {e}")
+                continue
 
-        # METHOD 2: Try OpenCV codecs
-        logger.info("Method 2: Trying OpenCV codecs...")
-        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-        
-        for codec in ['MJPG', 'XVID', 'DIVX', 'FFV1']:
+            sink = _HLSTee(writer.append_data, None)
+            if hls_output_dir:
+                sink.hls_writer = _open_hls_writer(hls_output_dir, new_fps, width, height, needs_rgb)
             try:
-                logger.info(f"Trying codec: {codec}")
-                fourcc = cv2.VideoWriter_fourcc(*codec)
-                out = cv2.VideoWriter(output_path, fourcc, new_fps, (width, height))
-                
-                if not out.isOpened():
-                    logger.warning(f"{codec} failed to open")
-                    continue
-                
-                written = 0
-                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                
-                while True:
-                    ret, frame = cap.read()
-                    if not ret:
-                        break
-                    
-                    if frame.shape[0] != height or frame.shape[1] != width:
-                        frame = cv2.resize(frame, (width, height))
-                    
-                    if len(frame.shape) == 2:
-                        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-                    elif frame.shape[2] != 3:
-                        frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
-                    
-                    enhanced = cv2.convertScaleAbs(frame, alpha=1.2, beta=20)
-                    
-                    if out.write(enhanced):
-                        written += 1
-                
-                out.release()
-                
-                if written > 0:
-                    cap.release()
-                    logger.info(f"Successfully saved {written} frames with {codec}")
-                    return True
-                
+                if rewind:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                rewind = True
+                timings = {}
+                written = _run_frame_pipeline(
+                    cap, sink, width, height,
+                    max_inflight_frames, to_rgb=needs_rgb, chain=chain,
+                    resampler=resampler, on_batch=on_batch, timings=timings,
+                )
             except Exception as e:
-                logger.warning(f"{codec} error: {e}")
+                logger.warning(f"{backend} failed: {e}")
+                sink.abort()
                 continue
+            finally:
+                writer.close()
+            rss.sample()
+
+            if written > 0:
+                hls_renditions = sink.finish()
+                cap.release()
+                if on_progress is not None:
+                    on_progress(written, written)
+                logger.info(f"Successfully saved {written} frames with {backend} (peak RSS {rss.peak_mb} MB)")
+                return {
+                    "frames_written": written,
+                    "writer": backend,
+                    "output_fps": new_fps,
+                    "output_path": written_path,
+                    "peak_rss_mb": rss.peak_mb,
+                    "input_metadata": input_metadata,
+                    "output_metadata": _output_metadata(writer.size, new_fps, written),
+                    "hls_renditions": hls_renditions,
+                    "phases": timings,
+                }
+            sink.abort()
+            logger.warning(f"{backend} wrote no frames")
         
         cap.release()
         logger.error("All methods failed to save video")
@@ -164,138 +660,375 @@ def enhance_video(video_path, output_path):
         return False
 
 
-def extract_metadata(video_path):
-    """Extract video metadata safely with error handling."""
+def _ffmpeg_exe():
+    """Locate the ffmpeg binary bundled with imageio-ffmpeg, if any."""
+    if not IMAGEIO_AVAILABLE:
+        return None
     try:
-        cap = cv2.VideoCapture(video_path)
-        
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count / fps if fps > 0 else 0
-        
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return None
+
+
+def _init_pool_worker():
+    # Each pool process owns one core; stop OpenCV from spawning its own threads
+    cv2.setNumThreads(1)
+
+
+def _pool_context():
+    # The pool is started from a job thread while pika's I/O thread and other jobs run;
+    # a forked child could inherit a lock one of them held (logging, OpenCV) and hang
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _get_process_pool(workers):
+    """Return the long-lived process pool used for segment-parallel enhancement."""
+    global _process_pool, _process_pool_size
+    with _process_pool_lock:
+        if _process_pool is None or _process_pool_size != workers:
+            if _process_pool is not None:
+                _process_pool.shutdown(wait=True)
+            _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context(),
+                                                initializer=_init_pool_worker)
+            _process_pool_size = workers
+        return _process_pool
+
+
+def _enhance_segment(video_path, segment_path, start_frame, end_frame, width, height, resampler, chain,
+                     backend):
+    """
+    Enhance frames [start_frame, end_frame) of video_path into segment_path.
+    An end_frame of None reads until the decoder runs dry. Runs in a pool process.
+    Returns (frames written, peak RSS, phase timings).
+    """
+    rss = RSSTracker()
+    timers = {"decode": PhaseTimer(), "filter": PhaseTimer(), "encode": PhaseTimer()}
+    clock = time.perf_counter
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Failed to open video: {video_path}")
+
+    written = 0
+    writer, needs_rgb, _ = _open_writer(backend, segment_path, resampler.out_fps, width, height)
+    try:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+        position = start_frame
+        while end_frame is None or position < end_frame:
+            began = clock()
+            if not cap.grab():
+                break
+            keep = resampler.keeps(position)
+            position += 1
+            if not keep:
+                timers["decode"].record(began, clock(), frames=0)
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            decoded = clock()
+            timers["decode"].record(began, decoded)
+            frame = chain.apply(_prepare_frame(frame, width, height))
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if needs_rgb else frame
+            filtered = clock()
+            timers["filter"].record(decoded, filtered)
+            writer.append_data(frame)
+            timers["encode"].record(filtered, clock())
+            written += 1
+    finally:
+        writer.close()
         cap.release()
-        
+
+    rss.sample()
+    return written, rss.peak, _phase_dicts(timers)
+
+
+def _stream_segment_hls(segment_path, sink):
+    """Decode a finished segment and feed its frames to an HLS-only _HLSTee."""
+    cap = cv2.VideoCapture(segment_path)
+    try:
+        while sink.hls_writer is not None:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            sink(frame)
+    finally:
+        cap.release()
+
+
+def _concat_segments(ffmpeg, segment_paths, output_path):
+    """Join identically encoded segments with ffmpeg's concat demuxer (stream copy, no re-encode)."""
+    list_path = output_path + ".segments.txt"
+    with open(list_path, "w") as f:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    try:
+        subprocess.run(
+            [ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_path, "-c", "copy", "-movflags", "+faststart", output_path],
+            check=True, capture_output=True,
+        )
+    finally:
+        os.remove(list_path)
+
+
+def enhance_video_parallel(video_path, output_path, workers=None, segment_frames=None, chain=None,
+                           target_fps=None, on_progress=None, hls_output_dir=None, input_metadata=None):
+    """
+    Enhance a video by splitting it into frame-range segments, enhancing them in
+    a process pool and stream-copying the results into a single output.
+
+    Falls back to the serial enhance_video for short videos, when only one worker
+    is configured, or when no ffmpeg-based writer or binary is available for the
+    join. Returns the same stats dict as enhance_video, or False on failure.
+    ``on_progress`` is called as whole segments finish. Segments finish out of
+    order; with ``hls_output_dir`` each one is fed to a single HLS encoder as
+    soon as every segment before it is done, so playback can start once the
+    first segments are ready (if that encoder fails to start, HLS is packaged
+    from the joined output instead).
+    With ``input_metadata`` from the metadata stage, segments are planned on
+    its exact frame count.
+    """
+    workers = PARALLEL_WORKERS if workers is None else int(workers)
+    if chain is None:
+        chain = build_filter_chain()
+    segment_frames = SEGMENT_FRAMES if segment_frames is None else int(segment_frames)
+    output_mp4 = output_path.replace('.avi', '.mp4')
+    ffmpeg = _ffmpeg_exe()
+    backend = next((b for b in get_writer_backends() if b in FFMPEG_BACKENDS), None)
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        logger.error(f"Failed to open video: {video_path}")
+        return False
+    input_metadata = input_metadata or _capture_metadata(cap)
+    source_fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = input_metadata["frame_count"]
+
+    if (source_fps <= 0 or workers <= 1 or ffmpeg is None or backend is None
+            or segment_frames <= 0 or frame_count < 2 * segment_frames):
+        # Hand over the open capture so the input is not opened twice
+        return enhance_video(video_path, output_path, chain=chain, target_fps=target_fps, cap=cap,
+                             on_progress=on_progress, hls_output_dir=hls_output_dir,
+                             input_metadata=input_metadata)
+
+    ranges = [(start, start + segment_frames) for start in range(0, frame_count, segment_frames)]
+    # CAP_PROP_FRAME_COUNT is an estimate for some containers; let the last segment run to EOF
+    ranges[-1] = (ranges[-1][0], None)
+    segment_paths = [f"{output_mp4}.part{i:04d}.mp4" for i in range(len(ranges))]
+
+    logger.info(f"Parallel enhancement: {frame_count} frames in {len(ranges)} segments across {workers} workers")
+    resampler = FrameResampler(source_fps, OUTPUT_FPS if target_fps is None else target_fps)
+    rss = RSSTracker()
+    hls = None
+    try:
+        pool = _get_process_pool(workers)
+        futures = [
+            pool.submit(_enhance_segment, video_path, seg_path, start, end, width, height,
+                        resampler, chain, backend)
+            for seg_path, (start, end) in zip(segment_paths, ranges)
+        ]
+        if hls_output_dir:
+            hls = _HLSTee(None, _open_hls_writer(hls_output_dir, resampler.out_fps,
+                                                 *_encoded_size(backend, width, height), rgb=False))
+        expected_frames = resampler.output_count(frame_count)
+        done = 0
+        streamed = 0
+        for future in as_completed(futures):
+            done += future.result()[0]
+            if on_progress is not None:
+                on_progress(done, expected_frames)
+            # Segments finish out of order; HLS takes them in order as the finished prefix grows
+            while hls is not None and hls.hls_writer is not None and streamed < len(futures) \
+                    and futures[streamed].done():
+                _stream_segment_hls(segment_paths[streamed], hls)
+                streamed += 1
+        results = [future.result() for future in futures]
+
+        kept = [path for path, (written, _, _) in zip(segment_paths, results) if written > 0]
+        total = sum(written for written, _, _ in results)
+        if total == 0:
+            logger.error("Parallel enhancement produced no frames")
+            cap.release()
+            return False
+
+        _concat_segments(ffmpeg, kept, output_mp4)
+        cap.release()
+        rss.sample()
+        peak = max([rss.peak] + [peak for _, peak, _ in results])
+        logger.info(f"Successfully saved {total} frames from {len(kept)} segments")
+        hls_renditions = hls.finish() if hls is not None else None
+        if hls_output_dir and hls_renditions is None:
+            try:
+                hls_renditions = package_hls(ffmpeg, output_mp4, hls_output_dir, resampler.out_fps,
+                                             *_encoded_size(backend, width, height))
+            except Exception as e:
+                logger.warning(f"HLS output dropped: {e}")
         return {
-            "fps": round(fps, 2),
-            "width": width,
-            "height": height,
-            "duration": round(duration, 2),
-            "frame_count": frame_count
+            "frames_written": total,
+            "writer": f"{backend}-parallel",
+            "output_fps": resampler.out_fps,
+            "output_path": output_mp4,
+            "segments": len(kept),
+            "peak_rss_mb": round(peak / (1024 * 1024), 1),
+            "input_metadata": input_metadata,
+            "output_metadata": _output_metadata(
+                _encoded_size(backend, width, height), resampler.out_fps, total
+            ),
+            "hls_renditions": hls_renditions,
+            "phases": _merge_phases(phases for _, _, phases in results),
         }
     except Exception as e:
-        logger.error(f"Error extracting metadata from {video_path}: {e}")
-        return {}
+        logger.warning(f"Parallel enhancement failed, falling back to serial: {e}")
+        logger.warning(traceback.format_exc())
+        if hls is not None:
+            hls.abort()
+        # The parent never read from cap, so it is still positioned at frame 0
+        return enhance_video(video_path, output_path, chain=chain, target_fps=target_fps, cap=cap,
+                             on_progress=on_progress, hls_output_dir=hls_output_dir,
+                             input_metadata=input_metadata)
+    finally:
+        for path in segment_paths:
+            if os.path.exists(path):
+                os.remove(path)
 
 
-def callback(ch, method, properties, body):
-    """Process RabbitMQ message with error handling and retries."""
-    try:
-        data = json.loads(body)
-        logger.info(f"Incoming message: {data}")
+def _enhanced_filename(raw_path):
+    return os.path.basename(raw_path).replace(".mp4", "_enhanced.mp4")
+
 
-        raw_path = data.get("filepath")
-        video_id = data.get("video_id")
+def _upstream_metadata(data):
+    """Input metadata the metadata stage already extracted for this job, if usable."""
+    result = (data.get("upstream") or {}).get("metadata") or {}
+    metadata = result.get("metadata")
+    if result.get("error") or not isinstance(metadata, dict):
+        return None
+    if not all(metadata.get(key) for key in ("fps", "width", "height", "frame_count")):
+        return None
+    return metadata
 
-        if not video_id or not raw_path:
-            logger.error("Missing video_id or filepath in message")
-            return
 
-        normalized_path = os.path.normpath(os.path.join(PROJECT_ROOT, raw_path))
-        logger.info(f"Looking for: {normalized_path}")
-        logger.info(f"Current working directory: {os.getcwd()}")
+def process_task(data, attempt=1, progress=None):
+    """
+    Enhance the video described by a task message and return the result to
+    report. Raises PermanentTaskError for tasks that cannot succeed and any
+    other exception for failures worth retrying. ``progress`` receives
+    frame-level progress while the video is enhanced.
+    """
+    logger.info(f"Incoming {STAGE} task for {data.get('video_id')} (attempt {attempt})")
+
+    raw_path = data.get("filepath")
+    video_id = data.get("video_id")
+
+    if not video_id or not raw_path:
+        raise PermanentTaskError("Missing video_id or filepath in message")
+
+    normalized_path = os.path.normpath(os.path.join(PROJECT_ROOT, raw_path))
+    logger.info(f"Looking for: {normalized_path}")
+
+    if not os.path.exists(normalized_path):
+        raise PermanentTaskError(f"Video not found: {normalized_path}")
 
-        if not os.path.exists(normalized_path):
-            logger.error(f"Video not found: {normalized_path}")
-            return
+    # Create output path - use AVI format which has better codec support on Windows
+    enhanced_filename = _enhanced_filename(normalized_path)
+    enhanced_output_path = os.path.join(os.path.dirname(normalized_path), enhanced_filename)
 
+    # Build the per-job filter chain (defaults to brightness/contrast)
+    try:
+        chain = build_filter_chain(data.get("filters"))
+    except ValueError as e:
+        raise PermanentTaskError(f"Invalid filters: {e}") from e
+
+    target_fps = data.get("target_fps")
+    if target_fps is not None:
         try:
-            # Extract metadata from original
-            metadata = extract_metadata(normalized_path)
-            logger.info(f"Original metadata: {metadata}")
-            
-            # Create output path - use AVI format which has better codec support on Windows
-            enhanced_filename = os.path.basename(normalized_path).replace(".mp4", "_enhanced.mp4")
-            enhanced_output_path = os.path.join(os.path.dirname(normalized_path), enhanced_filename)
-
-            # Enhance the video
-            logger.info(f"Starting enhancement for {video_id}")
-            success = enhance_video(normalized_path, enhanced_output_path)
-            
-            if not success:
-                logger.error(f"Video enhancement failed for {video_id}")
-                # Notify backend of failure
-                try:
-                    requests.post(FASTAPI_STATUS_URL, json={
-                        "video_id": video_id,
-                        "metadata": {},
-                        "enhanced_filename": enhanced_filename,
-                        "error": "Enhancement failed - codec unavailable"
-                    }, timeout=5)
-                except Exception as e:
-                    logger.error(f"Failed to notify FastAPI of failure: {e}")
-                return
-
-            # Extract metadata from enhanced video
-            enhanced_metadata = extract_metadata(enhanced_output_path)
-            logger.info(f"Enhanced metadata: {enhanced_metadata}")
-            logger.info(f"Enhancement complete - Saved to: {enhanced_output_path}")
-
-            # Notify FastAPI backend
-            try:
-                res = requests.post(FASTAPI_STATUS_URL, json={
-                    "video_id": video_id,
-                    "metadata": enhanced_metadata,
-                    "enhanced_filename": enhanced_filename
-                }, timeout=10)
-                logger.info(f"Status update response: {res.text}")
-            except Exception as e:
-                logger.error(f"Failed to notify FastAPI: {e}")
-                logger.error(traceback.format_exc())
+            target_fps = float(target_fps)
+        except (TypeError, ValueError):
+            raise PermanentTaskError(f"Invalid target_fps: {target_fps!r}")
 
-        except Exception as e:
-            logger.error(f"Error processing video {video_id}: {e}")
-            logger.error(traceback.format_exc())
+    want_hls = data.get("hls", HLS_BY_DEFAULT)
+    hls_output_dir = hls_dir(os.path.dirname(normalized_path), video_id) if want_hls else None
+
+    # Enhance into a hidden partial file and rename it into place once complete,
+    # so a file under the final name is always finished (the API caches it as immutable)
+    partial_output_path = os.path.join(os.path.dirname(normalized_path), f".partial-{enhanced_filename}")
+    logger.info(f"Starting enhancement for {video_id}")
+    started = time.perf_counter()
+    try:
+        stats = enhance_video_parallel(
+            normalized_path, partial_output_path, chain=chain, target_fps=target_fps, on_progress=progress,
+            hls_output_dir=hls_output_dir, input_metadata=_upstream_metadata(data),
+        )
+        if stats:
+            os.replace(stats["output_path"], enhanced_output_path)
+    finally:
+        if os.path.exists(partial_output_path):
+            os.remove(partial_output_path)
+
+    if not stats:
+        raise RuntimeError(f"Video enhancement failed for {video_id} - codec unavailable")
+    elapsed = time.perf_counter() - started
+    ENHANCEMENT_DURATION.observe(elapsed)
+    ENHANCEMENT_FRAMES.inc(stats["frames_written"])
+    if elapsed > 0 and stats["input_metadata"].get("frame_count"):
+        ENHANCEMENT_FPS.observe(stats["input_metadata"]["frame_count"] / elapsed)
+    trace = current_trace()
+    if trace is not None:
+        for name, phase in stats.get("phases", {}).items():
+            trace.add(name, phase["start"], phase["end"],
+                      busy_seconds=round(phase["busy"], 4), frames=phase["frames"])
+
+    # Input and output metadata come from the single decode/encode pass
+    logger.info(f"Original metadata: {stats['input_metadata']}")
+    enhanced_metadata = dict(stats["output_metadata"])
+    enhanced_metadata["peak_rss_mb"] = stats["peak_rss_mb"]
+    if stats.get("hls_renditions"):
+        enhanced_metadata["hls"] = hls_metadata(video_id, stats["hls_renditions"])
+    logger.info(f"Enhanced metadata: {enhanced_metadata}")
+    logger.info(f"Enhancement complete - Saved to: {enhanced_output_path}")
+
+    return {
+        "video_id": video_id,
+        "metadata": enhanced_metadata,
+        "enhanced_filename": enhanced_filename
+    }
 
-    except Exception as err:
-        logger.error(f"Error in callback: {err}")
-        logger.error(f"Raw message body: {body}")
-        logger.error(traceback.format_exc())
+
+def give_up(data, error):
+    """Failure result for a task that will not be retried any more."""
+    video_id = data.get("video_id")
+    if not video_id:
+        return None
+    return {
+        "video_id": video_id,
+        "metadata": {},
+        "enhanced_filename": _enhanced_filename(data.get("filepath") or ""),
+        "error": error
+    }
+
+
+def callback(ch, method, properties, body):
+    """Process a RabbitMQ delivery; acked on success, retried or dead-lettered on failure."""
+    handle_delivery(ch, method, properties, body, STAGE, process_task,
+                    on_give_up=give_up, status_url=FASTAPI_STATUS_URL)
 
 
 def main():
-    """Main worker loop with reconnection handling."""
-    while True:
-        try:
-            logger.info("Connecting to RabbitMQ...")
-            connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST, heartbeat=600))
-            channel = connection.channel()
-            
-            # Declare exchange and queue
-            exchange = channel.exchange_declare(exchange='video_tasks', exchange_type='fanout')
-            result = channel.queue_declare(queue='', exclusive=True)
-            queue_name = result.method.queue
-
-            channel.queue_bind(exchange='video_tasks', queue=queue_name)
-            channel.basic_qos(prefetch_count=1)
-
-            logger.info("[Enhancement Worker is ready] Waiting for tasks...")
-            channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-            channel.start_consuming()
-
-        except pika.exceptions.AMQPConnectionError:
-            logger.error("RabbitMQ connection failed, retrying in 5 seconds...")
-            import time
-            time.sleep(5)
-        except KeyboardInterrupt:
-            logger.info("Worker stopped by user")
-            break
-        except Exception as e:
-            logger.error(f"Unexpected error in main loop: {e}")
-            logger.error(traceback.format_exc())
-            import time
-            time.sleep(5)
+    """Supervise one or more consumer processes for the enhancement stage."""
+    global PARALLEL_WORKERS
+    args = parse_worker_args("Video enhancement worker")
+    if args.processes > 1 and "ENHANCE_PARALLEL_WORKERS" not in os.environ:
+        # Split the cores between the job processes' segment pools
+        PARALLEL_WORKERS = max(1, (os.cpu_count() or 1) // args.processes)
+        os.environ["ENHANCE_PARALLEL_WORKERS"] = str(PARALLEL_WORKERS)
+    # Probe encoders once up front so every job starts on a known-good writer
+    get_writer_backends()
+    supervise(STAGE, process_task, on_give_up=give_up, processes=args.processes,
+              prefetch=args.prefetch, status_url=FASTAPI_STATUS_URL, metrics_port=args.metrics_port)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,174 @@
+#workers\hls.py
+
+"""
+HLS packaging for enhanced videos.
+
+``HLSWriter`` takes the enhanced frames as they leave the pipeline and pipes
+them to one ffmpeg process that scales them to every rendition, encodes with
+keyframes on segment boundaries and writes an EVENT playlist per rendition
+plus a master playlist, so segments can be played while the rest of the video
+is still being enhanced. ``package_hls`` does the same from a finished file.
+
+Layout under ``<storage>/hls/<video_id>/``::
+
+    master.m3u8
+    <rendition>/index.m3u8
+    <rendition>/seg_00000.ts ...
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+# Rendition heights, highest first; heights above the source are skipped
+HLS_RENDITIONS = [int(h) for h in os.environ.get("HLS_RENDITIONS", "720,360").split(",") if h.strip()]
+HLS_SEGMENT_SECONDS = float(os.environ.get("HLS_SEGMENT_SECONDS", "4"))
+# Target bits per pixel per frame used to size each rendition's bitrate
+HLS_BITS_PER_PIXEL = float(os.environ.get("HLS_BITS_PER_PIXEL", "0.1"))
+HLS_DIRNAME = "hls"
+MASTER_PLAYLIST = "master.m3u8"
+
+logger = logging.getLogger(__name__)
+
+
+def hls_dir(storage_path, video_id):
+    return os.path.join(storage_path, HLS_DIRNAME, video_id)
+
+
+def master_playlist_path(video_id):
+    """Master playlist path relative to the storage directory (as served by the API)."""
+    return f"{HLS_DIRNAME}/{video_id}/{MASTER_PLAYLIST}"
+
+
+def plan_renditions(width, height, fps, heights=None):
+    """
+    (name, width, height, kbps) for each rendition not taller than the source.
+    The source height is used on its own if every requested height is larger.
+    """
+    heights = HLS_RENDITIONS if heights is None else heights
+    chosen = sorted({h for h in heights if 0 < h <= height}, reverse=True) or [height]
+    renditions = []
+    for h in chosen:
+        h -= h % 2
+        w = max(2, int(round(width * h / height / 2)) * 2)
+        kbps = max(200, int(w * h * fps * HLS_BITS_PER_PIXEL / 1000))
+        renditions.append((f"{h}p", w, h, kbps))
+    return renditions
+
+
+def _hls_command(ffmpeg, input_args, out_dir, fps, renditions, segment_seconds):
+    gop = max(1, int(round(fps * segment_seconds)))
+    count = len(renditions)
+    split = f"[0:v]split={count}" + "".join(f"[s{i}]" for i in range(count))
+    scales = [f"[s{i}]scale={w}:{h}[o{i}]" for i, (_, w, h, _) in enumerate(renditions)]
+
+    cmd = [ffmpeg, "-y", "-loglevel", "error", *input_args,
+           "-filter_complex", ";".join([split] + scales)]
+    for i, (_, _, _, kbps) in enumerate(renditions):
+        cmd += ["-map", f"[o{i}]",
+                f"-b:v:{i}", f"{kbps}k", f"-maxrate:v:{i}", f"{int(kbps * 1.5)}k",
+                f"-bufsize:v:{i}", f"{kbps * 2}k"]
+    cmd += [
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        # Fixed GOP aligned to the segment length so every segment starts on a keyframe
+        "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_playlist_type", "event",
+        "-hls_flags", "independent_segments+temp_file",
+        "-hls_segment_filename", os.path.join(out_dir, "%v", "seg_%05d.ts"),
+        "-master_pl_name", MASTER_PLAYLIST,
+        "-var_stream_map", " ".join(f"v:{i},name:{name}" for i, (name, _, _, _) in enumerate(renditions)),
+        os.path.join(out_dir, "%v", "index.m3u8"),
+    ]
+    return cmd
+
+
+def _reset_dir(out_dir):
+    # A retried job must not leave segments from the previous attempt in the playlists
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+
+
+def _ffmpeg_error(stderr_file):
+    stderr_file.seek(0)
+    return stderr_file.read().decode(errors="replace").strip()[-500:]
+
+
+class HLSWriter:
+    """Incremental HLS writer with the append_data/close interface of the video writers."""
+
+    def __init__(self, ffmpeg, out_dir, fps, width, height, pix_fmt_in="bgr24",
+                 heights=None, segment_seconds=None):
+        segment_seconds = segment_seconds or HLS_SEGMENT_SECONDS
+        self.out_dir = out_dir
+        self.renditions = plan_renditions(width, height, fps, heights)
+        self._frame_bytes = width * height * 3
+        _reset_dir(out_dir)
+        input_args = ["-f", "rawvideo", "-pix_fmt", pix_fmt_in, "-s", f"{width}x{height}",
+                      "-r", f"{fps:.6g}", "-i", "-"]
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(
+            _hls_command(ffmpeg, input_args, out_dir, fps, self.renditions, segment_seconds),
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr,
+        )
+
+    def append_data(self, frame):
+        if frame.nbytes != self._frame_bytes:
+            raise ValueError(f"HLS frame has {frame.nbytes} bytes, expected {self._frame_bytes}")
+        try:
+            self._proc.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            self._proc.wait()
+            raise RuntimeError(f"HLS encoder exited: {_ffmpeg_error(self._stderr)}")
+
+    def close(self):
+        """Finish the playlists; raises RuntimeError if ffmpeg failed."""
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = proc.wait()
+        error = _ffmpeg_error(self._stderr)
+        self._stderr.close()
+        if returncode != 0:
+            raise RuntimeError(f"HLS encoder failed ({returncode}): {error}")
+
+    def abort(self):
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        proc.kill()
+        proc.wait()
+        self._stderr.close()
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+
+def package_hls(ffmpeg, video_path, out_dir, fps, width, height, heights=None, segment_seconds=None):
+    """Package a finished video as HLS; returns the renditions written."""
+    segment_seconds = segment_seconds or HLS_SEGMENT_SECONDS
+    renditions = plan_renditions(width, height, fps, heights)
+    _reset_dir(out_dir)
+    result = subprocess.run(
+        _hls_command(ffmpeg, ["-i", video_path], out_dir, fps, renditions, segment_seconds),
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise RuntimeError(f"HLS packaging failed: {result.stderr.decode(errors='replace')[-500:]}")
+    return renditions
+
+
+def hls_metadata(video_id, renditions):
+    """Description of the HLS output reported with the enhancement result."""
+    return {
+        "playlist": master_playlist_path(video_id),
+        "renditions": [{"name": name, "width": w, "height": h, "kbps": kbps} for name, w, h, kbps in renditions],
+    }
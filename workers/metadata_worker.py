@@ -1,12 +1,17 @@
 #workers\metadata_worker.py
 
-import pika
-import json
-import requests
 import os
 import cv2
 import logging
+import threading
+import time
 import traceback
+from collections import OrderedDict
+
+from worker_metrics import METADATA_DURATION
+from worker_tracing import span
+from mp4_probe import probe_mp4
+from task_queue import PermanentTaskError, handle_delivery, parse_worker_args, stage_queue_name, supervise
 
 # Configure logging
 logging.basicConfig(
@@ -19,8 +24,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-RABBITMQ_HOST = 'localhost'
-QUEUE_NAME = 'video_tasks'
+STAGE = 'metadata'
+QUEUE_NAME = stage_queue_name(STAGE)
+# Used only by the HTTP result transport (RESULT_TRANSPORT=http)
 FASTAPI_STATUS_URL = 'http://localhost:8000/internal/metadata-extraction-status'
 
 # Ensure absolute path to storage
@@ -30,9 +36,47 @@ STORAGE_PATH = os.path.abspath(os.path.join(PROJECT_ROOT, "static", "storage"))
 # Ensure storage directory exists
 os.makedirs(STORAGE_PATH, exist_ok=True)
 
+# Metadata by (device, inode, size, mtime); jobs run on several threads
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "1024"))
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
+
+def _file_identity(video_path):
+    """Cache key that changes whenever the file is replaced or rewritten."""
+    st = os.stat(video_path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _opencv_metadata(video_path):
+    """Decoder-based fallback for containers the MP4 parser does not handle."""
+    cap = cv2.VideoCapture(video_path)
+
+    if not cap.isOpened():
+        logger.error(f"Failed to open video: {video_path}")
+        return {}
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    duration = frame_count / fps if fps > 0 else 0
+
+    cap.release()
+
+    return {
+        "fps": round(fps, 2) if fps > 0 else 0,
+        "width": width,
+        "height": height,
+        "duration": round(duration, 2),
+        "frame_count": frame_count
+    }
+
+
 def extract_metadata(video_path):
     """
     Extract video metadata with error handling.
+    MP4/MOV headers are parsed directly; other containers go through OpenCV.
+    Results are cached by file identity, so repeat lookups skip the file.
     Returns metadata dictionary or empty dict on error.
     """
     try:
@@ -40,118 +84,95 @@ def extract_metadata(video_path):
             logger.error(f"Video file not found: {video_path}")
             return {}
 
-        cap = cv2.VideoCapture(video_path)
-        
-        if not cap.isOpened():
-            logger.error(f"Failed to open video: {video_path}")
-            return {}
-
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        duration = frame_count / fps if fps > 0 else 0
-
-        cap.release()
-
-        metadata = {
-            "fps": round(fps, 2) if fps > 0 else 0,
-            "width": width,
-            "height": height,
-            "duration": round(duration, 2),
-            "frame_count": frame_count
-        }
-        
-        logger.info(f"Extracted metadata: {metadata}")
-        return metadata
+        started = time.perf_counter()
+        identity = _file_identity(video_path)
+        with _metadata_cache_lock:
+            metadata = _metadata_cache.get(identity)
+            if metadata is not None:
+                _metadata_cache.move_to_end(identity)
+        if metadata is not None:
+            METADATA_DURATION.labels("cache").observe(time.perf_counter() - started)
+            logger.info(f"Metadata cache hit: {metadata}")
+            return dict(metadata)
+
+        metadata = probe_mp4(video_path)
+        source = "mp4"
+        if metadata is None:
+            metadata = _opencv_metadata(video_path)
+            source = "opencv"
+        METADATA_DURATION.labels(source).observe(time.perf_counter() - started)
+
+        if metadata:
+            with _metadata_cache_lock:
+                _metadata_cache[identity] = metadata
+                while len(_metadata_cache) > METADATA_CACHE_SIZE:
+                    _metadata_cache.popitem(last=False)
+
+        logger.info(f"Extracted metadata ({source}): {metadata}")
+        return dict(metadata)
         
     except Exception as e:
         logger.error(f"Error extracting metadata from {video_path}: {e}")
         logger.error(traceback.format_exc())
         return {}
 
-
-def callback(ch, method, properties, body):
+def process_task(data, attempt=1, progress=None):
     """
-    Process RabbitMQ message with error handling.
+    Extract metadata for the video described by a task message and return the
+    result to report. Raises PermanentTaskError for tasks that cannot succeed.
+    Extraction is a single short read, so ``progress`` is not used.
     """
-    try:
-        data = json.loads(body)
-        logger.info(f"Incoming message: {data}")
-
-        raw_path = data.get("filepath")
-        video_id = data.get("video_id")
-
-        if not video_id or not raw_path:
-            logger.error("Missing video_id or filepath in message")
-            return
-
-        # Get just the filename and look in storage directory
-        filename = os.path.basename(raw_path)
-        normalized_path = os.path.normpath(os.path.join(STORAGE_PATH, filename))
-
-        logger.info(f"Looking for: {normalized_path}")
-        logger.info(f"Current working directory: {os.getcwd()}")
-
-        if os.path.exists(normalized_path):
-            metadata = extract_metadata(normalized_path)
-            
-            if metadata:
-                try:
-                    res = requests.post(FASTAPI_STATUS_URL, json={
-                        "video_id": video_id,
-                        "metadata": metadata
-                    }, timeout=10)
-                    logger.info(f"Status update response: {res.text}")
-                except Exception as e:
-                    logger.error(f"Failed to notify FastAPI: {e}")
-                    logger.error(traceback.format_exc())
-            else:
-                logger.error(f"Failed to extract metadata from {normalized_path}")
-        else:
-            logger.error(f"Video not found: {normalized_path}")
-
-    except json.JSONDecodeError:
-        logger.error("Failed to parse JSON from RabbitMQ message")
-        logger.error(f"Raw message body: {body}")
-    except Exception as err:
-        logger.error(f"Error in callback: {err}")
-        logger.error(f"Raw message body: {body}")
-        logger.error(traceback.format_exc())
+    logger.info(f"Incoming {STAGE} task for {data.get('video_id')} (attempt {attempt})")
+
+    raw_path = data.get("filepath")
+    video_id = data.get("video_id")
+
+    if not video_id or not raw_path:
+        raise PermanentTaskError("Missing video_id or filepath in message")
+
+    # Get just the filename and look in storage directory
+    filename = os.path.basename(raw_path)
+    normalized_path = os.path.normpath(os.path.join(STORAGE_PATH, filename))
+
+    logger.info(f"Looking for: {normalized_path}")
+
+    if not os.path.exists(normalized_path):
+        raise PermanentTaskError(f"Video not found: {normalized_path}")
+
+    with span("extract"):
+        metadata = extract_metadata(normalized_path)
+    if not metadata:
+        raise RuntimeError(f"Failed to extract metadata from {normalized_path}")
+
+    return {
+        "video_id": video_id,
+        "metadata": metadata
+    }
+
+
+def give_up(data, error):
+    """Failure result for a task that will not be retried any more."""
+    video_id = data.get("video_id")
+    if not video_id:
+        return None
+    return {
+        "video_id": video_id,
+        "metadata": {},
+        "error": error
+    }
+
+
+def callback(ch, method, properties, body):
+    """Process a RabbitMQ delivery; acked on success, retried or dead-lettered on failure."""
+    handle_delivery(ch, method, properties, body, STAGE, process_task,
+                    on_give_up=give_up, status_url=FASTAPI_STATUS_URL)
 
 
 def main():
-    """Main worker loop with reconnection handling."""
-    while True:
-        try:
-            logger.info("Connecting to RabbitMQ...")
-            connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST, heartbeat=600))
-            channel = connection.channel()
-            
-            # Declare exchange and queue
-            exchange = channel.exchange_declare(exchange='video_tasks', exchange_type='fanout')
-            result = channel.queue_declare(queue='', exclusive=True)
-            queue_name = result.method.queue
-
-            channel.queue_bind(exchange='video_tasks', queue=queue_name)
-            channel.basic_qos(prefetch_count=1)
-
-            logger.info("[Metadata Worker is ready] Waiting for tasks...")
-            channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=True)
-            channel.start_consuming()
-
-        except pika.exceptions.AMQPConnectionError:
-            logger.error("RabbitMQ connection failed, retrying in 5 seconds...")
-            import time
-            time.sleep(5)
-        except KeyboardInterrupt:
-            logger.info("Worker stopped by user")
-            break
-        except Exception as e:
-            logger.error(f"Unexpected error in main loop: {e}")
-            logger.error(traceback.format_exc())
-            import time
-            time.sleep(5)
+    """Supervise one or more consumer processes for the metadata stage."""
+    args = parse_worker_args("Metadata extraction worker")
+    supervise(STAGE, process_task, on_give_up=give_up, processes=args.processes,
+              prefetch=args.prefetch, status_url=FASTAPI_STATUS_URL, metrics_port=args.metrics_port)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,173 @@
+#workers\mp4_probe.py
+
+"""
+Minimal MP4/MOV header parser.
+
+Reads fps, dimensions, duration and frame count straight from the ``moov``
+box (mvhd, tkhd, mdhd, hdlr, stts, stsz, stsd) through ``mmap``, so only the
+pages holding the header are ever read, wherever ``moov`` sits in the file.
+The frame count comes from the sample tables and is exact, unlike
+``CAP_PROP_FRAME_COUNT``. Anything that is not a plain ISO-BMFF file with a
+video track (other containers, fragmented MP4) yields None so the caller can
+fall back to a decoder.
+"""
+
+import mmap
+import struct
+
+# Boxes whose children we descend into
+CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+FILE_BRAND_BOXES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"uuid", b"pnot"}
+
+
+def _iter_boxes(buf, start, end):
+    """Yield (type, content_start, box_end) for the boxes in buf[start:end]."""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from(">Q", buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _find(buf, start, end, box_type):
+    for found, content, box_end in _iter_boxes(buf, start, end):
+        if found == box_type:
+            return content, box_end
+    return None
+
+
+def _timescale_and_duration(buf, content):
+    """mvhd/mdhd: (timescale, duration) for version 0 or 1."""
+    version = buf[content]
+    if version == 1:
+        return struct.unpack_from(">IQ", buf, content + 20)
+    return struct.unpack_from(">II", buf, content + 12)
+
+
+def _stsd_dimensions(buf, content, end):
+    """Coded width/height from the first visual sample entry."""
+    entry = content + 8
+    if entry + 36 > end:
+        return 0, 0
+    return struct.unpack_from(">HH", buf, entry + 32)
+
+
+def _parse_video_track(buf, trak_start, trak_end):
+    mdia = _find(buf, trak_start, trak_end, b"mdia")
+    if mdia is None:
+        return None
+    hdlr = _find(buf, *mdia, b"hdlr")
+    if hdlr is None or buf[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+        return None
+
+    track = {"width": 0, "height": 0, "timescale": 0, "duration": 0, "frames": 0, "ticks": 0}
+    tkhd = _find(buf, trak_start, trak_end, b"tkhd")
+    if tkhd is not None and tkhd[1] - tkhd[0] >= 84:
+        # 16.16 fixed-point width and height close every tkhd version
+        width, height = struct.unpack_from(">II", buf, tkhd[1] - 8)
+        track["width"], track["height"] = width >> 16, height >> 16
+
+    mdhd = _find(buf, *mdia, b"mdhd")
+    if mdhd is not None:
+        track["timescale"], track["duration"] = _timescale_and_duration(buf, mdhd[0])
+
+    minf = _find(buf, *mdia, b"minf")
+    stbl = _find(buf, *minf, b"stbl") if minf else None
+    if stbl is None:
+        return track
+
+    stts = _find(buf, *stbl, b"stts")
+    if stts is not None:
+        entry_count = struct.unpack_from(">I", buf, stts[0] + 4)[0]
+        entries_end = min(stts[0] + 8 + entry_count * 8, stts[1])
+        for count, delta in struct.iter_unpack(">II", buf[stts[0] + 8:entries_end]):
+            track["frames"] += count
+            track["ticks"] += count * delta
+
+    stsz = _find(buf, *stbl, b"stsz")
+    if stsz is not None:
+        sample_count = struct.unpack_from(">I", buf, stsz[0] + 8)[0]
+        if sample_count:
+            track["frames"] = sample_count
+
+    if not track["width"] or not track["height"]:
+        stsd = _find(buf, *stbl, b"stsd")
+        if stsd is not None:
+            track["width"], track["height"] = _stsd_dimensions(buf, *stsd)
+    return track
+
+
+def _parse(buf):
+    size = len(buf)
+    first = _iter_boxes(buf, 0, size)
+    try:
+        box_type, _, _ = next(first)
+    except StopIteration:
+        return None
+    if box_type not in FILE_BRAND_BOXES:
+        return None
+
+    moov = _find(buf, 0, size, b"moov")
+    if moov is None:
+        return None
+
+    movie_timescale, movie_duration = 0, 0
+    mvhd = _find(buf, *moov, b"mvhd")
+    if mvhd is not None:
+        movie_timescale, movie_duration = _timescale_and_duration(buf, mvhd[0])
+
+    for box_type, content, box_end in _iter_boxes(buf, *moov):
+        if box_type != b"trak":
+            continue
+        track = _parse_video_track(buf, content, box_end)
+        if track is None:
+            continue
+        if not track["frames"] or not track["width"] or not track["height"]:
+            # Fragmented MP4 keeps its samples in moof boxes; let the decoder handle it
+            return None
+
+        timescale = track["timescale"] or movie_timescale
+        ticks = track["ticks"] or track["duration"]
+        if timescale and ticks:
+            duration = ticks / timescale
+        elif movie_timescale:
+            duration = movie_duration / movie_timescale
+        else:
+            duration = 0
+        fps = track["frames"] / duration if duration > 0 else 0
+        return {
+            "fps": round(fps, 2),
+            "width": track["width"],
+            "height": track["height"],
+            "duration": round(duration, 2),
+            "frame_count": track["frames"],
+        }
+    return None
+
+
+def probe_mp4(path):
+    """
+    Metadata for an MP4/MOV file in the metadata worker's format, or None if
+    the file is not a container this parser understands.
+    """
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return None
+    try:
+        return _parse(buf)
+    except (struct.error, IndexError):
+        return None
+    finally:
+        buf.close()
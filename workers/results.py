@@ -0,0 +1,143 @@
+#workers\results.py
+
+"""
+Result reporting from the workers back to the API.
+
+By default results are published to the durable ``video_results`` exchange
+on the same channel the task arrived on, just before the task is acked, and
+the API consumes them in batches. Setting RESULT_TRANSPORT=http falls back to
+POSTing each result to the API's /internal endpoints through a pooled
+``requests.Session`` with retry and backoff.
+
+Progress events go to the ``video_progress`` exchange as transient messages;
+they are throttled per job here and may be dropped by the broker or the API.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import pika
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RESULTS_EXCHANGE = 'video_results'
+PROGRESS_EXCHANGE = 'video_progress'
+# Minimum seconds between progress events for one job
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "0.5"))
+# "amqp" (default) or "http"
+RESULT_TRANSPORT = os.environ.get("RESULT_TRANSPORT", "amqp").lower()
+HTTP_RETRIES = int(os.environ.get("RESULT_HTTP_RETRIES", "5"))
+HTTP_BACKOFF = float(os.environ.get("RESULT_HTTP_BACKOFF", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def declare_results_exchange(channel):
+    channel.exchange_declare(exchange=RESULTS_EXCHANGE, exchange_type='fanout', durable=True)
+
+
+def publish_result(channel, result):
+    """Publish a result on a (connection-thread) pika channel as a persistent message."""
+    channel.basic_publish(
+        exchange=RESULTS_EXCHANGE,
+        routing_key=result.get("stage", ""),
+        body=json.dumps(result).encode(),
+        properties=pika.BasicProperties(content_type="application/json", delivery_mode=2),
+    )
+
+
+def declare_progress_exchange(channel):
+    channel.exchange_declare(exchange=PROGRESS_EXCHANGE, exchange_type='fanout', durable=True)
+
+
+def publish_progress(channel, event):
+    """Publish a progress event as a transient message; failures are only logged."""
+    if not channel.is_open:
+        return
+    try:
+        channel.basic_publish(
+            exchange=PROGRESS_EXCHANGE,
+            routing_key=event.get("stage", ""),
+            body=json.dumps(event).encode(),
+            properties=pika.BasicProperties(content_type="application/json", delivery_mode=1),
+        )
+    except Exception as e:
+        logger.warning(f"Failed to publish progress: {e}")
+
+
+class ProgressReporter:
+    """
+    Per-job progress callback, ``reporter(frames_done, frame_count)``.
+
+    Emits at most one event every ``interval`` seconds, plus the final one
+    (``frames_done >= frame_count``), with the processing rate and an ETA.
+    A ``frame_count`` of 0 means the total is unknown.
+    """
+
+    def __init__(self, emit, video_id, stage, interval=PROGRESS_INTERVAL):
+        self.emit = emit
+        self.video_id = video_id
+        self.stage = stage
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_emit = None
+
+    def __call__(self, frames_done, frame_count):
+        now = time.monotonic()
+        final = frame_count > 0 and frames_done >= frame_count
+        if not final and self.last_emit is not None and now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+
+        elapsed = now - self.started
+        fps = frames_done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if frame_count > 0 and fps > 0:
+            eta = round(max(0, frame_count - frames_done) / fps, 1)
+        self.emit({
+            "type": "progress",
+            "video_id": self.video_id,
+            "stage": self.stage,
+            "frames_done": frames_done,
+            "frame_count": frame_count,
+            "percent": round(100.0 * min(frames_done, frame_count) / frame_count, 1) if frame_count > 0 else None,
+            "fps": round(fps, 1),
+            "eta_seconds": eta,
+        })
+
+
+def http_session():
+    """Process-wide session: keeps connections to the API alive and retries with backoff."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"POST"}),
+            )
+            session = requests.Session()
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=8)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def post_result(url, result, timeout=10):
+    """HTTP fallback: POST a result to the API, retrying transient failures."""
+    try:
+        res = http_session().post(url, json=result, timeout=timeout)
+        logger.info(f"Status update response: {res.text}")
+        return res.ok
+    except Exception as e:
+        logger.error(f"Failed to notify FastAPI: {e}")
+        return False
@@ -0,0 +1,335 @@
+#workers\task_queue.py
+
+"""
+Shared RabbitMQ topology and ack handling for the pipeline workers.
+
+Every stage consumes from one named, durable quorum queue,
+``video_tasks.<stage>``. The API publishes each job's stages straight to
+these queues (through the default exchange) as their upstream stages finish,
+so replicas of a worker compete for tasks instead of each receiving a copy.
+Tasks are acked only after they succeed; a crash or error returns them to
+the queue, and after MAX_DELIVERIES failed attempts the broker dead-letters
+them to ``<queue>.dead``. ``supervise`` runs several consumer processes per
+host; each runs its jobs off the connection thread.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+
+from worker_metrics import METRICS_PORT, TASK_DURATION, TASK_QUEUE_WAIT, TASKS_IN_PROGRESS, serve_metrics
+from worker_tracing import TaskTrace, activate
+from results import (
+    RESULT_TRANSPORT, ProgressReporter, declare_progress_exchange, declare_results_exchange,
+    post_result, publish_progress, publish_result,
+)
+
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
+TASK_QUEUE_PREFIX = 'video_tasks'
+DEAD_LETTER_EXCHANGE = 'video_tasks.dlx'
+# Jobs run off the connection thread, so heartbeats keep flowing during long jobs
+RABBITMQ_HEARTBEAT = int(os.environ.get("RABBITMQ_HEARTBEAT", "60"))
+# Deliveries a task gets before it is dead-lettered
+MAX_DELIVERIES = int(os.environ.get("TASK_MAX_DELIVERIES", "3"))
+# Consumer processes per host and unacked tasks (= concurrent jobs) per process
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))
+WORKER_PREFETCH = int(os.environ.get("WORKER_PREFETCH", "1"))
+
+ACK, REQUEUE, REJECT = "ack", "requeue", "reject"
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentTaskError(Exception):
+    """The task can never succeed (bad message, missing input); dead-letter it right away."""
+
+
+def stage_queue_name(stage):
+    return f"{TASK_QUEUE_PREFIX}.{stage}"
+
+
+def declare_stage_queue(channel, stage):
+    """Declare the shared work queue for a stage (plus its dead-letter queue) and return its name."""
+    queue_name = stage_queue_name(stage)
+    dead_queue = f"{queue_name}.dead"
+
+    channel.exchange_declare(exchange=DEAD_LETTER_EXCHANGE, exchange_type='direct', durable=True)
+
+    channel.queue_declare(queue=dead_queue, durable=True)
+    channel.queue_bind(exchange=DEAD_LETTER_EXCHANGE, queue=dead_queue, routing_key=stage)
+
+    channel.queue_declare(queue=queue_name, durable=True, arguments={
+        # Quorum queues count redeliveries, including those caused by a consumer crash
+        'x-queue-type': 'quorum',
+        'x-delivery-limit': max(0, MAX_DELIVERIES - 1),
+        'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE,
+        'x-dead-letter-routing-key': stage,
+    })
+    return queue_name
+
+
+def delivery_attempt(properties):
+    """1-based attempt number of this delivery, from the quorum queue's x-delivery-count."""
+    headers = (properties.headers if properties else None) or {}
+    return int(headers.get('x-delivery-count', 0)) + 1
+
+
+def run_task(stage, properties, body, process, on_give_up=None, emit_progress=None):
+    """
+    Run ``process(data, attempt, progress)`` for one delivery and decide how to settle it.
+
+    Returns ``(outcome, result)``. On success the outcome is ACK and the result
+    is whatever ``process`` returned. PermanentTaskError, or any error on the
+    final attempt, gives REJECT (dead-letter) with the failure result built by
+    ``on_give_up(data, error)``. Any other error gives REQUEUE so another
+    replica can retry. Results are tagged with ``stage``.
+
+    ``progress`` is a ProgressReporter feeding ``emit_progress``, or None when
+    progress is not being reported. Queue wait, run time and tasks in
+    progress are recorded in the worker metrics. When the task carries a
+    traceparent header, its spans are returned in the result's ``trace``
+    (requeued attempts send none back).
+    """
+    headers = (properties.headers if properties else None) or {}
+    attempt = delivery_attempt(properties)
+    if attempt == 1:
+        _observe_queue_wait(stage, headers)
+    trace = TaskTrace(stage, headers)
+    in_progress = TASKS_IN_PROGRESS.labels(stage)
+    in_progress.inc()
+    started = time.perf_counter()
+    outcome = REQUEUE
+    try:
+        with activate(trace):
+            outcome, result = _attempt(stage, attempt, body, process, on_give_up, emit_progress)
+        if result is not None and trace.enabled:
+            result["trace"] = trace.finish(outcome)
+        return outcome, result
+    finally:
+        in_progress.dec()
+        TASK_DURATION.labels(stage, outcome).observe(time.perf_counter() - started)
+
+
+def _observe_queue_wait(stage, headers):
+    published_at = headers.get('x-published-at')
+    if isinstance(published_at, (int, float)):
+        TASK_QUEUE_WAIT.labels(stage).observe(max(0.0, time.time() - published_at))
+
+
+def _attempt(stage, attempt, body, process, on_give_up, emit_progress):
+    data = None
+    try:
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError as e:
+            raise PermanentTaskError(f"Failed to parse JSON from RabbitMQ message: {e}") from e
+        progress = None
+        if emit_progress is not None and isinstance(data, dict):
+            progress = ProgressReporter(emit_progress, data.get("video_id"), stage)
+        result = process(data, attempt, progress)
+    except Exception as e:
+        permanent = isinstance(e, PermanentTaskError) or attempt >= MAX_DELIVERIES
+        if permanent:
+            logger.error(f"Giving up on task after attempt {attempt}: {e}")
+        else:
+            logger.warning(f"Task failed on attempt {attempt}/{MAX_DELIVERIES}, requeueing: {e}")
+        logger.error(f"Raw message body: {body}")
+        logger.error(traceback.format_exc())
+
+        if not permanent:
+            return REQUEUE, None
+        result = None
+        if on_give_up is not None and isinstance(data, dict):
+            try:
+                result = on_give_up(data, str(e))
+            except Exception as notify_error:
+                logger.error(f"Failed to report abandoned task: {notify_error}")
+        return REJECT, _tag_result(result, stage)
+    return ACK, _tag_result(result, stage)
+
+
+def _tag_result(result, stage):
+    if result is not None:
+        result.setdefault("stage", stage)
+    return result
+
+
+def settle(ch, delivery_tag, outcome, result=None):
+    """
+    Publish the task's result (if any) and then apply the outcome, in that
+    order on the same channel. Must be called on the connection's thread.
+    """
+    if not ch.is_open:
+        # The broker already requeued everything unacked on this channel
+        logger.warning(f"Channel closed before delivery {delivery_tag} could be settled")
+        return
+    if result is not None:
+        publish_result(ch, result)
+    if outcome == ACK:
+        ch.basic_ack(delivery_tag=delivery_tag)
+    elif outcome == REQUEUE:
+        ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+    else:
+        ch.basic_reject(delivery_tag=delivery_tag, requeue=False)
+
+
+def _run(stage, properties, body, process, on_give_up, status_url, emit_progress):
+    """Run a task; with the HTTP transport the result is POSTed here, off the I/O thread."""
+    if RESULT_TRANSPORT == "http":
+        emit_progress = None
+    outcome, result = run_task(stage, properties, body, process, on_give_up, emit_progress)
+    if result is not None and RESULT_TRANSPORT == "http":
+        post_result(status_url, result)
+        result = None
+    return outcome, result
+
+
+def handle_delivery(ch, method, properties, body, stage, process, on_give_up=None, status_url=None):
+    """Run and settle one delivery synchronously on the calling thread."""
+    emit_progress = functools.partial(publish_progress, ch)
+    outcome, result = _run(stage, properties, body, process, on_give_up, status_url, emit_progress)
+    settle(ch, method.delivery_tag, outcome, result)
+
+
+def _run_off_thread(connection, ch, delivery_tag, properties, body, stage, process, on_give_up, status_url):
+    def emit_progress(event):
+        try:
+            connection.add_callback_threadsafe(functools.partial(publish_progress, ch, event))
+        except Exception:
+            pass  # Connection is gone; progress is best-effort
+
+    outcome, result = _run(stage, properties, body, process, on_give_up, status_url, emit_progress)
+    try:
+        connection.add_callback_threadsafe(functools.partial(settle, ch, delivery_tag, outcome, result))
+    except Exception as e:
+        # Connection is gone; the broker will redeliver the task
+        logger.error(f"Could not settle delivery {delivery_tag}: {e}")
+
+
+def consume_forever(stage, process, on_give_up=None, name=None, prefetch=None, status_url=None,
+                    metrics_port=None):
+    """
+    Consume a stage's work queue with manual acks, reconnecting on failure.
+
+    Up to ``prefetch`` jobs run on a thread pool while the connection thread
+    keeps servicing heartbeats; results and acks are handed back to it with
+    ``add_callback_threadsafe``. ``status_url`` is used by the HTTP result
+    transport. With ``metrics_port`` this process serves its metrics there.
+    """
+    serve_metrics(metrics_port)
+    name = name or stage.capitalize()
+    prefetch = max(1, prefetch or WORKER_PREFETCH)
+    executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix=f"{stage}-job")
+
+    while True:
+        try:
+            logger.info("Connecting to RabbitMQ...")
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(RABBITMQ_HOST, heartbeat=RABBITMQ_HEARTBEAT)
+            )
+            channel = connection.channel()
+
+            queue_name = declare_stage_queue(channel, stage)
+            declare_results_exchange(channel)
+            declare_progress_exchange(channel)
+            channel.basic_qos(prefetch_count=prefetch)
+
+            def on_message(ch, method, properties, body, connection=connection):
+                executor.submit(
+                    _run_off_thread, connection, ch, method.delivery_tag, properties, body,
+                    stage, process, on_give_up, status_url,
+                )
+
+            logger.info(f"[{name} Worker is ready] Waiting for tasks on {queue_name} (prefetch {prefetch})...")
+            channel.basic_consume(queue=queue_name, on_message_callback=on_message, auto_ack=False)
+            channel.start_consuming()
+
+        except pika.exceptions.AMQPConnectionError:
+            logger.error("RabbitMQ connection failed, retrying in 5 seconds...")
+            time.sleep(5)
+        except KeyboardInterrupt:
+            logger.info("Worker stopped by user")
+            executor.shutdown(wait=False, cancel_futures=True)
+            break
+        except Exception as e:
+            logger.error(f"Unexpected error in main loop: {e}")
+            logger.error(traceback.format_exc())
+            time.sleep(5)
+
+
+def _child_main(stage, process, on_give_up, name, prefetch, status_url, metrics_port):
+    # Restarted children are forked from a supervisor that traps SIGTERM; undo that
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    consume_forever(stage, process, on_give_up, name, prefetch, status_url, metrics_port)
+
+
+def supervise(stage, process, on_give_up=None, name=None, processes=1, prefetch=None, status_url=None,
+              metrics_port=None):
+    """
+    Run ``processes`` independent consumer processes for a stage and restart
+    any that die. With a single process the consumer runs in this process.
+    Process ``slot`` serves its metrics on ``metrics_port + slot``.
+    """
+    if processes <= 1:
+        consume_forever(stage, process, on_give_up, name, prefetch, status_url, metrics_port)
+        return
+
+    children = {}
+
+    def spawn(slot):
+        child = multiprocessing.Process(
+            target=_child_main,
+            args=(stage, process, on_give_up, name, prefetch, status_url,
+                  metrics_port + slot if metrics_port else None),
+            name=f"{stage}-worker-{slot}",
+        )
+        child.start()
+        children[slot] = child
+        logger.info(f"Started {child.name} (pid {child.pid})")
+
+    for slot in range(processes):
+        spawn(slot)
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    try:
+        while not stopping:
+            time.sleep(1)
+            for slot, child in list(children.items()):
+                if not child.is_alive() and not stopping:
+                    logger.warning(f"{child.name} exited with code {child.exitcode}, restarting")
+                    spawn(slot)
+    except KeyboardInterrupt:
+        logger.info("Supervisor stopped by user")
+    finally:
+        for child in children.values():
+            if child.is_alive():
+                child.terminate()
+        for child in children.values():
+            child.join(10)
+
+
+def parse_worker_args(description):
+    """Command-line options shared by the worker entry points."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES,
+                        help="job processes to run on this host (default: WORKER_PROCESSES or 1)")
+    parser.add_argument("--prefetch", type=int, default=WORKER_PREFETCH,
+                        help="unacked tasks (and concurrent jobs) per process (default: WORKER_PREFETCH or 1)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on this port, +1 per extra process (default: METRICS_PORT or off)")
+    return parser.parse_args()
@@ -0,0 +1,215 @@
+#workers\thumbnail_worker.py
+
+import os
+import cv2
+import logging
+import numpy as np
+
+from mp4_probe import probe_mp4
+from task_queue import PermanentTaskError, handle_delivery, parse_worker_args, stage_queue_name, supervise
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] [%(levelname)s] %(message)s',
+    handlers=[
+        logging.FileHandler('thumbnail_worker.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+STAGE = 'thumbnails'
+QUEUE_NAME = stage_queue_name(STAGE)
+# Used only by the HTTP result transport (RESULT_TRANSPORT=http)
+FASTAPI_STATUS_URL = 'http://localhost:8000/internal/thumbnail-status'
+
+# Ensure absolute path to storage
+PROJECT_ROOT = os.path.dirname(os.path.dirname(__file__))
+STORAGE_PATH = os.path.abspath(os.path.join(PROJECT_ROOT, "static", "storage"))
+
+# Thumbnails per video, tile width in pixels and tiles per sprite row
+THUMBNAIL_COUNT = int(os.environ.get("THUMBNAIL_COUNT", "20"))
+THUMBNAIL_WIDTH = int(os.environ.get("THUMBNAIL_WIDTH", "160"))
+THUMBNAIL_COLUMNS = int(os.environ.get("THUMBNAIL_COLUMNS", "5"))
+SPRITE_JPEG_QUALITY = int(os.environ.get("SPRITE_JPEG_QUALITY", "80"))
+
+
+def _video_duration(cap, video_path):
+    """Duration in seconds, from the MP4 header when possible."""
+    header = probe_mp4(video_path)
+    if header and header["duration"] > 0:
+        return header["duration"]
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    return frame_count / fps if fps > 0 else 0
+
+
+def grab_thumbnails(video_path, count=None, width=None):
+    """
+    Decode ``count`` frames at evenly spaced timestamps by seeking to each one,
+    so the cost depends on the thumbnail count rather than the video length.
+    Returns (frames resized to ``width``, seconds between thumbnails).
+    """
+    count = count or THUMBNAIL_COUNT
+    width = width or THUMBNAIL_WIDTH
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Failed to open video: {video_path}")
+    try:
+        duration = _video_duration(cap, video_path)
+        if duration <= 0:
+            raise RuntimeError(f"Unknown duration for {video_path}")
+        interval = duration / count
+
+        frames = []
+        for i in range(count):
+            # Middle of each interval, so the last tile is not past the final frame
+            cap.set(cv2.CAP_PROP_POS_MSEC, (i + 0.5) * interval * 1000)
+            ok, frame = cap.read()
+            if not ok:
+                if not frames:
+                    raise RuntimeError(f"Could not decode any frame from {video_path}")
+                # Short read near the end: repeat the last good frame
+                frames.append(frames[-1])
+                continue
+            height = max(2, int(round(frame.shape[0] * width / frame.shape[1] / 2)) * 2)
+            frames.append(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA))
+        return frames, interval
+    finally:
+        cap.release()
+
+
+def build_sprite(frames, columns=None):
+    """Pack equally sized tiles row by row into one image."""
+    columns = max(1, min(columns or THUMBNAIL_COLUMNS, len(frames)))
+    rows = -(-len(frames) // columns)
+    tile_h, tile_w = frames[0].shape[:2]
+    sprite = np.zeros((rows * tile_h, columns * tile_w, 3), np.uint8)
+    for i, frame in enumerate(frames):
+        y, x = divmod(i, columns)
+        sprite[y * tile_h:(y + 1) * tile_h, x * tile_w:(x + 1) * tile_w] = frame
+    return sprite, columns
+
+
+def _vtt_time(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{secs:06.3f}"
+
+
+def build_vtt(sprite_filename, count, interval, columns, tile_w, tile_h):
+    """WebVTT cues mapping each interval to its tile (``#xywh`` media fragment)."""
+    lines = ["WEBVTT", ""]
+    for i in range(count):
+        y, x = divmod(i, columns)
+        lines.append(f"{_vtt_time(i * interval)} --> {_vtt_time((i + 1) * interval)}")
+        lines.append(f"{sprite_filename}#xywh={x * tile_w},{y * tile_h},{tile_w},{tile_h}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _write_atomic(path, write):
+    temp_path = os.path.join(os.path.dirname(path), f".partial-{os.path.basename(path)}")
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _write_jpeg(path, image):
+    if not cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, SPRITE_JPEG_QUALITY]):
+        raise RuntimeError(f"Failed to write {path}")
+
+
+def generate_previews(video_path, output_dir, base_name):
+    """Write ``<base>_sprite.jpg`` and ``<base>_thumbnails.vtt``; returns their description."""
+    frames, interval = grab_thumbnails(video_path)
+    sprite, columns = build_sprite(frames)
+    tile_h, tile_w = frames[0].shape[:2]
+
+    sprite_filename = f"{base_name}_sprite.jpg"
+    vtt_filename = f"{base_name}_thumbnails.vtt"
+    vtt = build_vtt(sprite_filename, len(frames), interval, columns, tile_w, tile_h)
+
+    _write_atomic(os.path.join(output_dir, sprite_filename), lambda path: _write_jpeg(path, sprite))
+
+    def write_vtt(path):
+        with open(path, "w") as f:
+            f.write(vtt)
+
+    _write_atomic(os.path.join(output_dir, vtt_filename), write_vtt)
+
+    return {
+        "sprite": sprite_filename,
+        "vtt": vtt_filename,
+        "count": len(frames),
+        "width": tile_w,
+        "height": tile_h,
+        "columns": columns,
+        "interval": round(interval, 3),
+    }
+
+
+def process_task(data, attempt=1, progress=None):
+    """
+    Generate the preview sprite sheet and WebVTT index for the video described
+    by a task message. Previews are taken from the enhanced output when the
+    enhancement stage ran upstream, otherwise from the upload. Raises
+    PermanentTaskError for tasks that cannot succeed.
+    """
+    logger.info(f"Incoming {STAGE} task for {data.get('video_id')} (attempt {attempt})")
+
+    enhancement = (data.get("upstream") or {}).get("enhancement") or {}
+    source_path = enhancement.get("enhanced_filename") if not enhancement.get("error") else None
+    source_path = source_path or data.get("filepath")
+    video_id = data.get("video_id")
+
+    if not video_id or not source_path:
+        raise PermanentTaskError("Missing video_id or filepath in message")
+
+    # Get just the filename and look in storage directory
+    filename = os.path.basename(source_path)
+    normalized_path = os.path.normpath(os.path.join(STORAGE_PATH, filename))
+
+    if not os.path.exists(normalized_path):
+        raise PermanentTaskError(f"Video not found: {normalized_path}")
+
+    thumbnails = generate_previews(normalized_path, STORAGE_PATH, os.path.splitext(filename)[0])
+    logger.info(f"Thumbnails written: {thumbnails}")
+
+    return {
+        "video_id": video_id,
+        "thumbnails": thumbnails
+    }
+
+
+def give_up(data, error):
+    """Failure result for a task that will not be retried any more."""
+    video_id = data.get("video_id")
+    if not video_id:
+        return None
+    return {
+        "video_id": video_id,
+        "thumbnails": None,
+        "error": error
+    }
+
+
+def callback(ch, method, properties, body):
+    """Process a RabbitMQ delivery; acked on success, retried or dead-lettered on failure."""
+    handle_delivery(ch, method, properties, body, STAGE, process_task,
+                    on_give_up=give_up, status_url=FASTAPI_STATUS_URL)
+
+
+def main():
+    """Supervise one or more consumer processes for the thumbnail stage."""
+    args = parse_worker_args("Thumbnail and sprite sheet worker")
+    supervise(STAGE, process_task, on_give_up=give_up, processes=args.processes,
+              prefetch=args.prefetch, status_url=FASTAPI_STATUS_URL, metrics_port=args.metrics_port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#workers\video_filters.py
+
+"""
+Small filter-graph API used by the enhancement worker.
+
+A chain is described as a list of ``{"op": name, **params}`` dicts (this is
+what arrives in the ``filters`` field of a task message). Consecutive point
+operations (brightness, contrast, gamma, levels, ...) are fused at build time
+into a single 256-entry lookup table and applied with one ``cv2.LUT`` pass;
+spatial filters (sharpen, denoise) run as separate stages. Chains filter one
+frame at a time, in place, as the enhancement pipeline's frame ring hands
+them over.
+"""
+
+import cv2
+import numpy as np
+
+
+# Matches the historical convertScaleAbs(alpha=1.2, beta=20) enhancement
+DEFAULT_FILTERS = [{"op": "scale", "alpha": 1.2, "beta": 20}]
+
+
+# --- Point operations: float ramp in, float ramp out --------------------------
+
+def _scale(x, alpha=1.0, beta=0.0):
+    return np.abs(x * alpha + beta)
+
+
+def _brightness(x, beta=0.0):
+    return x + beta
+
+
+def _contrast(x, alpha=1.0, pivot=128.0):
+    return (x - pivot) * alpha + pivot
+
+
+def _gamma(x, gamma=1.0):
+    if gamma <= 0:
+        raise ValueError("gamma must be positive")
+    return 255.0 * np.power(x / 255.0, 1.0 / gamma)
+
+
+def _levels(x, in_black=0, in_white=255, out_black=0, out_white=255, gamma=1.0):
+    if in_white <= in_black:
+        raise ValueError("levels: in_white must be greater than in_black")
+    if gamma <= 0:
+        raise ValueError("gamma must be positive")
+    normalized = np.clip((x - in_black) / float(in_white - in_black), 0.0, 1.0)
+    return out_black + np.power(normalized, 1.0 / gamma) * (out_white - out_black)
+
+
+POINT_OPS = {
+    "scale": _scale,
+    "brightness": _brightness,
+    "contrast": _contrast,
+    "gamma": _gamma,
+    "levels": _levels,
+}
+
+
+# --- Stages -------------------------------------------------------------------
+
+class LUTStage:
+    """One or more fused point operations applied as a single cv2.LUT pass."""
+
+    in_place = True
+
+    def __init__(self, lut):
+        self.lut = lut
+
+    def run(self, src, dst):
+        cv2.LUT(src, self.lut, dst=dst)
+
+
+class SpatialStage:
+    """A neighbourhood filter; needs a destination distinct from its source."""
+
+    in_place = False
+
+
+class SharpenStage(SpatialStage):
+    def __init__(self, amount=1.0):
+        a = float(amount)
+        self.kernel = np.array([[0, -a, 0], [-a, 1 + 4 * a, -a], [0, -a, 0]], dtype=np.float32)
+
+    def run(self, src, dst):
+        cv2.filter2D(src, -1, self.kernel, dst=dst)
+
+
+class DenoiseStage(SpatialStage):
+    def __init__(self, ksize=3, method="median"):
+        ksize = int(ksize)
+        if ksize < 3 or ksize % 2 == 0:
+            raise ValueError("denoise: ksize must be an odd integer >= 3")
+        if method not in ("median", "gaussian"):
+            raise ValueError(f"denoise: unknown method {method!r}")
+        self.ksize = ksize
+        self.method = method
+
+    def run(self, src, dst):
+        if self.method == "median":
+            cv2.medianBlur(src, self.ksize, dst=dst)
+        else:
+            cv2.GaussianBlur(src, (self.ksize, self.ksize), 0, dst=dst)
+
+
+SPATIAL_OPS = {
+    "sharpen": SharpenStage,
+    "denoise": DenoiseStage,
+}
+
+
+def compile_lut(ops):
+    """
+    Fuse a sequence of ``(func, params)`` point operations into one uint8 LUT.
+    Each step saturates and rounds like the equivalent 8-bit OpenCV call would.
+    """
+    ramp = np.arange(256, dtype=np.float64)
+    for func, params in ops:
+        ramp = np.rint(np.clip(func(ramp, **params), 0, 255))
+    return ramp.astype(np.uint8)
+
+
+class FilterChain:
+    """A compiled, reusable sequence of filter stages."""
+
+    def __init__(self, stages, spec=None):
+        self.stages = stages
+        self.spec = spec or []
+        self._scratch = {}
+
+    def __getstate__(self):
+        # Scratch buffers are per-process; don't ship them to pool workers
+        state = self.__dict__.copy()
+        state["_scratch"] = {}
+        return state
+
+    def _scratch_for(self, shape, avoid):
+        buffers = self._scratch.get(shape)
+        if buffers is None:
+            buffers = self._scratch[shape] = (np.empty(shape, np.uint8), np.empty(shape, np.uint8))
+        return buffers[1] if buffers[0] is avoid else buffers[0]
+
+    def apply(self, frame):
+        """Filter one ``(H, W, C)`` uint8 frame in place and return it."""
+        current = frame
+        last = len(self.stages) - 1
+        for i, stage in enumerate(self.stages):
+            if stage.in_place:
+                stage.run(current, current)
+                continue
+            if i == last and current is not frame:
+                target = frame
+            else:
+                target = self._scratch_for(frame.shape, current)
+            stage.run(current, target)
+            current = target
+        if current is not frame:
+            np.copyto(frame, current)
+        return frame
+
+
+def build_filter_chain(spec=None):
+    """
+    Build a FilterChain from a list of ``{"op": name, **params}`` dicts.
+    ``None`` selects DEFAULT_FILTERS. Raises ValueError for unknown operations
+    or invalid parameters.
+    """
+    if spec is None:
+        spec = DEFAULT_FILTERS
+    if not isinstance(spec, list):
+        raise ValueError("filters must be a list of {'op': ...} objects")
+
+    stages = []
+    pending_points = []
+    for entry in spec:
+        if not isinstance(entry, dict) or "op" not in entry:
+            raise ValueError(f"Invalid filter entry: {entry!r}")
+        params = {k: v for k, v in entry.items() if k != "op"}
+        name = entry["op"]
+        try:
+            if name in POINT_OPS:
+                # Validate eagerly so bad parameters fail at build time
+                POINT_OPS[name](np.zeros(1), **params)
+                pending_points.append((POINT_OPS[name], params))
+            elif name in SPATIAL_OPS:
+                if pending_points:
+                    stages.append(LUTStage(compile_lut(pending_points)))
+                    pending_points = []
+                stages.append(SPATIAL_OPS[name](**params))
+            else:
+                raise ValueError(f"Unknown filter op: {name!r}")
+        except TypeError as e:
+            raise ValueError(f"Invalid parameters for {name!r}: {e}") from e
+
+    if pending_points:
+        stages.append(LUTStage(compile_lut(pending_points)))
+    return FilterChain(stages, spec)
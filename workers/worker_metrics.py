@@ -0,0 +1,83 @@
+#workers\worker_metrics.py
+
+"""
+Prometheus metrics for the stage workers.
+
+With ``--metrics-port`` (or METRICS_PORT) a worker serves them over HTTP;
+under ``--processes N`` consumer process ``i`` listens on port + i. Task
+metrics are recorded once per task by ``task_queue.run_task`` and the stage
+metrics once per job by the workers, never per frame. prometheus_client is
+optional: without it every metric is a no-op.
+"""
+
+import logging
+import os
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, start_http_server
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+    logging.warning("prometheus_client not available - worker metrics are disabled")
+
+logger = logging.getLogger(__name__)
+
+# 0 serves no metrics
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+FPS_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360, 480, 1000)
+
+
+class _NullMetric:
+    """Stands in for every metric when prometheus_client is missing."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+
+def _histogram(name, documentation, labels=(), buckets=DURATION_BUCKETS):
+    if not PROMETHEUS_AVAILABLE:
+        return _NullMetric()
+    return Histogram(name, documentation, labels, buckets=buckets)
+
+
+def _counter(name, documentation, labels=()):
+    return Counter(name, documentation, labels) if PROMETHEUS_AVAILABLE else _NullMetric()
+
+
+def _gauge(name, documentation, labels=()):
+    return Gauge(name, documentation, labels) if PROMETHEUS_AVAILABLE else _NullMetric()
+
+
+TASK_QUEUE_WAIT = _histogram("video_task_queue_wait_seconds",
+                             "Time from the API publishing a task to a worker starting it", ["stage"], WAIT_BUCKETS)
+TASK_DURATION = _histogram("video_task_duration_seconds", "Time spent running a task, by outcome",
+                           ["stage", "outcome"])
+TASKS_IN_PROGRESS = _gauge("video_tasks_in_progress", "Tasks being run by this process", ["stage"])
+METADATA_DURATION = _histogram("video_metadata_extraction_seconds",
+                               "Metadata extraction time, by where the metadata came from", ["source"])
+ENHANCEMENT_DURATION = _histogram("video_enhancement_seconds", "Time to enhance one video")
+ENHANCEMENT_FPS = _histogram("video_enhancement_fps", "Input frames enhanced per second, per video", (), FPS_BUCKETS)
+ENHANCEMENT_FRAMES = _counter("video_enhancement_frames", "Output frames written by the enhancement stage")
+
+
+def serve_metrics(port):
+    """Start the metrics HTTP server on ``port`` (in a daemon thread); 0 or None does nothing."""
+    if not port:
+        return
+    if not PROMETHEUS_AVAILABLE:
+        logger.warning(f"Not serving metrics on port {port}: prometheus_client is not installed")
+        return
+    start_http_server(port)
+    logger.info(f"Serving metrics on port {port}")
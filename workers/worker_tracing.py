@@ -0,0 +1,109 @@
+#workers\worker_tracing.py
+
+"""
+Spans for one task, sent back to the API with its result.
+
+The API publishes every task with a W3C ``traceparent`` header (parented on
+its publish span) and ``x-published-at``. ``task_queue.run_task`` opens a
+TaskTrace from them and makes it current for the job's thread, so stage
+code can add child spans with ``span(name)`` or ``current_trace().add``
+without the trace being passed around. Tasks published without a
+traceparent are not traced.
+"""
+
+import secrets
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+TRACEPARENT_HEADER = 'traceparent'
+PUBLISHED_AT_HEADER = 'x-published-at'
+
+_local = threading.local()
+
+
+def new_span_id():
+    return secrets.token_hex(8)
+
+
+def parse_traceparent(value):
+    """(trace_id, parent span_id) from a traceparent header, or None."""
+    parts = value.split('-') if isinstance(value, str) else []
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+def _span(name, start, end, parent_id, span_id=None, **attributes):
+    return {
+        "name": name,
+        "span_id": span_id or new_span_id(),
+        "parent_id": parent_id,
+        "start": start,
+        "end": end,
+        "attributes": attributes,
+    }
+
+
+class TaskTrace:
+    """
+    The ``process`` span of one task, its ``queue`` span (publish to start)
+    and child spans added while it runs. Times are epoch seconds.
+    """
+
+    def __init__(self, stage, headers):
+        self.stage = stage
+        self.trace_id, self.parent_id = parse_traceparent(headers.get(TRACEPARENT_HEADER)) or (None, None)
+        self.span_id = new_span_id()
+        self.started = time.time()
+        self.spans = []
+        published_at = headers.get(PUBLISHED_AT_HEADER)
+        if self.enabled and isinstance(published_at, (int, float)) and published_at <= self.started:
+            self.spans.append(_span("queue", published_at, self.started, self.parent_id, stage=stage))
+
+    @property
+    def enabled(self):
+        return self.trace_id is not None
+
+    def add(self, name, start, end, **attributes):
+        """Record a child span of the task's process span."""
+        if self.enabled:
+            self.spans.append(_span(name, start, end, self.span_id, stage=self.stage, **attributes))
+
+    @contextmanager
+    def span(self, name, **attributes):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), **attributes)
+
+    def finish(self, outcome):
+        """The spans to return with the result, ending the process span now."""
+        end = time.time()
+        process = _span("process", self.started, end, self.parent_id, self.span_id,
+                        stage=self.stage, outcome=outcome)
+        return {"trace_id": self.trace_id, "spans": self.spans + [process], "finished_at": end}
+
+
+def current_trace():
+    """The TaskTrace of the task running on this thread, or None."""
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def activate(trace):
+    previous = current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def span(name, **attributes):
+    """Context manager timing a child span of the current task (a no-op outside one)."""
+    trace = current_trace()
+    if trace is None or not trace.enabled:
+        return nullcontext()
+    return trace.span(name, **attributes)